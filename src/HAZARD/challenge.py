@@ -11,6 +11,7 @@ from .envs.fire.fire_utils import ObjectState as FireObjectState
 from .policy.env_actions import (agent_walk_to, agent_pickup, agent_drop, agent_explore, visualize_obs,
                                  agent_walk_to_single_step, low_level_action)
 import logging
+import numpy as np
 
 PATH = os.path.dirname(os.path.abspath(__file__))
 while os.path.basename(PATH) != "HAZARD":
@@ -46,7 +47,8 @@ class Challenge:
     def __init__(self, env_name, data_dir, output_dir, logger, launch_build=True, port=1071, screen_size=512,
                  map_size_h=512, map_size_v=512, grid_size=0.1, debug=False, max_steps=1500, use_gt=False,
                  reverse_observation=False, record_only=False, record_with_agents=False, use_dino=False,
-                 effect_on_agents=False, use_cached_assets=False):
+                 effect_on_agents=False, use_cached_assets=False, reuse_controller=False,
+                 scene_snapshots=False, obs_cache=False, lazy_obs=False, leak_check=False):
         if env_name == "fire":
             env = FireEnv
             max_steps = 1500 if not record_only else 4500
@@ -65,14 +67,18 @@ class Challenge:
                            map_size_h=map_size_h, map_size_v=map_size_v, grid_size=grid_size,
                            image_capture_path=os.path.join(output_dir, "images"), use_dino=use_dino,
                            log_path = os.path.join(output_dir, "log.txt"), reverse_observation=reverse_observation,
-                           check_version=False, use_gt=use_gt, record_only=record_only)
+                           check_version=False, use_gt=use_gt, record_only=record_only,
+                           reuse_controller=reuse_controller, scene_snapshots=scene_snapshots,
+                           obs_cache=obs_cache, lazy_obs=lazy_obs, leak_check=leak_check)
         else:
             self.env = env(launch_build=True, screen_size=screen_size, port=port, use_local_resources=use_cached_assets,
                            map_size_h=map_size_h, map_size_v=map_size_v, grid_size=grid_size,
                            image_capture_path=os.path.join(output_dir, "images") if record_with_agents else None,
                            check_version=False, use_gt=use_gt, use_dino=use_dino,
                            log_path=os.path.join(output_dir, "log.txt"),
-                           reverse_observation=reverse_observation, record_only=record_only)
+                           reverse_observation=reverse_observation, record_only=record_only,
+                           reuse_controller=reuse_controller, scene_snapshots=scene_snapshots,
+                           obs_cache=obs_cache, lazy_obs=lazy_obs, leak_check=leak_check)
         self.logger = logger
         self.logger.debug(port)
         self.logger.info("Environment Created")
@@ -95,6 +101,43 @@ class Challenge:
         self.nearest_object = None
         self.have_finished_list = []
 
+    def hide_finished(self, state):
+        """
+        The observation with the finished objects removed from sem_map and seg_mask. The controller may return
+        the same observation again until the next frame, so it is changed on a copy.
+        """
+        finished = list(self.have_finished_list)
+
+        def hidden(ids):
+            ids = ids.copy()
+            ids[np.isin(ids, finished)] = 0
+            return ids
+
+        observed = state
+
+        def raw():
+            raw = observed["raw"].copy()
+            raw.replace("seg_mask", lambda: hidden(observed["raw"]["seg_mask"]))
+            return raw
+
+        state = state.copy()
+        state.replace("sem_map", lambda: dict(observed["sem_map"], id=hidden(observed["sem_map"]["id"])))
+        state.replace("raw", raw)
+        return state
+
+    def obs_fields(self, agent):
+        """
+        The observation fields read in a step: the ones the agent declares (None for all fields), sem_map for
+        process_input and raw.rgb for visualize_obs.
+        """
+        fields = getattr(agent, "obs_fields", None)
+        if fields is None:
+            return None
+        fields = fields + ["sem_map"]
+        if agent.agent_type in ["llm", "llmv2", "mcts", "mctsv2"]:
+            fields.append("raw.rgb")
+        return fields
+
     def get_target_info(self, target_list):
         value_dict = json.load(open(os.path.join(PATH, "src/HAZARD/scenes/scene_configs/value.json")))
         object_attribute_dict = {}
@@ -283,6 +326,7 @@ class Challenge:
                 return
 
             action_logger = open(os.path.join(self.output_dir, "actions.txt"), "w")
+            obs_fields = self.obs_fields(agent)
 
             if agent.agent_type == "record":
                 while self.env.controller.frame_count < self.max_steps:
@@ -295,11 +339,10 @@ class Challenge:
                    print("Target status:")
                    for target in self.target_status:
                         print(target, self.target_status[target], self.env.controller.manager.objects[target].state, self.env.controller.manager.objects[target].position)
-                state = self.env.controller._obs()
+                state = self.env.controller._obs(fields=obs_fields)
                 # Suppose agent can not see the finished object
-                for finished_id in self.have_finished_list:
-                    state['sem_map']['id'][state['sem_map']['id'] == finished_id] = 0
-                    state['raw']['seg_mask'][state['raw']['seg_mask'] == finished_id] = 0
+                if len(self.have_finished_list) > 0:
+                    state = self.hide_finished(state)
                 self.step_num += 1
                 processed_input = self.process_input(state, action_result, action_info)
                 processed_input['save_dir'] = str(os.path.join(self.output_dir, str(i)))
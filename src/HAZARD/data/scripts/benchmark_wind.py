@@ -0,0 +1,48 @@
+import argparse
+import os
+import time
+from src.HAZARD.envs.wind.windagent_controller import WindAgentController
+from src.HAZARD.utils.scene_setup import SceneSetup
+
+"""
+Frames per second of the wind simulation with and without sleep-aware force skipping, on the suburb scenes.
+The agent stands still, only the wind and the objects move.
+
+python -m src.HAZARD.data.scripts.benchmark_wind --port 1071 --frames 500
+"""
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+while os.path.basename(PATH) != "HAZARD":
+    PATH = os.path.dirname(PATH)
+
+
+def benchmark(data_dir: str, sleep: bool, port: int, frames: int, launch_build: bool):
+    controller = WindAgentController(port=port, launch_build=launch_build, sleep=sleep)
+    controller.seed(0)
+    controller.init_scene(SceneSetup(data_dir=data_dir))
+    skipped = 0
+    start = time.perf_counter()
+    for _ in range(frames):
+        controller.communicate([])
+        skipped += controller.manager.sleep_report()["skipped"]
+    seconds = time.perf_counter() - start
+    forces = controller.manager.force_emitter.stats()["total_sent"]
+    controller.communicate({"$type": "terminate"})
+    controller.socket.close()
+    return dict(fps=frames / seconds, skipped=skipped, forces=forces)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=1071)
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--launch_build", action="store_true")
+    parser.add_argument("--data_dir", type=str, default=os.path.join(PATH, "data", "room_setup_wind"))
+    args = parser.parse_args()
+
+    scenes = sorted(d for d in os.listdir(args.data_dir) if "suburb" in d)
+    for scene in scenes:
+        for sleep in [False, True]:
+            result = benchmark(os.path.join(args.data_dir, scene), sleep, args.port, args.frames, args.launch_build)
+            print("{} sleep={}: {:.1f} frames/sec, {} force commands, {} forces skipped".format(
+                scene, sleep, result["fps"], result["forces"], result["skipped"]))
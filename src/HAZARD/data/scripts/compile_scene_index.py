@@ -0,0 +1,28 @@
+import argparse
+import os
+import time
+from src.HAZARD.utils.scene_index import compile_scenes
+
+"""
+Compile the cached index of every scene of the room_setup_* directories once, instead of on the first
+SceneSetup of each scene.
+
+python -m src.HAZARD.data.scripts.compile_scene_index
+"""
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+while os.path.basename(PATH) != "HAZARD":
+    PATH = os.path.dirname(PATH)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default=os.path.join(PATH, "data"))
+    args = parser.parse_args()
+
+    for name in sorted(os.listdir(args.data_dir)):
+        if not name.startswith("room_setup"):
+            continue
+        start = time.perf_counter()
+        scenes = compile_scenes(os.path.join(args.data_dir, name))
+        print("{}: {} scenes in {:.2f} sec".format(name, len(scenes), time.perf_counter() - start))
@@ -6,6 +6,9 @@ import numpy as np
 from .manager import FireObjectManager
 from .fire_utils import *
 from .object import FireStatus, AgentStatus
+from src.HAZARD.utils.spatial_hash import SpatialHash
+from src.HAZARD.utils.response_router import ResponseRouter
+from src.HAZARD.utils.object_table import Column, TableRow, ObjectTable
 
 
 def CHOUKA(T, constants=default_const):
@@ -28,15 +31,35 @@ def CHOUKA(T, constants=default_const):
                    (1 - start_prob) / (constants.CHOUKA_THRESHOLD_UPPER-constants.CHOUKA_THRESHOLD_PROB_INCREASE) 
                    * (T - constants.CHOUKA_THRESHOLD_PROB_INCREASE))
 
+def chouka_probabilities(T: np.ndarray, constants=default_const) -> np.ndarray:
+    '''
+    CHOUKA for an array of draw counts.
+    '''
+    start_prob = constants.CHOUKA_INITITIAL_PROB
+    increase = (1 - start_prob) / (constants.CHOUKA_THRESHOLD_UPPER - constants.CHOUKA_THRESHOLD_PROB_INCREASE) \
+               * (T - constants.CHOUKA_THRESHOLD_PROB_INCREASE)
+    return np.where(T <= constants.CHOUKA_THRESHOLD_PROB_INCREASE, start_prob, np.minimum(1.0, start_prob + increase))
+
 def box_overlap(pos1, size1, pos2, size2):
-    pos1 = np.array(pos1)
-    size1 = np.array(size1)
-    pos2 = np.array(pos2)
-    size2 = np.array(size2)
-    return np.all(pos1 + size1 / 2 > pos2 - size2 / 2) and np.all(pos1 - size1 / 2 < pos2 + size2 / 2)
+    for p1, s1, p2, s2 in zip(pos1, size1, pos2, size2):
+        if not (p1 + s1 / 2 > p2 - s2 / 2 and p1 - s1 / 2 < p2 + s2 / 2):
+            return False
+    return True
+
+# directions a fire can spread to, in (x, z). Fire.spread_mask has bit i set while SPREAD_DIRS[i] is left.
+SPREAD_DIRS = [(-1.1, 0), (1.1, 0), (0, -1.1), (0, 1.1)]
+SPREAD_DIRECTIONS = np.array([[x, 0, z] for x, z in SPREAD_DIRS])
+
+class Fire(TableRow):
+    __slots__ = ()
+    fire_id = Column(np.int64)
+    last_spread = Column(np.int64)
+    scale = Column(np.float64)
+    spread_mask = Column(np.uint8)
+    extinguishing = Column(np.bool_)
 
-class Fire:
     def __init__(self, fire_id, last_spread, scale, spread_dirs):
+        super().__init__()
         self.fire_id = fire_id
         self.last_spread = last_spread
         self.scale = scale
@@ -44,6 +67,14 @@ class Fire:
 
         self.extinguishing = False
 
+    @property
+    def spread_dirs(self):
+        return [d for i, d in enumerate(SPREAD_DIRS) if self.spread_mask >> i & 1]
+
+    @spread_dirs.setter
+    def spread_dirs(self, spread_dirs):
+        self.spread_mask = sum(1 << SPREAD_DIRS.index(tuple(d)) for d in spread_dirs)
+
 """
 This controller controls the spread of fire.
 """
@@ -53,15 +84,27 @@ class FireController(Controller):
         self.commands: List[dict] = list()
         super().__init__(port, check_version, launch_build)
         
-        self.manager = FireObjectManager()
+        # classifies the output data of each frame once for the manager, fire_step and image capture
+        self.router = ResponseRouter()
+        self.manager = FireObjectManager(temperature_cutoff=kwargs.get("temperature_cutoff", None),
+                                         bounds_refresh_interval=kwargs.get("bounds_refresh_interval", 100),
+                                         router=self.router, lod=kwargs.get("lod", False),
+                                         lod_validate=kwargs.get("lod_validate", False))
         self.add_ons.append(self.manager)
 
         self.update_fire_per_frame = 10
         self.frame_count = 0
-        self.fire_info: Dict[int, Fire] = dict()
+        # one row per fire, keyed by the burning object (or by the fire itself on the floor)
+        self.fire_info: Dict[int, Fire] = ObjectTable(Fire)
         self.fire_candidate = dict()
         self.RNG = np.random.Generator(np.random.PCG64(seed))
         self.constants = constants
+        # grid buckets over the xz plane, only used to find candidates for the exact tests
+        spread_cell = float(max(constants.FIRE_SPREAD_SIZE[0], constants.FIRE_SPREAD_SIZE[2]))
+        self.fire_index = SpatialHash(cell_size=spread_cell, axes=(0, 2)) # fire_info key -> fire footprint
+        self.candidate_index = SpatialHash(cell_size=spread_cell, axes=(0, 2)) # fire_candidate key -> footprint
+        self.fire_effect_index = SpatialHash(cell_size=constants.EXTINGUISH_RADIUS, axes=(0, 2)) # fire_info key -> effect position
+        self.object_fires = set() # fire_info keys of fires on objects, whose footprint follows the object
 
     def seed(self, seed):
         self.RNG = np.random.Generator(np.random.PCG64(seed))
@@ -90,6 +133,7 @@ class FireController(Controller):
                                    last_spread=self.frame_count,
                                    scale=self.constants.FIRE_INIT_SCALE,
                                    spread_dirs=[(-1.1, 0), (1.1, 0), (0, -1.1), (0, 1.1)])
+        self.index_fire(idx)
 
     def add_fire_object(self, idx):
         new_idx = self.get_unique_id()
@@ -102,6 +146,8 @@ class FireController(Controller):
                                    last_spread=self.frame_count,
                                    scale=self.constants.FIRE_FINAL_SCALE,
                                    spread_dirs=[(-1.1, 0), (1.1, 0), (0, -1.1), (0, 1.1)])
+        self.object_fires.add(idx)
+        self.index_fire(idx)
 
         size = self.manager.objects[idx].size
         self.commands.append({"$type": "scale_visual_effect", "id": new_idx, "scale_factor": {"x": float(size[0]*0.5), "y": float(size[1]*0.5), "z": float(size[2]*0.5)}})
@@ -113,7 +159,7 @@ class FireController(Controller):
         self.fire_info[fire_idx].extinguishing = True
         self.fire_info[fire_idx].spread_dirs = []
         self.manager.objects[fire_idx].temperature = self.constants.ROOM_TEMPERATURE
-        pass
+        self.manager.invalidate_temperature_field()
 
     def extinguish_fire_object(self, obj_idx):
         """
@@ -124,36 +170,118 @@ class FireController(Controller):
         self.manager.objects[obj_idx].temperature = self.constants.ROOM_TEMPERATURE
         self.manager.objects[obj_idx].is_heat_source = True
         self.manager.objects[self.fire_info[obj_idx].fire_id].temperature = self.constants.ROOM_TEMPERATURE
-        pass
+        self.manager.invalidate_temperature_field()
     
     def add_agent(self, idx, pos):
         self.manager.add_object(AgentStatus(idx, constants=self.constants, position=pos, size=None, endurance=10000))
     
+    def index_fire(self, idx):
+        self.fire_index.update(idx, self.manager.objects[idx].position, extent=self.constants.FIRE_SPREAD_SIZE * 0.5)
+        self.fire_effect_index.update(idx, self.manager.objects[self.fire_info[idx].fire_id].position)
+
+    def unindex_fire(self, idx):
+        self.fire_index.remove(idx)
+        self.fire_effect_index.remove(idx)
+        self.object_fires.discard(idx)
+
+    def sync_fire_index(self):
+        """
+        Fires on objects move with the object, refresh their footprints.
+        """
+        for idx in self.object_fires:
+            if idx in self.manager.objects:
+                self.fire_index.update(idx, self.manager.objects[idx].position, extent=self.constants.FIRE_SPREAD_SIZE * 0.5)
+
+    def clear_fire_index(self):
+        self.fire_index.clear()
+        self.candidate_index.clear()
+        self.fire_effect_index.clear()
+        self.object_fires = set()
+
     def candidate_fire_overlap(self, pos, size):
-        for pos2, size2 in self.fire_candidate.values():
+        low = np.asarray(pos) - np.asarray(size) * 0.5
+        high = np.asarray(pos) + np.asarray(size) * 0.5
+        for idx in self.candidate_index.query_box(low, high):
+            pos2, size2 = self.fire_candidate[idx]
             if box_overlap(pos, size, pos2, size2):
                 return True
-        for idx in self.fire_info:
+        for idx in self.fire_index.query_box(low, high):
             if box_overlap(pos, size, self.manager.objects[idx].position, self.constants.FIRE_SPREAD_SIZE):
                 return True
         return False
 
-    def try_spread(self, idx):
-        if idx in self.manager.objects and np.abs(self.manager.objects[idx].position).sum() > 50:
-            return
-        if len(self.fire_info[idx].spread_dirs) == 0:
+    def spread_fires(self, rows: np.ndarray):
+        """
+        Fires in these rows of fire_info may spread to a random direction left, with the CHOUKA probability.
+        """
+        fires = self.fire_info
+        keys = fires.id_array()[rows]
+        mask = fires.column("spread_mask")[rows]
+        obj_rows, found = self.manager.objects.lookup(keys)
+        found &= self.manager.objects.valid_mask("position")[obj_rows]
+        positions = self.manager.objects.column("position")[obj_rows]
+        # fires far away (on objects dropped out of the scene) do not spread
+        active = found & (np.abs(positions).sum(axis=1) <= 50) & (mask != 0)
+        rows, mask, positions = rows[active], mask[active], positions[active]
+        burning_time = self.frame_count - fires.column("last_spread")[rows]
+        hit = self.RNG.uniform(size=len(rows)) < chouka_probabilities(burning_time // 5, self.constants)
+        rows, mask, positions = rows[hit], mask[hit], positions[hit]
+        if len(rows) == 0:
             return
-        burning_time = self.frame_count - self.fire_info[idx].last_spread
-        spread_prob = CHOUKA(burning_time // 5)
-        if self.RNG.uniform() < spread_prob:
-            spread_dir = self.fire_info[idx].spread_dirs[self.RNG.choice(len(self.fire_info[idx].spread_dirs))]
-            self.fire_info[idx].spread_dirs.remove(spread_dir)
-            spread_dir = np.array([spread_dir[0], 0, spread_dir[1]])
-
-            pos = self.manager.objects[idx].position * np.array([1, 0, 1]) + spread_dir * (self.constants.FIRE_SPREAD_SIZE + self.manager.objects[self.fire_info[idx].fire_id].size) * 0.5
+        # pick one of the remaining directions uniformly, the choice-th set bit of the mask
+        bits = (mask[:, None] >> np.arange(len(SPREAD_DIRS))) & 1
+        choice = self.RNG.integers(0, bits.sum(axis=1))
+        direction = np.argmax((bits == 1) & (np.cumsum(bits, axis=1) == choice[:, None] + 1), axis=1)
+        fires.column("spread_mask")[rows] = mask & ~(1 << direction)
+        fires.column("last_spread")[rows] = self.frame_count
+
+        fire_rows, _ = self.manager.objects.lookup(fires.column("fire_id")[rows])
+        fire_sizes = self.manager.objects.column("size")[fire_rows]
+        targets = positions * np.array([1, 0, 1]) + SPREAD_DIRECTIONS[direction] * (self.constants.FIRE_SPREAD_SIZE + fire_sizes) * 0.5
+        # candidates added here block the ones after them, so these checks stay sequential
+        for pos in targets:
             if not self.candidate_fire_overlap(pos, self.constants.FIRE_SPREAD_SIZE):
-                self.fire_candidate[self.get_unique_id()] = (pos, self.constants.FIRE_SPREAD_SIZE)
-            self.fire_info[idx].last_spread = self.frame_count
+                candidate_id = self.get_unique_id()
+                self.fire_candidate[candidate_id] = (pos, self.constants.FIRE_SPREAD_SIZE)
+                self.candidate_index.insert(candidate_id, pos, extent=self.constants.FIRE_SPREAD_SIZE * 0.5)
+
+    def evolve_fires(self):
+        """
+        One update of all fires: growing ones scale up, large enough ones try spreading,
+        extinguishing ones scale down and are removed once small enough.
+        """
+        fires = self.fire_info
+        if len(fires) == 0:
+            return
+        step = self.constants.FIRE_SCALE_STEP
+        scale = fires.column("scale")
+        extinguishing = fires.column("extinguishing")
+        grow = (scale < self.constants.FIRE_FINAL_SCALE) & ~extinguishing
+        spread = ~grow & ~extinguishing
+        shrink = extinguishing & (scale >= self.constants.FIRE_INIT_SCALE + step)
+        remove = extinguishing & ~shrink
+
+        ratio = np.ones(len(scale))
+        scale[grow] += step
+        ratio[grow] = scale[grow] / (scale[grow] - step)
+        scale[shrink] -= step
+        ratio[shrink] = scale[shrink] / (scale[shrink] + step)
+        fire_ids = fires.column("fire_id")
+        scaled = np.flatnonzero(grow | shrink)
+        self.commands.extend({"$type": "scale_visual_effect", "id": fire_id,
+                              "scale_factor": {"x": r, "y": r, "z": r}}
+                             for fire_id, r in zip(fire_ids[scaled].tolist(), ratio[scaled].tolist()))
+
+        self.spread_fires(np.flatnonzero(spread))
+
+        removed = np.flatnonzero(remove)
+        removed_keys = fires.id_array()[removed].tolist()
+        removed_ids = fire_ids[removed].tolist()
+        self.commands.extend({"$type": "destroy_visual_effect", "id": fire_id} for fire_id in removed_ids)
+        for idx, fire_id in zip(removed_keys, removed_ids):
+            self.manager.remove_object(fire_id)
+            self.unindex_fire(idx)
+            self.fire_info.pop(idx)
 
     def fire_step(self, resp):
         # for idx in self.manager.objects_start_burning:
@@ -168,54 +296,28 @@ class FireController(Controller):
             self.commands.append({"$type": "destroy_visual_effect",
                                     "id": self.fire_info[idx].fire_id})
             self.manager.remove_object(self.fire_info[idx].fire_id)
+            self.unindex_fire(idx)
             self.fire_info.pop(idx)
         # extend fire
-        for i in range(len(resp)-1):
-            r_id = OutputData.get_data_type_id(resp[i])
-            if r_id == "over":
-                o = Overlap(resp[i])
-                idx = o.get_id()
-                # if idx in self.fire_candidate:
-                #     print("check", idx, o.get_object_ids(), o.get_env())
-                if idx in self.fire_candidate and o.get_object_ids().size < 3 and o.get_env() == False:
-                    self.add_fire_floor(self.fire_candidate[idx][0])
+        for b in self.router.get(resp, "over"):
+            o = Overlap(b)
+            idx = o.get_id()
+            # if idx in self.fire_candidate:
+            #     print("check", idx, o.get_object_ids(), o.get_env())
+            if idx in self.fire_candidate and o.get_object_ids().size < 3 and o.get_env() == False:
+                self.add_fire_floor(self.fire_candidate[idx][0])
         self.fire_candidate.clear()
+        self.candidate_index.clear()
         if self.frame_count % self.update_fire_per_frame == 0:
-            removed = []
-            for idx in self.fire_info:
-                if self.fire_info[idx].scale < self.constants.FIRE_FINAL_SCALE and not self.fire_info[idx].extinguishing:
-                    # expand large enough before spreading
-                    self.fire_info[idx].scale += self.constants.FIRE_SCALE_STEP
-                    ratio = self.fire_info[idx].scale / (self.fire_info[idx].scale - self.constants.FIRE_SCALE_STEP)
-                    self.commands.append({"$type": "scale_visual_effect",
-                                            "id": self.fire_info[idx].fire_id,
-                                            "scale_factor": {"x": ratio, "y": ratio, "z": ratio}})
-                elif not self.fire_info[idx].extinguishing:
-                    # large enough, try spreading
-                    self.try_spread(idx)
-                elif self.fire_info[idx].scale >= self.constants.FIRE_INIT_SCALE + self.constants.FIRE_SCALE_STEP:
-                    # extinguishing, scale down
-                    self.fire_info[idx].scale -= self.constants.FIRE_SCALE_STEP
-                    ratio = self.fire_info[idx].scale / (self.fire_info[idx].scale + self.constants.FIRE_SCALE_STEP)
-                    self.commands.append({"$type": "scale_visual_effect",
-                                            "id": self.fire_info[idx].fire_id,
-                                            "scale_factor": {"x": ratio, "y": ratio, "z": ratio}})
-                else:
-                    # scaled down enough, remove
-                    self.commands.append({"$type": "destroy_visual_effect",
-                                            "id": self.fire_info[idx].fire_id})
-                    self.manager.remove_object(self.fire_info[idx].fire_id)
-                    removed.append(idx)
-            for idx in removed:
-                self.fire_info.pop(idx)
-
-        for i in self.fire_candidate:
-            pos, size = self.fire_candidate[i]
-            self.commands.append({"$type": "send_overlap_box",
-                                  "half_extents": {"x": size[0]*0.5, "y": size[1]*0.5, "z": size[2]*0.5},
-                                  "rotation": {"w": 1.0, "x": 0.0, "y": 0.0, "z": 0.0},
-                                  "position": {"x": pos[0], "y": pos[1]+size[1]*0.5+0.01, "z": pos[2]},
-                                  "id": i})
+            self.sync_fire_index()
+            self.evolve_fires()
+
+        self.commands.extend({"$type": "send_overlap_box",
+                              "half_extents": {"x": size[0]*0.5, "y": size[1]*0.5, "z": size[2]*0.5},
+                              "rotation": {"w": 1.0, "x": 0.0, "y": 0.0, "z": 0.0},
+                              "position": {"x": pos[0], "y": pos[1]+size[1]*0.5+0.01, "z": pos[2]},
+                              "id": i}
+                             for i, (pos, size) in self.fire_candidate.items())
         self.frame_count += 1
 
     # def run(self):
@@ -233,5 +335,6 @@ class FireController(Controller):
         #     print(com)
         resp = super().communicate(commands)
         if self.initialized:
-            self.fire_step(resp)
+            with self.router.timed("fire_step"):
+                self.fire_step(resp)
         return resp
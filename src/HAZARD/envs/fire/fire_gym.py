@@ -8,6 +8,8 @@ from enum import IntEnum
 import os
 from .fireagent_controller import *
 from .agent import *
+from src.HAZARD.utils.leak_check import LeakCheck
+from src.HAZARD.utils.scene_snapshot import SceneSnapshots
 
 
 PATH = os.path.dirname(os.path.abspath(__file__))
@@ -29,13 +31,29 @@ class FireEnv(gym.Env):
                  use_local_resources: bool=False, seed=0, use_gt=False,
                  image_capture_path=None, log_path: str=None, reverse_observation=False,
                  screen_size=512, map_size_h=64, map_size_v=64, grid_size=0.25,
-                 record_only: bool=False, use_dino: bool=False):
+                 record_only: bool=False, use_dino: bool=False, temperature_cutoff=None,
+                 temperature_resolution=16, temperature_field=False,
+                 bounds_refresh_interval=100, lod=False, lod_validate=False, reuse_controller=False,
+                 scene_snapshots=False, obs_cache=False, lazy_obs=False, leak_check=False):
         self.controller_args = dict(use_local_resources=use_local_resources, launch_build=launch_build,
                                     port=port, check_version=check_version, screen_size=screen_size,
                                     image_capture_path=image_capture_path, log_path=log_path, use_dino=use_dino,
                                     map_size_h=map_size_h, map_size_v=map_size_v, grid_size=grid_size,
-                                    use_gt=use_gt, reverse_observation=reverse_observation, record_only=record_only)
+                                    use_gt=use_gt, reverse_observation=reverse_observation, record_only=record_only,
+                                    temperature_cutoff=temperature_cutoff, temperature_resolution=temperature_resolution,
+                                    temperature_field=temperature_field, bounds_refresh_interval=bounds_refresh_interval,
+                                    lod=lod, lod_validate=lod_validate)
         self.controller = None
+        # keep one controller and build for all episodes, reset_scene cleans up between them
+        self.reuse_controller = reuse_controller
+        # check for objects the last episode left in the build, on each reset
+        self.leak_check = LeakCheck() if leak_check else None
+        # one snapshot per scene, kept across controllers
+        self.snapshots = SceneSnapshots(enabled=scene_snapshots)
+        self.controller_args["snapshots"] = self.snapshots
+        self.controller_args["obs_cache"] = obs_cache
+        self.controller_args["lazy_obs"] = lazy_obs
+        self.controller_args["leak_check"] = self.leak_check
         self.RNG = np.random.RandomState(0)
 
         self.done = False
@@ -53,12 +71,14 @@ class FireEnv(gym.Env):
             data_dir = os.path.join(PATH, "data", "room_setup_fire", data_dirs[self.RNG.randint(len(data_dirs))])
             # data_dir = os.path.join(PATH, "data", "room_setup", "1a-0-0")
         self.setup = SceneSetup(data_dir=data_dir, record_mode=self.record_only)
-        if self.controller is not None:
+        if self.controller is not None and not self.reuse_controller:
             self.controller.communicate({"$type": "terminate"})
             self.controller.socket.close()
-        self.controller = FireAgentController(**self.controller_args)
+            self.controller = None
+        if self.controller is None:
+            self.controller = FireAgentController(**self.controller_args)
+            print("Controller connected")
         self.controller.seed(self.RNG.randint(1000000))
-        print("Controller connected")
         self.controller.init_scene(self.setup)
         self.num_step = 0
         self.last_action = None
@@ -69,7 +89,7 @@ class FireEnv(gym.Env):
         self.controller.do_action(0, "turn_by", {"angle": 0})
         self.controller.next_key_frame()
 
-        return self.controller._obs()["RL"]
+        return self.controller._obs(fields=["RL"])["RL"]
     
     # def step(self, action):
     #     # if self.done:
@@ -157,7 +177,7 @@ class FireEnv(gym.Env):
                 if self.last_action == ActionSpace.WALK_TO_RANDOM_OBJECT_IN_SIGHT:
                     target = self.last_target
                 else:
-                    obs = self.controller._obs()
+                    obs = self.controller._obs(fields=["sem_map"])
                     obj_ids = np.unique(obs["sem_map"]["id"])
                     targets = [self.controller.manager.get_real_id(idx) for idx in obj_ids if self.controller.manager.get_real_id(idx) not in self.controller.finished]
                     targets = [idx for idx in targets if idx is not None]
@@ -1,4 +1,4 @@
-from typing import Any, Tuple, Dict
+from typing import Any, Tuple, Dict, List, Optional
 from tdw.add_ons.third_person_camera import ThirdPersonCamera
 from tdw.librarian import HumanoidLibrarian
 from tdw.add_ons.logger import Logger
@@ -9,6 +9,7 @@ from tdw.output_data import OutputData, Images
 from tdw.scene_data.scene_bounds import SceneBounds
 from tdw.obi_data.fluids.cube_emitter import CubeEmitter
 from tdw.add_ons.obi import Obi
+from src.HAZARD.utils.obi_solver import init_obi, destroy_obi
 
 import numpy as np
 import cv2
@@ -22,6 +23,8 @@ from src.HAZARD.utils.model import Semantic_Mapping
 from src.HAZARD.utils.vision import Detector
 from src.HAZARD.utils.local_asset import get_local_url
 from src.HAZARD.utils.scene_setup import SceneSetup
+from src.HAZARD.utils.scene_snapshot import SceneSnapshots
+from src.HAZARD.utils.observation import LazyObservation, ObservationCache
 
 PATH = os.path.dirname(os.path.abspath(__file__))
 while os.path.basename(PATH) != "HAZARD":
@@ -48,12 +51,23 @@ class FireAgentController(FireController):
         self.reverse_observation = reverse_observation
         super().__init__(**kwargs)
         self.screen_size = kwargs.get("screen_size", 512)
+        self.temperature_resolution = kwargs.get("temperature_resolution", 16)
         self.agents: List[FireAgent] = []
         self.extinguishers = []
+        self.obi: Optional[Obi] = None
+        self.obi_solver_id = 0
         self.comm_counter = 0
         self.use_gt = kwargs.get("use_gt", True)
         self.use_dino = use_dino
         self.record_only = record_only
+        # shared by the gym with the controllers of later episodes, replays every batch when disabled
+        self.snapshots = kwargs.get("snapshots", None)
+        if self.snapshots is None:
+            self.snapshots = SceneSnapshots(enabled=False)
+        # LeakCheck of the gym, None for no check
+        self.leak_check = kwargs.get("leak_check", None)
+        self.obs_cache = ObservationCache(enabled=kwargs.get("obs_cache", False))
+        self.lazy_obs = kwargs.get("lazy_obs", False)
         if not self.use_gt:
             if self.use_dino:
                 from src.HAZARD.utils.vision_dino import DetectorSAM
@@ -70,6 +84,10 @@ class FireAgentController(FireController):
         self.grid_size = kwargs.get("grid_size", 0.25)
         self.sem_map = Semantic_Mapping(device=None, screen_size=self.screen_size,
                                         map_size_h=self.map_size_h, map_size_v=self.map_size_v, grid_size=self.grid_size)
+        if kwargs.get("temperature_field", False):
+            self.manager.enable_temperature_field(map_offset=self.sem_map.map_offset, grid_size=self.grid_size,
+                                                  map_size_h=self.map_size_h, map_size_v=self.map_size_v,
+                                                  heights=Semantic_Mapping.heights)
 
         self.maps = []
         self.id2name = {}
@@ -78,12 +96,16 @@ class FireAgentController(FireController):
         # self.init_seg()
 
     def init_obi(self):
-        self.obi = Obi()
-        self.communicate([{"$type": "create_obi_solver"}])
-        self.obi.set_solver(solver_id=0, scale_factor=1.0, substeps=1)
-        self.add_ons.append(self.obi)
-        self.communicate([])
-        self.communicate([])
+        self.obi = init_obi(self, solver_id=self.obi_solver_id)
+
+    def destroy_obi(self):
+        """
+        Undo init_obi, so that a reused build starts the next scene without its solvers.
+        """
+        if self.obi is None:
+            return
+        destroy_obi(self, self.obi, solver_id=self.obi_solver_id)
+        self.obi = None
 
     def update_replicant_url(self):
         if not os.path.isfile(f"{os.getcwd()}/data/assets/replicant_0"): # There is no local model of replicant
@@ -116,9 +138,11 @@ class FireAgentController(FireController):
         for idx in self.fire_info:
             commands.append({"$type": "destroy_visual_effect", "id": self.fire_info[idx].fire_id})
         self.communicate(commands)
+        self.destroy_obi()
         
-        self.fire_info = dict()
+        self.fire_info.clear()
         self.fire_candidate = dict()
+        self.clear_fire_index()
         self.initialized = False
         self.maps = []
         self.add_ons = []
@@ -126,6 +150,7 @@ class FireAgentController(FireController):
         self.extinguishers = []
         self.id2name = {}
         self.frame_count = 0
+        self.obs_cache.reset()
         self.communicate([])
         
         self.last_reward = None
@@ -151,6 +176,7 @@ class FireAgentController(FireController):
         self.extinguishers = []
         self.containers = setup.containers
         self.other_containers = {}
+        batches = []
         for commands in setup.commands_list:
             filtered_commands = []
             tp = None
@@ -176,9 +202,10 @@ class FireAgentController(FireController):
                 if tp.startswith("add_") and tp.endswith("_container"):
                     self.other_containers[command['id']] = command['container_id']
                 filtered_commands.append(command)
-            self.communicate(filtered_commands)
+            batches.append(filtered_commands)
             if tp == "terminate":
                 break
+        self.snapshots.load(self, setup, batches)
         for fire_pos in setup.other["fire"]:
             self.add_fire_floor(fire_pos)
 
@@ -210,7 +237,10 @@ class FireAgentController(FireController):
         self.target_id2category = setup.target_id2category
         self.target_id2name = setup.target_id2name
         self.finished = []
-        self.communicate([])
+        # the ids of the new scene, on a frame before the episode starts
+        resp = self.communicate(self.leak_check.commands() if self.leak_check is not None else [])
+        if self.leak_check is not None:
+            self.leak_check.check(self, resp)
         if self.image_capture_path != None:
             if not self.record_only:
                 camera = ThirdPersonCamera(avatar_id="record",
@@ -234,7 +264,7 @@ class FireAgentController(FireController):
             commands.extend([{"$type": "set_floorplan_roof", "show": False}])
 
         # Capture when running after init_scene. (Because screen size may be modified)
-        resp = self.communicate([{"$type": "send_scene_regions"}])
+        resp = self.snapshots.scene_regions(self, setup)
         self.set_scene_bounds(resp)
 
         self.manager.prepare_segmentation_data()
@@ -342,7 +372,8 @@ class FireAgentController(FireController):
                               lifespan=0.5)
     
     def do_extinguish(self, target: np.ndarray):
-        for idx, fire in self.fire_info.items():
+        for idx in self.fire_effect_index.query_radius(target, self.constants.EXTINGUISH_RADIUS):
+            fire = self.fire_info[idx]
             if fire.extinguishing:
                 continue
             fire_id = fire.fire_id
@@ -370,13 +401,11 @@ class FireAgentController(FireController):
         #                 print(point_cloud[t, j, k].item(), end=' ', file=fout)
         #             print('', file=fout)
         # shape: (3, 512, 512)
-        # down sample to 16x16
-        point_cloud = point_cloud[:, ::(width//16), ::(width//16)]
-        temp = np.zeros((16, 16))
-        for i in range(16):
-            for j in range(16):
-                temperature = self.manager.query_point_temperature(point_cloud[:, i, j])
-                temp[i, j] = temperature
+        # down sample to temperature_resolution x temperature_resolution (16x16 by default)
+        step = max(1, width // self.temperature_resolution)
+        point_cloud = point_cloud[:, ::step, ::step]
+        points = point_cloud.reshape(3, -1).T
+        temp = self.manager.query_points_temperature(points).reshape(point_cloud.shape[1:])
         temp = cv2.resize(temp, (width, height), interpolation=cv2.INTER_NEAREST)
         return temp
     
@@ -455,18 +484,16 @@ class FireAgentController(FireController):
                     # this object is dropped and moved to a distant place
                     self.finished.append(target)
         if self.image_capture_path != None:
-            for i in range(len(resp) - 1):
-                r_id = OutputData.get_data_type_id(resp[i])
-                # Get Images output data.
-                if r_id == "imag":
-                    images = Images(resp[i])
-                    # Determine which avatar captured the image.
-                    if images.get_avatar_id() == "record":
-                        # Save the image.
-                        # if self.comm_counter % 10 == 0:
-                        TDWUtils.save_images(images=images, filename=str(self.comm_counter),
-                                             output_directory=self.image_capture_path)
-                        self.comm_counter += 1
+            # Get Images output data.
+            for b in self.router.get(resp, "imag"):
+                images = Images(b)
+                # Determine which avatar captured the image.
+                if images.get_avatar_id() == "record":
+                    # Save the image.
+                    # if self.comm_counter % 10 == 0:
+                    TDWUtils.save_images(images=images, filename=str(self.comm_counter),
+                                         output_directory=self.image_capture_path)
+                    self.comm_counter += 1
         # The ImageCapture addon already saves the image. No need to save again. 
         return resp
 
@@ -476,101 +503,129 @@ class FireAgentController(FireController):
     
     
     @torch.no_grad()
-    def _obs(self, agent_idx: int = 0):
-        # print("get obs")
-
-        self.manager.prepare_segmentation_data()
-        self.communicate([])
-
-        obs = dict()
+    def _obs(self, agent_idx: int = 0, fields: Optional[List[str]] = None):
         """
-        raw observation: RGBD, temperature
-        """
-        rgb = self.agents[agent_idx].dynamic.get_pil_image()
-        id_image = np.array(self.agents[agent_idx].dynamic.get_pil_image("id"))
-        if self.reverse_observation:
-            rgb = np.flip(rgb, axis=0)
-            id_image = np.flip(id_image, axis=0)
-
-        if self.use_gt:
-            seg_mask = self.manager.segm.get_seg_mask(id_image)
-        else:
-            rcnn_mask = self.detector.inference(np.array(rgb))
-            seg_mask = self.manager.segm.get_seg_mask(np.array(id_image),
-                                                        rcnn=rcnn_mask,
-                                                        id_list=self.manager.id_list)
-        depth = TDWUtils.get_depth_values(self.agents[agent_idx].dynamic.images["depth"], width=self.screen_size, height=self.screen_size)
-        depth = np.flip(depth, axis=0)
-        
-        rgb = np.array(rgb).astype(np.float32).transpose((2, 0, 1)).astype(np.float32) * 1.0 / 255
-        depth = depth.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
-        
-        log_temp = self.get_temperature_observation(agent_idx, width=self.screen_size, height=self.screen_size)
-        log_temp = np.log(log_temp.reshape((1, self.screen_size, self.screen_size)).astype(np.float32))
-        obs["raw"] = dict(
-            rgb=rgb,
-            depth=depth,
-            log_temp=log_temp,
-            seg_mask=seg_mask
-        )
-        
+        fields: the fields that will be read, "raw.<name>" for one raw field. With lazy_obs only these are computed
+        now, the others on first access before the next frame. None for all of them.
         """
-        mapped observation
-        """
-        camera_matrix = self.agents[agent_idx].dynamic.camera_matrix.reshape((4, 4))
-        obs_concat = np.concatenate([rgb, depth, log_temp], axis=0)
-        
-        sem = self.sem_map.forward(obs=obs_concat, id_map=seg_mask, camera_matrix=camera_matrix, maps_last=self.maps[agent_idx],
-                                   position=self.agents[agent_idx].dynamic.transform.position, record_mode=self.record_only,
-                                   targets=[self.manager.id_renumbering[target] for target in self.target_ids])
-        obs["sem_map"] = dict(height=sem["height"].cpu().numpy(),
-                              explored=sem["explored"].cpu().numpy(),
-                              id=sem["id"].cpu().numpy(),
-                              other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
-        self.maps[agent_idx] = dict(height=sem["height"].cpu().numpy(),
-                              explored=sem["explored"].cpu().numpy(),
-                              id=sem["id"].cpu().numpy(),
-                              other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+        # print("get obs")
+        obs = self.obs_cache.get(agent_idx, self.frame_count)
+        if obs is None:
+            self.manager.prepare_segmentation_data()
+            self.communicate([])
+            obs = LazyObservation(self.frame_count, lambda: self.frame_count)
+            self.add_obs_fields(obs, agent_idx)
+            self.obs_cache.put(agent_idx, obs)
+        obs.compute(fields if self.lazy_obs else None)
+        return obs
 
-        """
-        map of goal and agent
-        """
-        agent_pos = self.sem_map.real_to_grid(self.agents[agent_idx].dynamic.transform.position)
-        target_poss = [self.sem_map.real_to_grid(self.manager.objects[idx].position) for idx in self.target_ids]
-        
-        goal_map = np.zeros((self.map_size_h, self.map_size_v))
-        for (i, target_pos) in enumerate(target_poss):
-            if self.target_ids[i] in self.finished:
-                continue
-            if target_pos[0] < 0 or target_pos[0] >= self.map_size_h or target_pos[1] < 0 or target_pos[1] >= self.map_size_v:
-                continue
-            if not (sem["id"] == self.manager.get_renumbered_id(self.target_ids[i])).any():
-                continue
-            goal_map[target_pos[0], target_pos[1]] = 1
-        if agent_pos[0] > 0 and agent_pos[0] < self.map_size_h - 1 and agent_pos[1] > 0 and agent_pos[1] < self.map_size_v - 1:
-            goal_map[agent_pos[0], agent_pos[1]] = -2
-            rad = self.agents[agent_idx].get_facing()
-            rad = int(rad / (np.math.pi / 4))
-            if rad < 0:
-                rad += 8
-            dx = list([1, 1, 0, -1, -1, -1, 0, 1])[rad]
-            dz = list([0, 1, 1, 1, 0, -1, -1, -1])[rad]
-            goal_map[agent_pos[0] + dx][agent_pos[1] + dz] = -1
-        obs["goal_map"] = goal_map
+    def add_obs_fields(self, obs: LazyObservation, agent_idx: int):
+        images = dict()
+
+        def image(pass_mask: str):
+            if pass_mask not in images:
+                images[pass_mask] = np.array(self.agents[agent_idx].dynamic.get_pil_image(pass_mask))
+                if self.reverse_observation:
+                    images[pass_mask] = np.flip(images[pass_mask], axis=0)
+            return images[pass_mask]
+
+        def rgb():
+            return image("img").astype(np.float32).transpose((2, 0, 1)).astype(np.float32) * 1.0 / 255
+
+        def depth():
+            depth = TDWUtils.get_depth_values(self.agents[agent_idx].dynamic.images["depth"], width=self.screen_size, height=self.screen_size)
+            depth = np.flip(depth, axis=0)
+            return depth.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
+
+        def log_temp():
+            log_temp = self.get_temperature_observation(agent_idx, width=self.screen_size, height=self.screen_size)
+            return np.log(log_temp.reshape((1, self.screen_size, self.screen_size)).astype(np.float32))
+
+        def seg_mask():
+            if self.use_gt:
+                return self.manager.segm.get_seg_mask(image("id"))
+            rcnn_mask = self.detector.inference(np.array(image("img")))
+            return self.manager.segm.get_seg_mask(np.array(image("id")), rcnn=rcnn_mask, id_list=self.manager.id_list)
+
+        def raw():
+            """
+            raw observation: RGBD, temperature
+            """
+            raw = LazyObservation(obs.frame, obs.clock)
+            raw.add("rgb", rgb)
+            raw.add("depth", depth)
+            raw.add("log_temp", log_temp)
+            raw.add("seg_mask", seg_mask)
+            return raw
+
+        @torch.no_grad()
+        def sem_map():
+            """
+            mapped observation
+            """
+            raw = obs["raw"]
+            # the semantic map reads depth and the channels after it, the rgb channels are left empty
+            obs_concat = np.concatenate([np.zeros((3, self.screen_size, self.screen_size), dtype=np.float32),
+                                         raw["depth"], raw["log_temp"]], axis=0)
+
+            sem = self.sem_map.forward(obs=obs_concat, id_map=raw["seg_mask"], camera_matrix=camera_matrix, maps_last=self.maps[agent_idx],
+                                       position=self.agents[agent_idx].dynamic.transform.position, record_mode=self.record_only,
+                                       targets=[self.manager.id_renumbering[target] for target in self.target_ids])
+            self.maps[agent_idx] = dict(height=sem["height"].cpu().numpy(),
+                                  explored=sem["explored"].cpu().numpy(),
+                                  id=sem["id"].cpu().numpy(),
+                                  other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+            return dict(height=sem["height"].cpu().numpy(),
+                        explored=sem["explored"].cpu().numpy(),
+                        id=sem["id"].cpu().numpy(),
+                        other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+
+        def goal_map():
+            """
+            map of goal and agent
+            """
+            sem_id = obs["sem_map"]["id"]
+            agent_pos = self.sem_map.real_to_grid(self.agents[agent_idx].dynamic.transform.position)
+            target_poss = [self.sem_map.real_to_grid(self.manager.objects[idx].position) for idx in self.target_ids]
+
+            goal_map = np.zeros((self.map_size_h, self.map_size_v))
+            for (i, target_pos) in enumerate(target_poss):
+                if self.target_ids[i] in self.finished:
+                    continue
+                if target_pos[0] < 0 or target_pos[0] >= self.map_size_h or target_pos[1] < 0 or target_pos[1] >= self.map_size_v:
+                    continue
+                if not (sem_id == self.manager.get_renumbered_id(self.target_ids[i])).any():
+                    continue
+                goal_map[target_pos[0], target_pos[1]] = 1
+            if agent_pos[0] > 0 and agent_pos[0] < self.map_size_h - 1 and agent_pos[1] > 0 and agent_pos[1] < self.map_size_v - 1:
+                goal_map[agent_pos[0], agent_pos[1]] = -2
+                rad = self.agents[agent_idx].get_facing()
+                rad = int(rad / (np.math.pi / 4))
+                if rad < 0:
+                    rad += 8
+                dx = list([1, 1, 0, -1, -1, -1, 0, 1])[rad]
+                dz = list([0, 1, 1, 1, 0, -1, -1, -1])[rad]
+                goal_map[agent_pos[0] + dx][agent_pos[1] + dz] = -1
+            return goal_map
+
+        def rl():
+            RL_obs = np.zeros((5, self.map_size_h, self.map_size_v))
+            RL_obs[0] = obs["sem_map"]["height"]
+            RL_obs[1] = obs["sem_map"]["explored"]
+            RL_obs[2] = obs["sem_map"]["id"]
+            RL_obs[3] = obs["goal_map"]
+            RL_obs[4] = obs["sem_map"]["other"][0]
+            return RL_obs
 
         """
         agent info
         """
+        camera_matrix = self.agents[agent_idx].dynamic.camera_matrix.reshape((4, 4))
+        obs.add("raw", raw)
+        obs.add("sem_map", sem_map)
+        obs.add("goal_map", goal_map)
         obs["camera_matrix"] = camera_matrix
-        # return RL_obs
-        RL_obs = np.zeros((5, self.map_size_h, self.map_size_v))
-        RL_obs[0] = obs["sem_map"]["height"]
-        RL_obs[1] = obs["sem_map"]["explored"]
-        RL_obs[2] = obs["sem_map"]["id"]
-        RL_obs[3] = goal_map
-        RL_obs[4] = obs["sem_map"]["other"][0]
-        obs["RL"] = RL_obs
-        return obs
+        obs.add("RL", rl)
     
     def _info(self):
         info = dict()
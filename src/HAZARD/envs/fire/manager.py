@@ -6,26 +6,50 @@ import numpy as np
 from .object import *
 from .fire_utils import *
 from src.HAZARD.utils.seg_id import SegmentationID
+from src.HAZARD.utils.output_decoder import decode_transforms, decode_bounds, decode_rigidbodies, decode_replicants
+from src.HAZARD.utils.bounds_cache import BoundsCache
+from src.HAZARD.utils.response_router import ResponseRouter
+from src.HAZARD.utils.lod import LODScheduler, UpdateTier, nearest_distance
+from src.HAZARD.utils.spatial_query import SpatialQuery
 
 """
 Add-on to control the evolvement of objects, including temperature and state.
 Future development may include changing object appearances.
 """
 class FireObjectManager(AddOn):
-    def __init__(self, constants=default_const):
+    def __init__(self, constants=default_const, temperature_cutoff: Optional[float] = None,
+                 bounds_refresh_interval: int = 100,
+                 router: Optional[ResponseRouter] = None, lod: bool = False, lod_validate: bool = False):
         super().__init__()
         self.constants = constants
-        self.objects: Dict[int, ObjectStatus] = dict()
-        self.temperature_manager = TemperatureManager()
+        self.objects: Dict[int, ObjectStatus] = ObjectTable(ObjectStatus)
+        # nearest object queries on a lazily rebuilt grid
+        self.spatial = SpatialQuery(self.objects)
+        self.temperature_manager = TemperatureManager(cutoff=temperature_cutoff)
+        # only needed by the cutoff kernel, kept up to date from the transforms
+        self.spatial_hash = self.temperature_manager.make_spatial_hash() if temperature_cutoff is not None else None
+        # optional cached temperature grid, see enable_temperature_field
+        self.temperature_field: Optional[TemperatureField] = None
         self.objects_start_burning: Set[int] = set()
         self.objects_stop_burning: Set[int] = set()
         self.segm = SegmentationID()
         self.id_renumbering = dict()
         self.id_list = [0]
         self.timer = 0
+        self.bounds_cache = BoundsCache(refresh_interval=bounds_refresh_interval)
+        # shared with the controller, which classifies the output data once per frame
+        self.router = router if router is not None else ResponseRouter()
+        # level of detail of the temperature tick: objects far from every heat source are updated less often
+        self.lod = LODScheduler(active_distance=2.0, near_distance=4.0, enabled=lod, validate=lod_validate)
+        self.lod_reference: Dict[int, float] = dict() # full-rate temperatures, only kept with lod_validate
+        self.lod_last: Dict[int, float] = dict() # temperatures at the end of the last tick, to notice outside changes
 
     def reset(self):
-        self.objects = dict()
+        self.objects = ObjectTable(ObjectStatus)
+        self.spatial.reset(self.objects)
+        if self.spatial_hash is not None:
+            self.spatial_hash.clear()
+        self.invalidate_temperature_field()
         self.objects_start_burning = set()
         self.objects_stop_burning = set()
         self.commands = []
@@ -33,86 +57,150 @@ class FireObjectManager(AddOn):
         self.id_renumbering = dict()
         self.id_list = [0]
         self.timer = 0
+        self.bounds_cache.reset()
+        self.lod.reset()
+        self.lod_reference = dict()
+        self.lod_last = dict()
 
     def get_initialization_commands(self) -> List[dict]:
         return [{"$type": "send_bounds"},
                 {"$type": "send_transforms"}]
     
     def on_send(self, resp: List[bytes]) -> None:
-        for i in range(len(resp)-1):
-            r_id = OutputData.get_data_type_id(resp[i])
+        with self.router.timed(type(self).__name__):
+            self.process_output(resp)
+
+    def process_output(self, resp: List[bytes]) -> None:
+        transforms = None
+        bounds_ids = None
+        for r_id, b in self.router.select(resp, ("tran", "boun", "repl")):
             if r_id == "tran":
-                tran = Transforms(resp[i])
-                for j in range(tran.get_num()):
-                    idx = tran.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].position = tran.get_position(j)
-                        self.objects[idx].rotation = tran.get_rotation(j)
-                    else:
-                        print("object {} not recorded, may be caused by composite objects which you can ignore".format(idx))
-                        self.add_object(ObjectStatus(idx, position=tran.get_position(j)))
+                ids, positions, rotations = decode_transforms(b)
+                transforms = (ids, rotations)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("position", rows[found], positions[found])
+                self.objects.write("rotation", rows[found], rotations[found])
+                if self.spatial_hash is not None:
+                    self.spatial_hash.update_many(ids[found].tolist(), positions[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("object {} not recorded, may be caused by composite objects which you can ignore".format(idx))
+                    self.add_object(ObjectStatus(idx, position=positions[j]))
             elif r_id == "boun":
-                boun = Bounds(resp[i])
-                for j in range(boun.get_num()):
-                    idx = boun.get_id(j)
-                    if idx in self.objects:
-                        concat = np.zeros([6, 3])
-                        concat[0] = boun.get_front(j)
-                        concat[1] = boun.get_back(j)
-                        concat[2] = boun.get_left(j)
-                        concat[3] = boun.get_right(j)
-                        concat[4] = boun.get_top(j)
-                        concat[5] = boun.get_bottom(j)
-                        self.objects[idx].size = np.max(concat, axis=0) - np.min(concat, axis=0)
-                    else:
-                        print("object {} not recorded, may be caused by composite objects which you can ignore".format(idx))
-                        self.add_object(ObjectStatus(idx, size=boun.get_front(j) + boun.get_right(j) + boun.get_top(j) - boun.get_back(j) - boun.get_left(j) - boun.get_bottom(j)))
-                        concat = np.zeros([6, 3])
-                        concat[0] = boun.get_front(j)
-                        concat[1] = boun.get_back(j)
-                        concat[2] = boun.get_left(j)
-                        concat[3] = boun.get_right(j)
-                        concat[4] = boun.get_top(j)
-                        concat[5] = boun.get_bottom(j)
-                        self.objects[idx].size = np.max(concat, axis=0) - np.min(concat, axis=0)
+                ids, sizes = decode_bounds(b)
+                bounds_ids = ids
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("size", rows[found], sizes[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("object {} not recorded, may be caused by composite objects which you can ignore".format(idx))
+                    self.add_object(ObjectStatus(idx, size=sizes[j]))
             elif r_id == "repl":
-                repl = Replicants(resp[i])
-                for j in range(repl.get_num()):
-                    idx = repl.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].position = repl.get_position(j)
-                    else:
-                        print("agent {} not recorded, this shouldn't happen".format(idx))
-                        self.add_object(AgentStatus(idx, position=repl.get_position(j), size=None))
-        for i in range(len(resp)-1):
-            r_id = OutputData.get_data_type_id(resp[i])
+                ids, positions = decode_replicants(b)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("position", rows[found], positions[found])
+                if self.spatial_hash is not None:
+                    self.spatial_hash.update_many(ids[found].tolist(), positions[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("agent {} not recorded, this shouldn't happen".format(idx))
+                    self.add_object(AgentStatus(idx, position=positions[j], size=None))
+        self.bounds_cache.on_send(self.objects, transforms=transforms, bounds_ids=bounds_ids)
+        for r_id, b in self.router.select(resp, ("segm", "rseg")):
             if r_id == "segm":
-                segm = SegmentationColors(resp[i])
+                segm = SegmentationColors(b)
                 self.segm.process(segm, self.id_renumbering)
             elif r_id == "rseg":
-                segm = ReplicantSegmentationColors(resp[i])
+                segm = ReplicantSegmentationColors(b)
                 self.segm.process(segm, self.id_renumbering)
         
         self.timer += 1
         if self.timer % 5 == 0:
-            temp_dict = self.temperature_manager.evolve(self.objects)
-            for idx in temp_dict:
-                self.objects[idx].temperature = temp_dict[idx]
+            due = None
+            if self.lod.enabled:
+                tiers = self.temperature_tiers()
+                due, steps = self.lod.schedule(self.objects.id_array().tolist(), tiers)
+                reference = self.reference_temperatures() if self.lod.validate else None
+                self.temperature_manager.evolve_table(self.objects, spatial_hash=self.spatial_hash, update=due, steps=steps)
+                if reference is not None:
+                    self.validate_temperatures(reference, tiers, due)
+            else:
+                self.temperature_manager.evolve_table(self.objects, spatial_hash=self.spatial_hash)
+            self.invalidate_temperature_field()
             
             self.objects_start_burning = set()
             self.objects_stop_burning = set()
             for idx in self.objects:
                 if np.abs(self.objects[idx].position).sum() > 50:
                     continue
+                if due is not None and not due[self.objects.row_of(idx)]:
+                    # the temperature did not change, so neither can the state
+                    continue
                 status = self.objects[idx].step()
                 if status == ObjectState.START_BURNING:
                     self.objects_start_burning.add(idx)
+                    self.bounds_cache.mark_dirty([idx])
                 elif status == ObjectState.STOP_BURNING:
                     self.objects_stop_burning.add(idx)
-        self.commands = [{"$type": "send_bounds"}, {"$type": "send_transforms"}]
+            if self.lod.validate:
+                self.lod_last = dict(zip(self.objects.id_array().tolist(), self.objects.column("temperature").tolist()))
+        self.commands = self.bounds_cache.commands() + [{"$type": "send_transforms"}]
     
+    def temperature_tiers(self) -> np.ndarray:
+        """
+        Update tiers in row order: by distance to the nearest heat source, burning objects and agents are always active.
+        """
+        positions = self.objects.column("position").astype(np.float64)
+        is_heat_source = self.objects.column("is_heat_source")
+        distances = nearest_distance(positions, positions[is_heat_source])
+        active = is_heat_source | (self.objects.column("state") == ObjectState.BURNING.value)
+        active |= ~self.objects.valid_mask("position")
+        active |= np.array([obj.name == "Agent" for obj in self.objects.views], dtype=bool)
+        return self.lod.classify(positions, distances, active)
+
+    def reference_temperatures(self) -> np.ndarray:
+        """
+        lod_validate: one full-rate tick of the reference temperatures, in row order.
+        Heat sources and temperatures changed since the last tick (new objects, extinguishing) are copied from the table.
+        """
+        ids, positions, temperatures, is_heat_source = self.temperature_manager.gather(self.objects)
+        for i, idx in enumerate(ids):
+            if not is_heat_source[i] and idx in self.lod_reference and self.lod_last.get(idx) == temperatures[i]:
+                temperatures[i] = self.lod_reference[idx]
+        reference = self.temperature_manager.evolve_columns(ids, positions, temperatures, is_heat_source,
+                                                            spatial_hash=self.spatial_hash)
+        self.lod_reference = dict(zip(ids, reference.tolist()))
+        return reference
+
+    def validate_temperatures(self, reference: np.ndarray, tiers: np.ndarray, due: np.ndarray):
+        """
+        Temperature error of the objects updated on this tick (the others lag behind by design),
+        and objects of any tier that ignite in only one of the two simulations.
+        """
+        temperatures = self.objects.column("temperature")
+        compared = ~self.objects.column("is_heat_source") & (tiers != UpdateTier.RETIRED)
+        thresholds = np.array([obj.temperature_threshold if obj.inflammable and obj.state == ObjectState.NORMAL else np.inf
+                               for obj in self.objects.views])
+        ignites = (temperatures > thresholds) != (reference > thresholds)
+        self.lod.record("temperature", np.abs(temperatures - reference)[compared & due], int(ignites[compared].sum()))
+
+    def lod_report(self):
+        """
+        Objects per update tier on the last tick and, with lod_validate, the difference to the full-rate simulation.
+        """
+        return dict(tiers=self.lod.stats(), validation=self.lod.validation_report())
+
+    def mark_bounds_dirty(self, ids: List[int]):
+        """
+        Request the bounds of these objects on the next frame, e.g. after grasping or teleporting them.
+        """
+        self.bounds_cache.mark_dirty(ids)
+
     def add_object(self, obj: ObjectStatus):
         self.objects[obj.idx] = obj
+        if self.spatial_hash is not None and obj.position is not None:
+            self.spatial_hash.update(obj.idx, obj.position)
+        self.invalidate_temperature_field()
         if obj.idx not in self.id_renumbering:
             self.id_list.append(obj.idx)
             self.id_renumbering[obj.idx] = len(self.id_list) - 1
@@ -120,22 +208,43 @@ class FireObjectManager(AddOn):
     def remove_object(self, idx: int):
         if idx in self.objects:
             del self.objects[idx]
+        if self.spatial_hash is not None:
+            self.spatial_hash.remove(idx)
+        self.lod.forget(idx)
+        self.invalidate_temperature_field()
     
     def query_point_temperature(self, point: np.ndarray) -> float:
-        return self.temperature_manager.query_point_temperature(point, self.objects)
+        return self.temperature_manager.query_point_temperature(point, self.objects, spatial_hash=self.spatial_hash)
+
+    def query_points_temperature(self, points: np.ndarray) -> np.ndarray:
+        if self.temperature_field is not None:
+            return self.temperature_field.query(points, self.temperature_manager, self.objects, spatial_hash=self.spatial_hash)
+        return self.temperature_manager.query_points_temperature(points, self.objects, spatial_hash=self.spatial_hash)
+
+    def enable_temperature_field(self, map_offset: List[int], grid_size: float, map_size_h: int, map_size_v: int,
+                                 heights: List[float]):
+        """
+        Serve query_points_temperature from a grid cached between evolve ticks instead of computing every query.
+        """
+        self.temperature_field = TemperatureField(map_offset=map_offset, grid_size=grid_size,
+                                                  map_size_h=map_size_h, map_size_v=map_size_v, heights=heights)
+
+    def invalidate_temperature_field(self):
+        """
+        Call after changing temperatures outside of the evolve tick (e.g. extinguishing).
+        """
+        if self.temperature_field is not None:
+            self.temperature_field.invalidate()
+
+    def temperature_cutoff_error(self):
+        """
+        How much the cutoff kernel deviates from the full computation on the current scene.
+        Use it to choose a cutoff radius that does not change the temperatures noticeably.
+        """
+        return self.temperature_manager.cutoff_error(self.objects, spatial_hash=self.spatial_hash)
     
     def find_nearest_object(self, pos: np.ndarray, objects: Optional[List[int]] = None):
-        min_dist = 1e10
-        min_idx = None
-        it = iter(self.objects) if objects is None else iter(objects)
-        for idx in it:
-            if self.objects[idx].name != "Object":
-                continue
-            dist = np.linalg.norm(self.objects[idx].position - pos)
-            if dist < min_dist:
-                min_dist = dist
-                min_idx = idx
-        return min_idx
+        return self.spatial.nearest(pos, ids=objects)
     
     def prepare_segmentation_data(self):
         self.commands.extend([{"$type": "send_segmentation_colors"},
@@ -1,13 +1,33 @@
-from typing import Dict, Set
+from typing import Dict, Set, List, Optional
 from .fire_utils import *
+import math
 import numpy as np
+from src.HAZARD.utils.spatial_hash import SpatialHash
+from src.HAZARD.utils.object_table import Column, TableRow, ObjectTable
+
+# offsets of the box anchors relative to (position, size), see ObjectStatus.top() etc.
+CENTER = np.array([0, 0.5, 0])
+TOP = np.array([1, 1, 1])
+LEFT = np.array([-0.5, 0.5, 0])
+RIGHT = np.array([0.5, 0.5, 0])
+FRONT = np.array([0, 0.5, 0.5])
+BACK = np.array([0, 0.5, -0.5])
+
+class ObjectStatus(TableRow):
+    __slots__ = ("idx", "inflammable", "burning_time", "burning_time_left", "temperature_threshold", "constants", "name")
+    state = Column(np.int8, enum=ObjectState)
+    temperature = Column(np.float64)
+    is_heat_source = Column(bool)
+    position = Column(np.float32, (3,))
+    rotation = Column(np.float32, (4,))
+    size = Column(np.float32, (3,))
 
-class ObjectStatus:
     def __init__(self, idx, constants: Constants=default_const,
                  inflammable: bool = True, state: int = None,
                  burning_time: int = 300, burning_time_left: int = 0,
                  temperature: float = 20.0, temperature_threshold: float = 200.0,
                  is_heat_source: bool = False, position: np.ndarray = None, rotation: np.ndarray = None, size: np.ndarray = None):
+        super().__init__()
         self.idx: int = idx
         self.inflammable: bool = inflammable
         self.state: int = (ObjectState.NORMAL if state is None else state)
@@ -43,14 +63,16 @@ class ObjectStatus:
             self.temperature = self.constants.FIRE_TEMPERATURE
             return ObjectState.START_BURNING
     
-    def center(self): return self.position + self.size * np.array([0, 0.5, 0])
+    def center(self): return self.vector("position") + self.vector("size") * CENTER
     def bottom(self): return self.position
-    def top(self): return self.position + self.size * np.array([1, 1, 1])
-    def left(self): return self.position + self.size * np.array([-0.5, 0.5, 0])
-    def right(self): return self.position + self.size * np.array([0.5, 0.5, 0])
-    def front(self): return self.position + self.size * np.array([0, 0.5, 0.5])
-    def back(self): return self.position + self.size * np.array([0, 0.5, -0.5])
+    def top(self): return self.vector("position") + self.vector("size") * TOP
+    def left(self): return self.vector("position") + self.vector("size") * LEFT
+    def right(self): return self.vector("position") + self.vector("size") * RIGHT
+    def front(self): return self.vector("position") + self.vector("size") * FRONT
+    def back(self): return self.vector("position") + self.vector("size") * BACK
+
 class FireStatus(ObjectStatus):
+    __slots__ = ()
     def __init__(self, idx, position, size, constants=default_const):
         super().__init__(idx, constants, inflammable=False, state=ObjectState.BURNING,
                          burning_time=-1, burning_time_left=-1,
@@ -59,6 +81,7 @@ class FireStatus(ObjectStatus):
         self.name = "Fire"
 
 class AgentStatus(ObjectStatus):
+    __slots__ = ()
     def __init__(self, idx, position, size, endurance: float = 60.0, constants=default_const):
         super().__init__(idx, constants, inflammable=False, state=ObjectState.NORMAL,
                          burning_time=-1, burning_time_left=-1,
@@ -80,45 +103,270 @@ room temperature has a weight of exp(-1)
 T1 is average temperature of nearby objects, weighted by (effective_distance/distance)^2
 room temperature has a weight of 1
 This algorithm is scientific, and a lot more computationally efficient.
+
+With a cutoff radius, objects further than the cutoff are ignored. Neighbours are found with a
+spatial hash whose cell size is the cutoff, so evolve costs O(N*k) instead of O(N^2).
+Use cutoff_error to check how far the result drifts from the full computation.
 """
 class TemperatureManager:
     def __init__(self, room_temperature: float = 20.0,
                     effective_distance: float = 0.5,
-                    decay_rate: float = 0.03):
+                    decay_rate: float = 0.03,
+                    block_size: int = 256,
+                    cutoff: Optional[float] = None):
         self.room_temperature = room_temperature
         self.effective_distance = effective_distance
         self.decay_rate = decay_rate
+        self.block_size = block_size # rows of the pairwise weight matrix computed at once, bounds memory
+        self.cutoff = cutoff
+
+    def weights(self, targets: np.ndarray, sources: np.ndarray, cutoff: Optional[float] = None) -> np.ndarray:
+        """
+        Pairwise weights (effective_distance/distance)^2, shape (len(targets), len(sources))
+        """
+        distance = np.linalg.norm(targets[:, None, :] - sources[None, :, :], axis=-1)
+        weight = (self.effective_distance / np.maximum(distance, 0.1)) ** 2
+        if cutoff is not None:
+            weight[distance > cutoff] = 0
+        # objects without a position (nan, see gather) take no part
+        weight[np.isnan(distance)] = 0
+        return weight
+
+    def gather(self, objects: Dict[int, ObjectStatus]):
+        """
+        ids and columns in the same order. For an ObjectTable the columns are read directly, in row order,
+        and rows without a position get a nan position.
+        """
+        if isinstance(objects, ObjectTable):
+            positions = np.where(objects.valid_mask("position")[:, None], objects.column("position"), np.nan)
+            return (objects.id_array().tolist(), positions.astype(np.float64),
+                    objects.column("temperature").copy(), objects.column("is_heat_source").copy())
+        ids = list(objects)
+        positions = np.array([objects[idx].position for idx in ids], dtype=np.float64).reshape(-1, 3)
+        temperatures = np.array([objects[idx].temperature for idx in ids], dtype=np.float64)
+        is_heat_source = np.array([objects[idx].is_heat_source for idx in ids], dtype=bool)
+        return ids, positions, temperatures, is_heat_source
+
+    def make_spatial_hash(self) -> SpatialHash:
+        return SpatialHash(cell_size=self.cutoff)
 
-    def evolve(self, objects: Dict[int, ObjectStatus]):
-        new_temperatures = dict()
-        for idx in objects:
-            obj = objects[idx]
-            if obj.is_heat_source:
-                new_temperatures[idx] = obj.temperature
+    def hash_reach(self, spatial_hash: SpatialHash) -> int:
+        # number of cells to look at around a cell so that nothing within the cutoff is missed
+        return max(1, math.ceil(self.cutoff / spatial_hash.cell_size))
+
+    def decay(self, rows: np.ndarray, steps: Optional[np.ndarray] = None):
+        """
+        Decay rate of the given rows. An object skipped for k ticks catches up with 1 - (1 - decay_rate)^k,
+        which is exact as long as its surroundings did not change in the meantime.
+        """
+        if steps is None:
+            return self.decay_rate
+        return 1 - (1 - self.decay_rate) ** steps[rows]
+
+    def evolve_arrays(self, positions: np.ndarray, temperatures: np.ndarray, is_heat_source: np.ndarray,
+                      update: Optional[np.ndarray] = None, steps: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        positions: (N, 3), temperatures: (N,), is_heat_source: (N,)
+        update: (N,) only these objects are updated (all by default), steps: (N,) ticks each of them catches up on
+        returns the new temperatures, shape (N,)
+        """
+        new_temperatures = temperatures.copy()
+        targets = ~is_heat_source & ~np.isnan(positions[:, 0])
+        targets = np.flatnonzero(targets if update is None else targets & update)
+        for start in range(0, len(targets), self.block_size):
+            rows = targets[start:start + self.block_size]
+            weight = self.weights(positions[rows], positions)
+            weight[np.arange(len(rows)), rows] = 0 # an object does not heat itself
+            # Weight of room temperature is 1
+            sum_weight = 1 + weight.sum(axis=1)
+            sum_weighted_temperature = self.room_temperature + weight @ temperatures
+            decay = self.decay(rows, steps)
+            new_temperatures[rows] = temperatures[rows] * (1 - decay) + sum_weighted_temperature / sum_weight * decay
+        return new_temperatures
+
+    def evolve_cutoff(self, ids: List[int], positions: np.ndarray, temperatures: np.ndarray,
+                      is_heat_source: np.ndarray, spatial_hash: SpatialHash,
+                      update: Optional[np.ndarray] = None, steps: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Same as evolve_arrays, but only objects within self.cutoff contribute.
+        Objects are processed one hash cell at a time against the surrounding cells.
+        """
+        reach = self.hash_reach(spatial_hash)
+        index = dict(zip(ids, range(len(ids))))
+        for idx, i in index.items():
+            if idx not in spatial_hash and not np.isnan(positions[i, 0]):
+                spatial_hash.insert(idx, positions[i])
+        new_temperatures = temperatures.copy()
+        targets = ~is_heat_source & ~np.isnan(positions[:, 0])
+        targets = targets if update is None else targets & update
+        for cell, keys in spatial_hash.cells.items():
+            rows = np.array([index[key] for key in keys if key in index], dtype=np.int64)
+            rows = rows[targets[rows]]
+            if len(rows) == 0:
                 continue
-            # sum_weight = np.exp(-1)
-            sum_weight = 1 # Weight of room temperature
-            sum_weighted_temperature = self.room_temperature * sum_weight
-            for idx2 in objects:
-                if idx2 == idx:
-                    continue
-                distance = np.linalg.norm(objects[idx2].position - obj.position)
-                distance = max(distance, 0.1)
-                # weight = np.exp(-max(10000, distance / self.effective_distance))
-                weight = (self.effective_distance/distance)**2
-                sum_weighted_temperature += objects[idx2].temperature * weight
-                sum_weight += weight
-            # print(sum_weighted_temperature / sum_weight)
-            new_temperatures[idx] = obj.temperature * (1 - self.decay_rate) + sum_weighted_temperature / sum_weight * self.decay_rate
+            cols = np.array([index[key] for key in spatial_hash.neighbours(cell, reach) if key in index], dtype=np.int64)
+            weight = self.weights(positions[rows], positions[cols], cutoff=self.cutoff)
+            weight[rows[:, None] == cols[None, :]] = 0 # an object does not heat itself
+            sum_weight = 1 + weight.sum(axis=1)
+            sum_weighted_temperature = self.room_temperature + weight @ temperatures[cols]
+            decay = self.decay(rows, steps)
+            new_temperatures[rows] = temperatures[rows] * (1 - decay) + sum_weighted_temperature / sum_weight * decay
         return new_temperatures
+
+    def evolve_temperatures(self, objects: Dict[int, ObjectStatus], spatial_hash: Optional[SpatialHash] = None,
+                            update: Optional[np.ndarray] = None, steps: Optional[np.ndarray] = None):
+        """
+        Returns the ids and their new temperatures, in the order of gather.
+        update and steps are in the same order, see evolve_arrays.
+        """
+        ids, positions, temperatures, is_heat_source = self.gather(objects)
+        return ids, self.evolve_columns(ids, positions, temperatures, is_heat_source, spatial_hash, update, steps)
+
+    def evolve_columns(self, ids: List[int], positions: np.ndarray, temperatures: np.ndarray, is_heat_source: np.ndarray,
+                       spatial_hash: Optional[SpatialHash] = None, update: Optional[np.ndarray] = None,
+                       steps: Optional[np.ndarray] = None) -> np.ndarray:
+        if len(ids) == 0:
+            return temperatures
+        if self.cutoff is None:
+            return self.evolve_arrays(positions, temperatures, is_heat_source, update, steps)
+        if spatial_hash is None:
+            spatial_hash = self.make_spatial_hash()
+        return self.evolve_cutoff(ids, positions, temperatures, is_heat_source, spatial_hash, update, steps)
+
+    def evolve(self, objects: Dict[int, ObjectStatus], spatial_hash: Optional[SpatialHash] = None):
+        ids, new_temperatures = self.evolve_temperatures(objects, spatial_hash)
+        return dict(zip(ids, new_temperatures.tolist()))
+
+    def evolve_table(self, objects: ObjectTable, spatial_hash: Optional[SpatialHash] = None,
+                     update: Optional[np.ndarray] = None, steps: Optional[np.ndarray] = None):
+        """
+        evolve, writing the new temperatures straight into the temperature column.
+        update and steps are in row order.
+        """
+        _, new_temperatures = self.evolve_temperatures(objects, spatial_hash, update, steps)
+        objects.column("temperature")[:] = new_temperatures
+
+    def cutoff_error(self, objects: Dict[int, ObjectStatus], spatial_hash: Optional[SpatialHash] = None):
+        """
+        Compare one evolve step with and without the cutoff, on the current state.
+        Returns max and mean absolute temperature difference, over objects that are not heat sources.
+        """
+        ids, positions, temperatures, is_heat_source = self.gather(objects)
+        if self.cutoff is None or len(ids) == 0 or is_heat_source.all():
+            return dict(max=0.0, mean=0.0)
+        if spatial_hash is None:
+            spatial_hash = self.make_spatial_hash()
+        full = self.evolve_arrays(positions, temperatures, is_heat_source)
+        cut = self.evolve_cutoff(ids, positions, temperatures, is_heat_source, spatial_hash)
+        error = np.abs(full - cut)[~is_heat_source & ~np.isnan(positions[:, 0])]
+        if len(error) == 0:
+            return dict(max=0.0, mean=0.0)
+        return dict(max=float(error.max()), mean=float(error.mean()))
     
-    def query_point_temperature(self, target: np.ndarray, objects: Dict[int, ObjectStatus]):
-        sum_weight = np.exp(-1)
-        sum_weighted_temperature = self.room_temperature * sum_weight
-        for idx in objects:
-            distance = np.linalg.norm(objects[idx].position - target)
-            distance = max(distance, 0.1)
-            weight = (self.effective_distance/distance)**2
-            sum_weighted_temperature += objects[idx].temperature * weight
-            sum_weight += weight
-        return sum_weighted_temperature / sum_weight
\ No newline at end of file
+    def query_points_temperature(self, points: np.ndarray, objects: Dict[int, ObjectStatus],
+                                 spatial_hash: Optional[SpatialHash] = None) -> np.ndarray:
+        """
+        Temperature at each of the (M, 3) points, in one vectorized pass. Returns shape (M,)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        ids, positions, temperatures, _ = self.gather(objects)
+        room_weight = np.exp(-1)
+        result = np.full(len(points), self.room_temperature, dtype=np.float64)
+        if len(positions) == 0:
+            return result
+
+        def weighted_average(rows, cols):
+            weight = self.weights(points[rows], positions[cols], cutoff=self.cutoff)
+            sum_weight = room_weight + weight.sum(axis=1)
+            sum_weighted_temperature = self.room_temperature * room_weight + weight @ temperatures[cols]
+            result[rows] = sum_weighted_temperature / sum_weight
+
+        if self.cutoff is not None and spatial_hash is not None:
+            index = dict(zip(ids, range(len(ids))))
+            reach = self.hash_reach(spatial_hash)
+            cells = np.floor(points[:, spatial_hash.axes] / spatial_hash.cell_size).astype(np.int64)
+            cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+            order = np.argsort(inverse.reshape(-1), kind="stable")
+            splits = np.cumsum(np.bincount(inverse.reshape(-1), minlength=len(cells)))[:-1]
+            for cell, rows in zip(cells.tolist(), np.split(order, splits)):
+                cols = np.array([index[key] for key in spatial_hash.neighbours(tuple(cell), reach) if key in index], dtype=np.int64)
+                if len(cols) > 0:
+                    weighted_average(rows, cols)
+            return result
+        cols = np.arange(len(positions))
+        for start in range(0, len(points), self.block_size):
+            weighted_average(np.arange(start, min(start + self.block_size, len(points))), cols)
+        return result
+
+    def query_point_temperature(self, target: np.ndarray, objects: Dict[int, ObjectStatus],
+                                spatial_hash: Optional[SpatialHash] = None):
+        return float(self.query_points_temperature(np.asarray(target).reshape(1, 3), objects, spatial_hash)[0])
+
+class TemperatureField:
+    """
+    Cached temperatures on a coarse 3d grid: the (map_size_h, map_size_v) xz grid of Semantic_Mapping,
+    with one layer per height. Queries inside the grid are trilinear interpolations of the cache,
+    points outside fall back to the exact computation.
+    The cache is rebuilt lazily on the first query after invalidate(), i.e. at most once per evolve tick.
+    """
+    def __init__(self, map_offset: List[int], grid_size: float, map_size_h: int, map_size_v: int,
+                 heights: List[float]):
+        self.map_offset = np.array(map_offset, dtype=np.float64)
+        self.grid_size = grid_size
+        self.map_size_h = map_size_h
+        self.map_size_v = map_size_v
+        self.heights = np.array(heights, dtype=np.float64)
+        gx, gz = np.meshgrid(np.arange(map_size_h), np.arange(map_size_v), indexing="ij")
+        x = (gx - self.map_offset[0]) * grid_size
+        z = (gz - self.map_offset[1]) * grid_size
+        # (len(heights), map_size_h, map_size_v, 3)
+        self.points = np.stack([np.broadcast_to(x, (len(heights),) + x.shape),
+                                np.broadcast_to(self.heights[:, None, None], (len(heights),) + x.shape),
+                                np.broadcast_to(z, (len(heights),) + x.shape)], axis=-1)
+        self.grid: Optional[np.ndarray] = None
+        self.rebuilds = 0
+
+    def invalidate(self):
+        self.grid = None
+
+    def refresh(self, temperature_manager: TemperatureManager, objects: Dict[int, ObjectStatus],
+                spatial_hash: Optional[SpatialHash] = None):
+        if self.grid is None:
+            self.grid = temperature_manager.query_points_temperature(self.points.reshape(-1, 3), objects, spatial_hash).reshape(self.points.shape[:-1])
+            self.rebuilds += 1
+        return self.grid
+
+    def query(self, points: np.ndarray, temperature_manager: TemperatureManager, objects: Dict[int, ObjectStatus],
+              spatial_hash: Optional[SpatialHash] = None) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        grid = self.refresh(temperature_manager, objects, spatial_hash)
+        gx = points[:, 0] / self.grid_size + self.map_offset[0]
+        gz = points[:, 2] / self.grid_size + self.map_offset[1]
+        y = points[:, 1]
+        inside = (gx >= 0) & (gx <= self.map_size_h - 1) & (gz >= 0) & (gz <= self.map_size_v - 1) \
+                 & (y >= self.heights[0]) & (y <= self.heights[-1])
+        result = np.empty(len(points), dtype=np.float64)
+        outside = np.flatnonzero(~inside)
+        if len(outside) > 0:
+            result[outside] = temperature_manager.query_points_temperature(points[outside], objects, spatial_hash)
+        inside = np.flatnonzero(inside)
+        if len(inside) == 0:
+            return result
+        gx, gz, y = gx[inside], gz[inside], y[inside]
+        x0 = np.minimum(np.floor(gx).astype(np.int64), self.map_size_h - 2) if self.map_size_h > 1 else np.zeros(len(gx), dtype=np.int64)
+        z0 = np.minimum(np.floor(gz).astype(np.int64), self.map_size_v - 2) if self.map_size_v > 1 else np.zeros(len(gz), dtype=np.int64)
+        l0 = np.clip(np.searchsorted(self.heights, y, side="right") - 1, 0, max(len(self.heights) - 2, 0))
+        x1 = np.minimum(x0 + 1, self.map_size_h - 1)
+        z1 = np.minimum(z0 + 1, self.map_size_v - 1)
+        l1 = np.minimum(l0 + 1, len(self.heights) - 1)
+        fx = gx - x0
+        fz = gz - z0
+        dy = self.heights[l1] - self.heights[l0]
+        fy = np.divide(y - self.heights[l0], dy, out=np.zeros_like(y), where=dy > 0)
+
+        def bilinear(layer):
+            return (grid[layer, x0, z0] * (1 - fx) * (1 - fz) + grid[layer, x1, z0] * fx * (1 - fz)
+                    + grid[layer, x0, z1] * (1 - fx) * fz + grid[layer, x1, z1] * fx * fz)
+
+        result[inside] = bilinear(l0) * (1 - fy) + bilinear(l1) * fy
+        return result
@@ -1,11 +1,13 @@
-from typing import List, Union, Dict
+from typing import List, Optional, Union, Dict
 from .manager import FloodObjectManager
 from .utils import *
 from .object import AgentStatus
+from src.HAZARD.utils.response_router import ResponseRouter
 from tdw.controller import Controller
 from tdw.obi_data.fluids.disk_emitter import DiskEmitter
 from tdw.obi_data.fluids.fluid import Fluid
 from tdw.add_ons.obi import Obi
+from src.HAZARD.utils.obi_solver import init_obi, destroy_obi
 
 import numpy as np
 
@@ -40,26 +42,38 @@ class FloodController(Controller):
         self.commands: List[dict] = list()
         super().__init__(port, check_version, launch_build)
 
+        # classifies the output data of each frame once for the manager and image capture
+        self.router = ResponseRouter()
         self.manager = FloodObjectManager(source_position=None,
                                           source_from="x_max",
                                           floor_ids=[],
                                           floor_positions=[],
                                           floor_sizes=[],
                                           floor_directions=[],
-                                          flood_density=default_const.FLOOD_DENSITY)
+                                          flood_density=default_const.FLOOD_DENSITY,
+                                          bounds_refresh_interval=kwargs.get("bounds_refresh_interval", 100),
+                                          router=self.router, lod=kwargs.get("lod", False),
+                                          lod_validate=kwargs.get("lod_validate", False))
         self.add_ons.append(self.manager)
 
         self.physical_flood_info: Dict[int, PhysicalFlood] = dict()
         self.floor_flood_info: Dict[int, FloorFlood] = dict()
+        self.obi: Optional[Obi] = None
+        self.obi_solver_id = 1
+        self.RNG = np.random.Generator(np.random.PCG64(seed))
         self.constants = constants
 
     def init_obi(self):
-        self.obi = Obi()
-        self.communicate([{"$type": "create_obi_solver"}])
-        self.obi.set_solver(solver_id=1, scale_factor=1.0, substeps=1)
-        self.add_ons.append(self.obi)
-        self.communicate([])
-        self.communicate([])
+        self.obi = init_obi(self, solver_id=self.obi_solver_id)
+
+    def destroy_obi(self):
+        """
+        Undo init_obi, so that a reused build starts the next scene without its solvers.
+        """
+        if self.obi is None:
+            return
+        destroy_obi(self, self.obi, solver_id=self.obi_solver_id)
+        self.obi = None
 
     def seed(self, seed):
         self.RNG = np.random.Generator(np.random.PCG64(seed))
@@ -122,5 +136,6 @@ class FloodController(Controller):
         #     print(com)
         resp = super().communicate(commands)
         if self.initialized:
-            self.flood_step(resp)
+            with self.router.timed("flood_step"):
+                self.flood_step(resp)
         return resp
@@ -4,6 +4,8 @@ import gym
 import gym.spaces
 from .floodagent_controller import *
 from .agent import *
+from src.HAZARD.utils.leak_check import LeakCheck
+from src.HAZARD.utils.scene_snapshot import SceneSnapshots
 import numpy as np
 import os
 PATH = os.path.dirname(os.path.abspath(__file__))
@@ -27,14 +29,28 @@ class FloodEnv(gym.Env):
                  use_local_resources: bool = False, seed = 0, screen_size = 512, use_dino=False,
                  image_capture_path = None, log_path: str = None, use_gt = False,
                  map_size_h = 128, map_size_v = 128, grid_size = 0.25, reverse_observation = False,
-                 record_only: bool = False):
+                 record_only: bool = False, bounds_refresh_interval = 100, lod = False, lod_validate = False,
+                 flood_height_resolution = 16, reuse_controller = False,
+                 scene_snapshots = False, obs_cache = False, lazy_obs = False, leak_check = False):
         self.controller_args = dict(use_local_resources=use_local_resources, launch_build=launch_build,
                                     port=port, check_version=check_version, screen_size=screen_size,
                                     image_capture_path=image_capture_path, log_path=log_path, use_dino=use_dino,
                                     map_size_h=map_size_h, map_size_v=map_size_v, grid_size=grid_size,
                                     use_gt=use_gt, reverse_observation=reverse_observation,
-                                    record_only=record_only)
+                                    record_only=record_only, bounds_refresh_interval=bounds_refresh_interval,
+                                    lod=lod, lod_validate=lod_validate,
+                                    flood_height_resolution=flood_height_resolution)
         self.controller = None
+        # keep one controller and build for all episodes, reset_scene cleans up between them
+        self.reuse_controller = reuse_controller
+        # check for objects the last episode left in the build, on each reset
+        self.leak_check = LeakCheck() if leak_check else None
+        # one snapshot per scene, kept across controllers
+        self.snapshots = SceneSnapshots(enabled=scene_snapshots)
+        self.controller_args["snapshots"] = self.snapshots
+        self.controller_args["obs_cache"] = obs_cache
+        self.controller_args["lazy_obs"] = lazy_obs
+        self.controller_args["leak_check"] = self.leak_check
         self.RNG = np.random.RandomState(0)
 
         rgb_space = gym.spaces.Box(0, 256, (3, screen_size, screen_size), dtype=np.int32)
@@ -69,12 +85,14 @@ class FloodEnv(gym.Env):
             data_dir = os.path.join(PATH, "data", "room_setup_fire", data_dirs[self.RNG.randint(len(data_dirs))])
             # data_dir = os.path.join(PATH, "data", "room_setup", "1a-0-0")
         self.setup = SceneSetup(data_dir=data_dir, is_flood=True, record_mode=self.record_only)
-        if self.controller is not None:
+        if self.controller is not None and not self.reuse_controller:
             self.controller.communicate({"$type": "terminate"})
             self.controller.socket.close()
-        self.controller = FloodAgentController(**self.controller_args)
+            self.controller = None
+        if self.controller is None:
+            self.controller = FloodAgentController(**self.controller_args)
+            print("Controller connected")
         self.controller.seed(self.RNG.randint(1000000))
-        print("Controller connected")
         self.controller.init_scene(self.setup)
         self.num_step = 0
         self.last_action = None
@@ -85,7 +103,7 @@ class FloodEnv(gym.Env):
         self.controller.do_action(0, "turn_by", {"angle": 90})
         self.controller.next_key_frame()
 
-        return self.controller._obs()["RL"]
+        return self.controller._obs(fields=["RL"])["RL"]
     
     # def step(self, action):
     #     """
@@ -173,7 +191,7 @@ class FloodEnv(gym.Env):
                 if self.last_action == ActionSpace.WALK_TO_RANDOM_OBJECT_IN_SIGHT:
                     target = self.last_target
                 else:
-                    obs = self.controller._obs()
+                    obs = self.controller._obs(fields=["sem_map"])
                     obj_ids = np.unique(obs["sem_map"]["id"])
                     targets = [self.controller.manager.get_real_id(idx) for idx in obj_ids if self.controller.manager.get_real_id(idx) not in self.controller.finished]
                     targets = [idx for idx in targets if idx is not None]
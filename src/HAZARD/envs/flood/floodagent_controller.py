@@ -1,4 +1,4 @@
-from typing import Any, Tuple, Dict
+from typing import Any, Tuple, Dict, List, Optional
 from .object import ObjectStatus
 from .agent import *
 from .flood import FloorFlood
@@ -14,6 +14,8 @@ from tdw.output_data import OutputData, Images
 from src.HAZARD.utils.vision import Detector
 from src.HAZARD.utils.model import Semantic_Mapping
 from src.HAZARD.utils.scene_setup import SceneSetup
+from src.HAZARD.utils.scene_snapshot import SceneSnapshots
+from src.HAZARD.utils.observation import LazyObservation, ObservationCache
 import numpy as np
 import cv2
 import copy
@@ -36,12 +38,22 @@ class FloodAgentController(FloodController):
         self.action_slowdown = 0
         super().__init__(**kwargs)
         self.screen_size = kwargs.get("screen_size", 512)
+        # resolution of the flood height observation before it is upsampled to the screen size
+        self.flood_height_resolution = kwargs.get("flood_height_resolution", 16)
         self.agents: List[FloodAgent] = []
         self.comm_counter = 0
         self.use_gt = kwargs.get("use_gt", True)
         self.use_dino = use_dino
         self.single_room = single_room
         self.record_only = record_only
+        # shared by the gym with the controllers of later episodes, replays every batch when disabled
+        self.snapshots = kwargs.get("snapshots", None)
+        if self.snapshots is None:
+            self.snapshots = SceneSnapshots(enabled=False)
+        # LeakCheck of the gym, None for no check
+        self.leak_check = kwargs.get("leak_check", None)
+        self.obs_cache = ObservationCache(enabled=kwargs.get("obs_cache", False))
+        self.lazy_obs = kwargs.get("lazy_obs", False)
         self.id2name = {}
         self.other_containers = {}
         if not self.use_gt:
@@ -89,6 +101,12 @@ class FloodAgentController(FloodController):
                 agent.drop(arm=arm)
                 while agent.action.status == ActionStatus.ongoing:
                     self.communicate([])
+        # the flood planes are visual effects, destroy_all_objects does not remove them
+        commands = []
+        for i in self.floor_flood_info:
+            commands.append({"$type": "destroy_visual_effect", "id": self.floor_flood_info[i].floor_id})
+        self.communicate(commands)
+        self.destroy_obi()
 
         self.floor_flood_info = dict()
         self.physical_flood_info = dict()
@@ -98,6 +116,7 @@ class FloodAgentController(FloodController):
         self.id2name = {}
         self.manager.reset()
         self.frame_count = 0
+        self.obs_cache.reset()
         self.communicate([])
 
         self.last_reward = None
@@ -114,6 +133,7 @@ class FloodAgentController(FloodController):
         self.other_containers = {}
         for obj in setup.objects:
             self.manager.add_object(obj)
+        batches = []
         for commands in setup.commands_list:
             if len(commands) == 1 and commands[0]["$type"] == "terminate":
                 continue
@@ -132,7 +152,8 @@ class FloodAgentController(FloodController):
                 if tp.startswith("add_") and tp.endswith("_container"):
                     self.other_containers[command['id']] = command['container_id']
             # json.dump(filtered_commands, open("/data/private/zqh/tmp.json", "w"))
-            self.communicate(filtered_commands)
+            batches.append(filtered_commands)
+        self.snapshots.load(self, setup, batches)
 
 
         if not self.record_only:
@@ -161,7 +182,10 @@ class FloodAgentController(FloodController):
         self.target_id2category = setup.target_id2category
         self.target_id2name = setup.target_id2name
         self.finished = []
-        self.communicate([])
+        # the ids of the new scene, on a frame before the episode starts
+        resp = self.communicate(self.leak_check.commands() if self.leak_check is not None else [])
+        if self.leak_check is not None:
+            self.leak_check.check(self, resp)
         if self.image_capture_path is not None:
             # camera = ThirdPersonCamera(avatar_id="record", position={"x": -7.78, "y": 7.67, "z": 0.16},
             #                            look_at=self.agents[0].replicant_id)
@@ -237,9 +261,11 @@ class FloodAgentController(FloodController):
                 self.manager.add_flood(id=floor_id, position=position, direction=rotation,
                                        scale=np.array([1.0, 1.0, 1.0]))
 
-        resp = self.communicate([{"$type": "send_scene_regions"}])
+        resp = self.snapshots.scene_regions(self, setup)
         self.manager.flood_manager.source_from = setup.flood_source_from
         self.manager.flood_manager.set_scene_bounds(resp=resp)
+        # the water level of the whole episode, so that it can be queried at any frame
+        self.manager.flood_manager.make_schedule(seed=int(self.RNG.integers(1 << 31)))
         self.add_ons.append(self.manager)
 
         self.manager.prepare_segmentation_data()
@@ -404,17 +430,15 @@ class FloodAgentController(FloodController):
                     self.finished.append(target)
 
         if self.image_capture_path != None:
-            for i in range(len(resp) - 1):
-                r_id = OutputData.get_data_type_id(resp[i])
-                # Get Images output data.
-                if r_id == "imag":
-                    images = Images(resp[i])
-                    # Determine which avatar captured the image.
-                    if images.get_avatar_id() == "record":
-                        # Save the image.
-                        TDWUtils.save_images(images=images, filename=str(self.comm_counter),
-                                             output_directory=self.image_capture_path)
-                        self.comm_counter += 1
+            # Get Images output data.
+            for b in self.router.get(resp, "imag"):
+                images = Images(b)
+                # Determine which avatar captured the image.
+                if images.get_avatar_id() == "record":
+                    # Save the image.
+                    TDWUtils.save_images(images=images, filename=str(self.comm_counter),
+                                         output_directory=self.image_capture_path)
+                    self.comm_counter += 1
         return resp
 
     def get_seg_mask(self, rgb, obj2idx):
@@ -437,112 +461,138 @@ class FloodAgentController(FloodController):
         #                 print(point_cloud[t, j, k].item(), end=' ', file=fout)
         #             print('', file=fout)
         # shape: (3, 512, 512)
-        # down sample to 16x16
-        point_cloud = point_cloud[:, ::(width//16), ::(width//16)]
-        temp = np.zeros((16, 16))
-        for i in range(16):
-            for j in range(16):
-                flood_height = self.manager.query_point_flood_height(point_cloud[:, i, j])
-                temp[i, j] = flood_height
-        temp = cv2.resize(temp, (width, height), interpolation=cv2.INTER_NEAREST)
+        # down sample to flood_height_resolution x flood_height_resolution, the full image if it is not smaller
+        resolution = min(self.flood_height_resolution, width, height)
+        point_cloud = point_cloud[:, ::(height//resolution), ::(width//resolution)][:, :resolution, :resolution]
+        temp = self.manager.query_points_flood_height(point_cloud.reshape(3, -1).T).reshape(resolution, resolution)
+        if temp.shape != (height, width):
+            temp = cv2.resize(temp, (width, height), interpolation=cv2.INTER_NEAREST)
         return temp
 
     @torch.no_grad()
-    def _obs(self, agent_idx: int = 0):
-        # print("get obs")
-
-        self.manager.prepare_segmentation_data()
-        self.communicate([])
-
-        obs = dict()
-        """
-        raw observation: RGBD, temperature
+    def _obs(self, agent_idx: int = 0, fields: Optional[List[str]] = None):
         """
-        rgb = self.agents[agent_idx].dynamic.get_pil_image()
-        id_image = np.array(self.agents[agent_idx].dynamic.get_pil_image("id"))
-        if self.reverse_observation:
-            rgb = np.flip(rgb, axis=0)
-            id_image = np.flip(id_image, axis=0)
-        seg_mask = None
-        if self.use_gt:
-            seg_mask = self.manager.segm.get_seg_mask(id_image)
-        else:
-            rcnn_mask = self.detector.inference(np.array(rgb))
-            seg_mask = self.manager.segm.get_seg_mask(np.array(id_image),
-                                                        rcnn=rcnn_mask,
-                                                        id_list=self.manager.id_list)
-
-        depth = TDWUtils.get_depth_values(self.agents[agent_idx].dynamic.images["depth"], width=self.screen_size, height=self.screen_size)
-        depth = np.flip(depth, axis=0)
-
-        rgb = np.array(rgb).astype(np.float32).transpose((2, 0, 1)).astype(np.float32) * 1.0 / 255
-        depth = depth.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
-
-        flood_height = self.get_flood_height_observation(agent_idx, width=self.screen_size, height=self.screen_size)
-        flood_height = flood_height.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
-        obs["raw"] = dict(
-            rgb=rgb,
-            depth=depth,
-            log_temp=flood_height,
-            seg_mask=seg_mask
-        )
-
+        fields: the fields that will be read, "raw.<name>" for one raw field. With lazy_obs only these are computed
+        now, the others on first access before the next frame. None for all of them.
         """
-        mapped observation
-        """
-        camera_matrix = self.agents[agent_idx].dynamic.camera_matrix.reshape((4, 4))
-        obs_concat = np.concatenate([rgb, depth, flood_height], axis=0)
-        sem = self.sem_map.forward(obs=obs_concat, id_map=seg_mask, camera_matrix=camera_matrix, maps_last=self.maps[agent_idx],
-                                   position=self.agents[agent_idx].dynamic.transform.position, record_mode=self.record_only,
-                                   targets=[self.manager.id_renumbering[target] for target in self.target_ids])
-        obs["sem_map"] = dict(height=sem["height"].cpu().numpy(),
-                              explored=sem["explored"].cpu().numpy(),
-                              id=sem["id"].cpu().numpy(),
-                              other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
-        self.maps[agent_idx] = dict(height=sem["height"].cpu().numpy(),
-                              explored=sem["explored"].cpu().numpy(),
-                              id=sem["id"].cpu().numpy(),
-                              other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+        # print("get obs")
+        obs = self.obs_cache.get(agent_idx, self.frame_count)
+        if obs is None:
+            self.manager.prepare_segmentation_data()
+            self.communicate([])
+            obs = LazyObservation(self.frame_count, lambda: self.frame_count)
+            self.add_obs_fields(obs, agent_idx)
+            self.obs_cache.put(agent_idx, obs)
+        obs.compute(fields if self.lazy_obs else None)
+        return obs
 
-        """
-        map of goal and agent
-        """
-        agent_pos = self.sem_map.real_to_grid(self.agents[agent_idx].dynamic.transform.position)
-        target_poss = [self.sem_map.real_to_grid(self.manager.objects[idx].position) for idx in self.target_ids]
-        
-        goal_map = np.zeros((self.map_size_h, self.map_size_v))
-        for (i, target_pos) in enumerate(target_poss):
-            if self.target_ids[i] in self.finished:
-                continue
-            if target_pos[0] < 0 or target_pos[0] >= self.map_size_h or target_pos[1] < 0 or target_pos[1] >= self.map_size_v:
-                continue
-            if not (sem["id"] == self.manager.get_renumbered_id(self.target_ids[i])).any():
-                continue
-            goal_map[target_pos[0], target_pos[1]] = 1
-        if agent_pos[0] > 0 and agent_pos[0] < self.map_size_h - 1 and agent_pos[1] > 0 and agent_pos[1] < self.map_size_v - 1:
-            goal_map[agent_pos[0], agent_pos[1]] = -2
-            rad = self.agents[agent_idx].get_facing()
-            rad = int(rad / (np.math.pi / 4))
-            if rad < 0:
-                rad += 8
-            dx = list([1, 1, 0, -1, -1, -1, 0, 1])[rad]
-            dz = list([0, 1, 1, 1, 0, -1, -1, -1])[rad]
-            goal_map[agent_pos[0] + dx][agent_pos[1] + dz] = -1
-        obs["goal_map"] = goal_map
+    def add_obs_fields(self, obs: LazyObservation, agent_idx: int):
+        images = dict()
+
+        def image(pass_mask: str):
+            if pass_mask not in images:
+                images[pass_mask] = np.array(self.agents[agent_idx].dynamic.get_pil_image(pass_mask))
+                if self.reverse_observation:
+                    images[pass_mask] = np.flip(images[pass_mask], axis=0)
+            return images[pass_mask]
+
+        def rgb():
+            return image("img").astype(np.float32).transpose((2, 0, 1)).astype(np.float32) * 1.0 / 255
+
+        def depth():
+            depth = TDWUtils.get_depth_values(self.agents[agent_idx].dynamic.images["depth"], width=self.screen_size, height=self.screen_size)
+            depth = np.flip(depth, axis=0)
+            return depth.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
+
+        def flood_height():
+            flood_height = self.get_flood_height_observation(agent_idx, width=self.screen_size, height=self.screen_size)
+            return flood_height.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
+
+        def seg_mask():
+            if self.use_gt:
+                return self.manager.segm.get_seg_mask(image("id"))
+            rcnn_mask = self.detector.inference(np.array(image("img")))
+            return self.manager.segm.get_seg_mask(np.array(image("id")), rcnn=rcnn_mask, id_list=self.manager.id_list)
+
+        def raw():
+            """
+            raw observation: RGBD, flood height
+            """
+            raw = LazyObservation(obs.frame, obs.clock)
+            raw.add("rgb", rgb)
+            raw.add("depth", depth)
+            raw.add("log_temp", flood_height)
+            raw.add("seg_mask", seg_mask)
+            return raw
+
+        @torch.no_grad()
+        def sem_map():
+            """
+            mapped observation
+            """
+            raw = obs["raw"]
+            # the semantic map reads depth and the channels after it, the rgb channels are left empty
+            obs_concat = np.concatenate([np.zeros((3, self.screen_size, self.screen_size), dtype=np.float32),
+                                         raw["depth"], raw["log_temp"]], axis=0)
+
+            sem = self.sem_map.forward(obs=obs_concat, id_map=raw["seg_mask"], camera_matrix=camera_matrix, maps_last=self.maps[agent_idx],
+                                       position=self.agents[agent_idx].dynamic.transform.position, record_mode=self.record_only,
+                                       targets=[self.manager.id_renumbering[target] for target in self.target_ids])
+            self.maps[agent_idx] = dict(height=sem["height"].cpu().numpy(),
+                                  explored=sem["explored"].cpu().numpy(),
+                                  id=sem["id"].cpu().numpy(),
+                                  other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+            return dict(height=sem["height"].cpu().numpy(),
+                        explored=sem["explored"].cpu().numpy(),
+                        id=sem["id"].cpu().numpy(),
+                        other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+
+        def goal_map():
+            """
+            map of goal and agent
+            """
+            sem_id = obs["sem_map"]["id"]
+            agent_pos = self.sem_map.real_to_grid(self.agents[agent_idx].dynamic.transform.position)
+            target_poss = [self.sem_map.real_to_grid(self.manager.objects[idx].position) for idx in self.target_ids]
+
+            goal_map = np.zeros((self.map_size_h, self.map_size_v))
+            for (i, target_pos) in enumerate(target_poss):
+                if self.target_ids[i] in self.finished:
+                    continue
+                if target_pos[0] < 0 or target_pos[0] >= self.map_size_h or target_pos[1] < 0 or target_pos[1] >= self.map_size_v:
+                    continue
+                if not (sem_id == self.manager.get_renumbered_id(self.target_ids[i])).any():
+                    continue
+                goal_map[target_pos[0], target_pos[1]] = 1
+            if agent_pos[0] > 0 and agent_pos[0] < self.map_size_h - 1 and agent_pos[1] > 0 and agent_pos[1] < self.map_size_v - 1:
+                goal_map[agent_pos[0], agent_pos[1]] = -2
+                rad = self.agents[agent_idx].get_facing()
+                rad = int(rad / (np.math.pi / 4))
+                if rad < 0:
+                    rad += 8
+                dx = list([1, 1, 0, -1, -1, -1, 0, 1])[rad]
+                dz = list([0, 1, 1, 1, 0, -1, -1, -1])[rad]
+                goal_map[agent_pos[0] + dx][agent_pos[1] + dz] = -1
+            return goal_map
+
+        def rl():
+            RL_obs = np.zeros((5, self.map_size_h, self.map_size_v))
+            RL_obs[0] = obs["sem_map"]["height"]
+            RL_obs[1] = obs["sem_map"]["explored"]
+            RL_obs[2] = obs["sem_map"]["id"]
+            RL_obs[3] = obs["goal_map"]
+            RL_obs[4] = obs["sem_map"]["other"][0]
+            return RL_obs
 
         """
         agent info
         """
+        camera_matrix = self.agents[agent_idx].dynamic.camera_matrix.reshape((4, 4))
+        obs.add("raw", raw)
+        obs.add("sem_map", sem_map)
+        obs.add("goal_map", goal_map)
         obs["camera_matrix"] = camera_matrix
-
-        RL_obs = np.zeros((5, self.map_size_h, self.map_size_v))
-        RL_obs[0] = obs["sem_map"]["height"]
-        RL_obs[1] = obs["sem_map"]["explored"]
-        RL_obs[2] = obs["sem_map"]["id"]
-        RL_obs[3] = goal_map
-        RL_obs[4] = obs["sem_map"]["other"][0]
-        obs["RL"] = RL_obs
-        return obs
+        obs.add("RL", rl)
 
     def _info(self):
         info = dict()
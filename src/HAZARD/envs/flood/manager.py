@@ -3,9 +3,15 @@ from tdw.output_data import OutputData, Transforms, Bounds, Rigidbodies
 from tdw.output_data import Replicants, SegmentationColors, ReplicantSegmentationColors
 from typing import Dict, List, Set, Optional
 import numpy as np
-from .object import FloodManager, ObjectStatus
+from .object import FloodManager, FloodSurfaceRenderer, ObjectStatus, ObjectTable, water_states
 from .utils import *
 from src.HAZARD.utils.seg_id import SegmentationID
+from src.HAZARD.utils.output_decoder import decode_transforms, decode_bounds, decode_rigidbodies, decode_replicants
+from src.HAZARD.utils.bounds_cache import BoundsCache
+from src.HAZARD.utils.response_router import ResponseRouter
+from src.HAZARD.utils.lod import LODScheduler
+from src.HAZARD.utils.force_emitter import ForceEmitter
+from src.HAZARD.utils.spatial_query import SpatialQuery
 
 """
 Add-on to control the evolvement of objects, including temperature and state.
@@ -15,10 +21,14 @@ Future development may include changing object appearances.
 
 class FloodObjectManager(AddOn):
     def __init__(self, constants=default_const, source_position=None, source_from=None, floor_ids=[],
-                 floor_positions=[], floor_sizes=[], floor_directions=[], flood_density=1.0):
+                 floor_positions=[], floor_sizes=[], floor_directions=[], flood_density=1.0,
+                 bounds_refresh_interval: int = 100,
+                 router: Optional[ResponseRouter] = None, lod: bool = False, lod_validate: bool = False):
         super().__init__()
         self.constants = constants
-        self.objects: Dict[int, ObjectStatus] = dict()
+        self.objects: Dict[int, ObjectStatus] = ObjectTable(ObjectStatus)
+        # nearest object queries on a lazily rebuilt grid
+        self.spatial = SpatialQuery(self.objects)
         self.flood_manager = FloodManager(ascending_speed=constants.ASCENDING_SPEED,
                                           ascending_interval=constants.ASCENDING_INTERVAL,
                                           max_height=constants.MAX_HEIGHT,
@@ -34,95 +44,71 @@ class FloodObjectManager(AddOn):
                                           drag_coefficient=constants.DRAG_COEFFICIENT)
         self.objects_floating: Set[int] = set()
         self.objects_flooded: Set[int] = set()
-        self.recover_command_list = []
+        # water planes are only moved when their pose changes
+        self.surface_renderer = FloodSurfaceRenderer()
         self.segm = SegmentationID()
         self.id_renumbering = dict()
         self.id_list = [0]
+        self.bounds_cache = BoundsCache(refresh_interval=bounds_refresh_interval)
+        # shared with the controller, which classifies the output data once per frame
+        self.router = router if router is not None else ResponseRouter()
+        # level of detail of the per-object flood update: objects well above the water are updated less often
+        self.lod = LODScheduler(active_distance=0.2, near_distance=0.5, enabled=lod, validate=lod_validate)
+        # dry objects get no buoyancy and no drag, their zero forces are not sent
+        self.force_emitter = ForceEmitter()
 
     def update_visual_effects(self):
         new_effect_dict = self.flood_manager.evolve()
-        self.recover_command_list.reverse()
-        self.commands = [{"$type": "send_bounds"}, {"$type": "send_transforms"}, {"$type": "send_rigidbodies"}]
-        self.commands.extend(self.recover_command_list)
-        self.recover_command_list = []
-        floor_flood_commands = []
-        for floor_effect_idx in new_effect_dict:
-            for axis in ["yaw", "pitch", "roll"]:
-                if new_effect_dict[floor_effect_idx]["angles"][axis] > 0:
-                    floor_flood_commands.append(
-                        {"$type": "rotate_visual_effect_by",
-                         "angle": new_effect_dict[floor_effect_idx]["angles"][axis],
-                         "axis": axis,
-                         "id": floor_effect_idx,
-                         "is_world": True}
-                    )
-                    self.recover_command_list.append(
-                        {"$type": "rotate_visual_effect_by",
-                         "angle": -new_effect_dict[floor_effect_idx]["angles"][axis],
-                         "axis": axis,
-                         "id": floor_effect_idx,
-                         "is_world": True}
-                    )
-            floor_flood_commands.append(
-                {"$type": "scale_visual_effect",
-                 "scale_factor": {"x": new_effect_dict[floor_effect_idx]["scales"]['x'],
-                                  "y": new_effect_dict[floor_effect_idx]["scales"]['y'],
-                                  "z": new_effect_dict[floor_effect_idx]["scales"]['z']
-                                  },
-                 "id": floor_effect_idx}
-            )
-            floor_flood_commands.append(
-                {"$type": "teleport_visual_effect",
-                 "position": {"x": new_effect_dict[floor_effect_idx]["positions"]['x'],
-                              "y": new_effect_dict[floor_effect_idx]["positions"]['y'],
-                              "z": new_effect_dict[floor_effect_idx]["positions"]['z']},
-                 "id": floor_effect_idx}
-            )
+        self.commands = self.bounds_cache.commands() + [{"$type": "send_transforms"}, {"$type": "send_rigidbodies"}]
+        floor_flood_commands = self.surface_renderer.commands(
+            new_effect_dict, dict(zip(self.flood_manager.floor_ids, self.flood_manager.floor_directions)))
         self.objects_flooded = set()
         self.objects_floating = set()
-        counter = 0
-        for idx in self.objects:
-            if self.objects[idx].name == "Agent":
-                continue
-            obj = self.objects[idx]
-            status, buoyancy_scale = self.flood_manager.update_object_status_new(self.objects[idx])
-            if status.state == ObjectState.FLOODED or status.state == ObjectState.FLOODED_FLOATING:
-                self.objects_flooded.add(idx)
-            if status.state == ObjectState.FLOATING or status.state == ObjectState.FLOODED_FLOATING:
-                self.objects_floating.add(idx)
-                # height_diff = self.query_height_diff(position=None)
-                # if not start_floating:
-                #     floor_flood_commands.append({
-                #         "$type": "teleport_object_by", "id": status.idx,
-                #         "position": {"x":0.0, "y":height_diff, "z":0.0}, "absolute": True
-                #     })
-            # add buoyancy
-            if isinstance(obj.size, np.ndarray) and isinstance(obj.velocity, np.ndarray):
-                counter += 1
-                horizontal_force = self.flood_manager.cal_horizontal_force(object=self.objects[idx],
-                                                                           source=self.flood_manager.source_position)
-                floor_flood_commands.append({"$type": "apply_force_to_object",
-                                             "id": status.idx,
-                                             "force": {"x": horizontal_force["x"],
-                                                       "y": buoyancy_scale + horizontal_force["y"],
-                                                       "z": horizontal_force["z"]}})
-            else:
-                floor_flood_commands.append({"$type": "apply_force_to_object",
-                                             "id": status.idx,
-                                             "force": {"x": 0,
-                                                       "y": buoyancy_scale,
-                                                       "z": 0}})
-        # print(counter)
-        self.commands.extend([{"$type": "send_bounds"}, {"$type": "send_transforms"}])
+        if len(self.objects) > 0:
+            floor_flood_commands.extend(self.flood_physics())
         self.commands.extend(floor_flood_commands)
 
+    def flood_physics(self) -> List[dict]:
+        """
+        Water state, buoyancy and drag of every object in one vectorized pass over the columns.
+        Returns the apply_force_to_object commands.
+        """
+        ids = self.objects.id_array()
+        process = np.array([obj.name != "Agent" for obj in self.objects.views], dtype=bool)
+        if self.lod.enabled:
+            due, _ = self.lod.schedule(ids.tolist(), self.flood_tiers())
+            if self.lod.validate:
+                # skipped objects are out of the water and stay there: no state change and zero force
+                heights, _ = self.flood_manager.physics_step(*self.physics_columns(np.flatnonzero(process & ~due)))
+                self.lod.record("height_under_water", heights, int((heights > 0).sum()))
+            process &= due
+        rows = np.flatnonzero(process)
+        heights, forces = self.flood_manager.physics_step(*self.physics_columns(rows))
+        state = self.objects.column("state")
+        state[rows] = water_states(state[rows], self.objects.column("waterproof")[rows],
+                                   self.objects.column("has_buoyancy")[rows], heights > 0)
+        self.objects.column("prev_height_under_water")[rows] = heights
+        flooded = (state[rows] == ObjectState.FLOODED.value) | (state[rows] == ObjectState.FLOODED_FLOATING.value)
+        floating = (state[rows] == ObjectState.FLOATING.value) | (state[rows] == ObjectState.FLOODED_FLOATING.value)
+        self.objects_flooded = set(ids[rows[flooded]].tolist())
+        self.objects_floating = set(ids[rows[floating]].tolist())
+        return self.force_emitter.emit(ids[rows], forces)
+
+    def physics_columns(self, rows: np.ndarray):
+        return (self.objects.column("position")[rows], self.objects.column("size")[rows],
+                self.objects.column("velocity")[rows], self.objects.valid_mask("velocity")[rows])
+
     def reset(self):
-        self.objects = dict()
+        self.objects = ObjectTable(ObjectStatus)
+        self.spatial.reset(self.objects)
         self.objects_floating = set()
         self.objects_flooded = set()
         self.flood_manager.reset()
-        self.recover_command_list = []
+        self.surface_renderer.reset()
         self.commands = []
+        self.bounds_cache.reset()
+        self.lod.reset()
+        self.force_emitter.reset()
         self.update_visual_effects()
         self.initialized = False
         self.id_renumbering = dict()
@@ -134,78 +120,83 @@ class FloodObjectManager(AddOn):
                 {"$type": "send_rigidbodies"}]
 
     def on_send(self, resp: List[bytes]) -> None:
-        for i in range(len(resp) - 1):
-            r_id = OutputData.get_data_type_id(resp[i])
+        with self.router.timed(type(self).__name__):
+            self.process_output(resp)
+
+    def process_output(self, resp: List[bytes]) -> None:
+        transforms = None
+        bounds_ids = None
+        for r_id, b in self.router.select(resp, ("tran", "boun", "repl", "rigi")):
             if r_id == "tran":
-                tran = Transforms(resp[i])
-                for j in range(tran.get_num()):
-                    idx = tran.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].position = tran.get_position(j)
-                        self.objects[idx].rotation = tran.get_rotation(j)
-                    else:
-                        print("Warning: object with id {} not found in FloodObjectManager".format(idx))
-                        self.add_object(ObjectStatus(idx, position=tran.get_position(j)))
+                ids, positions, rotations = decode_transforms(b)
+                transforms = (ids, rotations)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("position", rows[found], positions[found])
+                self.objects.write("rotation", rows[found], rotations[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in FloodObjectManager".format(idx))
+                    self.add_object(ObjectStatus(idx, position=positions[j]))
             elif r_id == "boun":
-                boun = Bounds(resp[i])
-                for j in range(boun.get_num()):
-                    idx = boun.get_id(j)
-                    if idx in self.objects:
-                        concat = np.zeros([6, 3])
-                        concat[0] = boun.get_front(j)
-                        concat[1] = boun.get_back(j)
-                        concat[2] = boun.get_left(j)
-                        concat[3] = boun.get_right(j)
-                        concat[4] = boun.get_top(j)
-                        concat[5] = boun.get_bottom(j)
-                        self.objects[idx].size = np.max(concat, axis=0) - np.min(concat, axis=0)
-                        if self.objects[idx].size[0] < 0:
-                            print(boun.get_front(j), boun.get_back(j), boun.get_left(j), boun.get_right(j), boun.get_top(j), boun.get_bottom(j))
-                    else:
-                        print("Warning: object with id {} not found in FloodObjectManager".format(idx))
-                        self.add_object(ObjectStatus(idx, size=boun.get_front(j) + boun.get_right(j) + boun.get_top(
-                            j) - boun.get_back(j) - boun.get_left(j) - boun.get_bottom(j)))
-                        concat = np.zeros([6, 3])
-                        concat[0] = boun.get_front(j)
-                        concat[1] = boun.get_back(j)
-                        concat[2] = boun.get_left(j)
-                        concat[3] = boun.get_right(j)
-                        concat[4] = boun.get_top(j)
-                        concat[5] = boun.get_bottom(j)
-                        self.objects[idx].size = np.max(concat, axis=0) - np.min(concat, axis=0)
-                        if self.objects[idx].size[0] < 0:
-                            print(boun.get_front(j), boun.get_back(j), boun.get_left(j), boun.get_right(j), boun.get_top(j), boun.get_bottom(j))
+                ids, sizes = decode_bounds(b)
+                bounds_ids = ids
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("size", rows[found], sizes[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in FloodObjectManager".format(idx))
+                    self.add_object(ObjectStatus(idx, size=sizes[j]))
             elif r_id == "repl":
-                repl = Replicants(resp[i])
-                for j in range(repl.get_num()):
-                    idx = repl.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].position = repl.get_position(j)
-                    else:
-                        print("Warning: object with id {} not found in FloodObjectManager".format(idx))
+                ids, positions = decode_replicants(b)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("position", rows[found], positions[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in FloodObjectManager".format(idx))
             elif r_id == "rigi":
-                rigi = Rigidbodies(resp[i])
-                for j in range(rigi.get_num()):
-                    idx = rigi.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].velocity = rigi.get_velocity(j)
-                    else:
-                        print("Warning: object with id {} not found in FloodObjectManager".format(idx))
-                        self.add_object(ObjectStatus(idx, velocity=rigi.get_velocity(j)))
-        for i in range(len(resp)-1):
-            r_id = OutputData.get_data_type_id(resp[i])
+                ids, velocities, _ = decode_rigidbodies(b)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("velocity", rows[found], velocities[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in FloodObjectManager".format(idx))
+                    self.add_object(ObjectStatus(idx, velocity=velocities[j]))
+        self.bounds_cache.on_send(self.objects, transforms=transforms, bounds_ids=bounds_ids)
+        for r_id, b in self.router.select(resp, ("segm", "rseg")):
             if r_id == "segm":
-                segm = SegmentationColors(resp[i])
+                segm = SegmentationColors(b)
                 self.segm.process(segm, id_renumbering=self.id_renumbering)
             elif r_id == "rseg":
-                segm = ReplicantSegmentationColors(resp[i])
+                segm = ReplicantSegmentationColors(b)
                 self.segm.process(segm, id_renumbering=self.id_renumbering)
         self.update_visual_effects()
 
+    def flood_tiers(self) -> np.ndarray:
+        """
+        Update tiers in row order: by height above the water surface, objects that are wet or floating are always active.
+        """
+        positions = self.objects.column("position").astype(np.float64)
+        distances = positions[:, 1] - self.flood_manager.surface_heights(positions)
+        active = self.objects.column("state") != ObjectState.NORMAL.value
+        active |= ~self.objects.valid_mask("position") | ~self.objects.valid_mask("size")
+        return self.lod.classify(positions, distances, active)
+
+    def lod_report(self):
+        """
+        Objects per update tier on the last frame and, with lod_validate, what the skipped updates would have done.
+        """
+        return dict(tiers=self.lod.stats(), validation=self.lod.validation_report())
+
     def query_height_diff(self, position):
         # TODO different height diff
         return self.flood_manager.height_diff
 
+    def mark_bounds_dirty(self, ids: List[int]):
+        """
+        Request the bounds of these objects on the next frame, e.g. after grasping or teleporting them.
+        """
+        self.bounds_cache.mark_dirty(ids)
+
     def add_object(self, obj: ObjectStatus):
         self.objects[obj.idx] = obj
         if obj.idx not in self.id_renumbering:
@@ -218,6 +209,7 @@ class FloodObjectManager(AddOn):
     def remove_object(self, idx: int):
         if idx in self.objects:
             del self.objects[idx]
+        self.lod.forget(idx)
 
     def query_point_underwater(self, point: np.ndarray) -> float:
         return self.flood_manager.query_point_underwater(point)
@@ -225,18 +217,14 @@ class FloodObjectManager(AddOn):
     def query_point_flood_height(self, point: np.ndarray) -> float:
         return self.flood_manager.query_point_flood_height(point)
 
+    def query_points_flood_height(self, points: np.ndarray, frame=None) -> np.ndarray:
+        """
+        Flood height above many points at once, at the current frame or at any frame of the flood schedule.
+        """
+        return self.flood_manager.flood_height(points, frame)
+
     def find_nearest_object(self, pos: np.ndarray, objects: Optional[List[int]] = None):
-        min_dist = 1e10
-        min_idx = None
-        it = iter(self.objects) if objects is None else iter(objects)
-        for idx in it:
-            if self.objects[idx].name != "Object":
-                continue
-            dist = np.linalg.norm(self.objects[idx].position - pos)
-            if dist < min_dist:
-                min_dist = dist
-                min_idx = idx
-        return min_idx
+        return self.spatial.nearest(pos, ids=objects)
     
     def prepare_segmentation_data(self):
         self.commands.extend([{"$type": "send_segmentation_colors"},
@@ -4,15 +4,37 @@ from .utils import *
 import numpy as np
 import math
 from tdw.scene_data.scene_bounds import SceneBounds
+from tdw.quaternion_utils import QuaternionUtils
 import random
+from src.HAZARD.utils.object_table import Column, TableRow, ObjectTable
 
 
-class ObjectStatus:
+# offsets of the box anchors relative to (position, size), see ObjectStatus.top() etc.
+CENTER = np.array([0, 0.5, 0])
+TOP = np.array([1, 1, 1])
+LEFT = np.array([-0.5, 0.5, 0])
+RIGHT = np.array([0.5, 0.5, 0])
+FRONT = np.array([0, 0.5, 0.5])
+BACK = np.array([0, 0.5, -0.5])
+
+
+class ObjectStatus(TableRow):
+    __slots__ = ("idx", "constants", "name")
+    state = Column(np.int8, enum=ObjectState)
+    waterproof = Column(bool)
+    has_buoyancy = Column(bool)
+    prev_height_under_water = Column(np.float64)
+    position = Column(np.float32, (3,))
+    rotation = Column(np.float32, (4,))
+    size = Column(np.float32, (3,))
+    velocity = Column(np.float32, (3,))
+
     def __init__(self, idx, constants: Constants = default_const,
                  waterproof: bool = False, has_buoyancy: bool = False, state: int = None,
                  position: np.ndarray = None, rotation: np.ndarray = None,
                  size: np.ndarray = None,
                  velocity: np.ndarray = np.array([0, 0, 0])):
+        super().__init__()
         self.idx: int = idx
         self.waterproof: bool = waterproof
         self.has_buoyancy: bool = has_buoyancy
@@ -43,33 +65,47 @@ class ObjectStatus:
             self.state = ObjectState.NORMAL
 
     def center(self):
-        return self.position + self.size * np.array([0, 0.5, 0])
+        return self.vector("position") + self.vector("size") * CENTER
 
     def bottom(self):
         return self.position
 
     def top(self):
-        return self.position + self.size * np.array([1, 1, 1])
+        return self.vector("position") + self.vector("size") * TOP
 
     def left(self):
-        return self.position + self.size * np.array([-0.5, 0.5, 0])
+        return self.vector("position") + self.vector("size") * LEFT
 
     def right(self):
-        return self.position + self.size * np.array([0.5, 0.5, 0])
+        return self.vector("position") + self.vector("size") * RIGHT
 
     def front(self):
-        return self.position + self.size * np.array([0, 0.5, 0.5])
+        return self.vector("position") + self.vector("size") * FRONT
 
     def back(self):
-        return self.position + self.size * np.array([0, 0.5, -0.5])
+        return self.vector("position") + self.vector("size") * BACK
 
     def area(self):
-        return self.size[0] * self.size[2]
+        size = self.vector("size")
+        return size[0] * size[2]
 
     def horizontal_area(self):
-        return self.size[1] * self.size[2]
+        size = self.vector("size")
+        return size[1] * size[2]
+
+def water_states(state: np.ndarray, waterproof: np.ndarray, has_buoyancy: np.ndarray, in_water: np.ndarray) -> np.ndarray:
+    """
+    ObjectStatus.in_water / out_of_water for arrays of state values.
+    """
+    wet = np.where(waterproof, np.where(has_buoyancy, ObjectState.FLOATING.value, ObjectState.NORMAL.value),
+                   np.where(has_buoyancy, ObjectState.FLOODED_FLOATING.value, ObjectState.FLOODED.value))
+    dry = state.copy()
+    dry[state == ObjectState.FLOODED_FLOATING.value] = ObjectState.FLOODED.value
+    dry[state == ObjectState.FLOATING.value] = ObjectState.NORMAL.value
+    return np.where(in_water, np.where(state == ObjectState.NORMAL.value, wet, state), dry).astype(state.dtype)
 
 class AgentStatus(ObjectStatus):
+    __slots__ = ()
     def __init__(self, idx, position, size, constants=default_const):
         super().__init__(idx, constants=constants, waterproof = True, has_buoyancy = False,
                          state=ObjectState.NORMAL, position = position, size=size)
@@ -116,13 +152,29 @@ class FloodManager:
         self.source_height = 0
         self.ascending_counter = 0
         self.height_diff = 0
+        self.tan_roll = math.tan(abs(roll_theta / 180) * math.pi)
+        self.schedule: Optional[FloodSchedule] = None
+        self.frame = 0 # number of evolve calls since make_schedule
         self.flood_density = flood_density
         self.drag_coefficient = drag_coefficient
         self.flood_force_scale = flood_force_scale
 
     def reset(self):
         self.roll_theta = self.original_roll_theta
+        self.old_roll_theta = 0
+        self.tan_roll = math.tan(abs(self.roll_theta / 180) * math.pi)
         self.source_height = 0
+        self.ascending_counter = 0
+        self.height_diff = 0
+        # the floors of the next scene are added again by add_floor_flood
+        self.floor_ids = []
+        self.floor_positions = []
+        self.floor_sizes = []
+        self.floor_directions = []
+        self.floor_flood_angles = []
+        self.floor_flood_heights = []
+        self.schedule = None
+        self.frame = 0
 
     def add_floor_flood(self, id, position, scale, direction):
         self.floor_ids.append(id)
@@ -140,7 +192,7 @@ class FloodManager:
             floor_position_for_calculation = self.floor_positions[i]["x"] if self.source_from in ['x_max', 'x_min'] \
                                                     else self.floor_positions[i]["z"]
             distance_to_source = abs(self.source_location_for_calculation - floor_position_for_calculation)
-            height_diff_to_source = math.tan(abs(self.roll_theta/180)*math.pi) * distance_to_source
+            height_diff_to_source = self.tan_roll * distance_to_source
             self.floor_positions[i]["y"] = self.source_height - height_diff_to_source
             flood_effect_dict[self.floor_ids[i]]["positions"] = {
                 "x": self.floor_positions[i]["x"],
@@ -202,37 +254,104 @@ class FloodManager:
         self.old_roll_theta = self.roll_theta
         return flood_effect_dict
 
-    def evolve(self):
-        self.ascending_counter += 1
-        self.height_diff = 0
-        if self.ascending_counter % self.ascending_interval == 0:
-            self.ascending_counter = 0
-            self.height_diff += (self.ascending_speed * random.random() * 2.0)
-            self.source_height += self.ascending_speed
-            if self.source_height >= self.max_height:
-                self.height_diff -= (self.source_height - self.max_height)
-                self.source_height = self.max_height
-                if self.roll_theta > 0:
-                    old_length = self.source_height / math.tan(abs(self.roll_theta / 180) * math.pi)
+    def advance(self, source_height: float, roll_theta: float, ascending_counter: int, rand=random):
+        """
+        One frame of the water level. rand provides random() for height_diff.
+        Returns the new source_height, roll_theta, ascending_counter and height_diff.
+        """
+        ascending_counter += 1
+        height_diff = 0
+        if ascending_counter % self.ascending_interval == 0:
+            ascending_counter = 0
+            height_diff += (self.ascending_speed * rand.random() * 2.0)
+            source_height += self.ascending_speed
+            if source_height >= self.max_height:
+                height_diff -= (source_height - self.max_height)
+                source_height = self.max_height
+                if roll_theta > 0:
+                    old_length = source_height / math.tan(abs(roll_theta / 180) * math.pi)
                     new_length = old_length + self.fluid_velocity * self.ascending_interval
-                    self.roll_theta = math.atan(self.source_height / new_length) * 180 / math.pi
-                elif self.roll_theta < 0:
-                    old_length = self.source_height / math.tan(abs(self.roll_theta / 180) * math.pi)
+                    roll_theta = math.atan(source_height / new_length) * 180 / math.pi
+                elif roll_theta < 0:
+                    old_length = source_height / math.tan(abs(roll_theta / 180) * math.pi)
                     new_length = old_length + self.fluid_velocity * self.ascending_interval
-                    self.roll_theta = -math.atan(self.source_height / new_length) * 180 / math.pi
+                    roll_theta = -math.atan(source_height / new_length) * 180 / math.pi
+        return source_height, roll_theta, ascending_counter, height_diff
+
+    def evolve(self):
+        if self.schedule is not None:
+            self.frame += 1
+            self.source_height, self.roll_theta, self.height_diff = self.schedule.state(self.frame)
+        else:
+            self.source_height, self.roll_theta, self.ascending_counter, self.height_diff = \
+                self.advance(self.source_height, self.roll_theta, self.ascending_counter)
+        self.tan_roll = math.tan(abs(self.roll_theta / 180) * math.pi)
         return self.get_updated_flood_angles_and_heights()
 
+    def make_schedule(self, seed: int = 0, num_frames: int = 3000):
+        """
+        Precompute the water level of the episode from the current state, evolve then reads it frame by frame.
+        """
+        self.schedule = FloodSchedule(self, seed=seed, num_frames=num_frames)
+        self.frame = 0
+
+    def flood_height(self, points: np.ndarray, frame=None) -> np.ndarray:
+        """
+        Water height (at least 0) above each of the (N, 3) points, as in query_point_flood_height.
+        frame: a frame of the schedule (scalar or (N,)), past or future, None for the current water level.
+        Frames need a schedule, see make_schedule.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if frame is None:
+            source_height, tan_roll = self.source_height, self.tan_roll
+        else:
+            if self.schedule is None:
+                # making one here would change how evolve draws height_diff
+                raise RuntimeError("flood_height(frame=...) needs a schedule, call make_schedule first")
+            source_height, tan_roll = self.schedule.level(frame)
+        axis = 0 if self.source_from in ['x_max', 'x_min'] else 2
+        distance_to_source = np.abs(self.source_location_for_calculation - points[:, axis])
+        return np.maximum(source_height - tan_roll * distance_to_source, 0)
+
     def query_point_underwater(self, point: np.ndarray):
         floor_position_for_calculation = point[0] if self.source_from in ['x_max', 'x_min'] else point[2]
         distance_to_source = abs(self.source_location_for_calculation - floor_position_for_calculation)
-        height_diff_to_source = math.tan(abs(self.roll_theta / 180) * math.pi) * distance_to_source
+        height_diff_to_source = self.tan_roll * distance_to_source
         flood_height = self.source_height - height_diff_to_source
         return point[1] <= flood_height
 
+    def surface_heights(self, points: np.ndarray) -> np.ndarray:
+        """
+        Unclipped water surface height above each of the (N, 3) points, as in query_height_beneath_water.
+        """
+        axis = 0 if self.source_from in ['x_max', 'x_min'] else 2
+        distance_to_source = np.abs(self.source_location_for_calculation - points[:, axis])
+        return self.source_height - self.tan_roll * distance_to_source
+
+    def physics_step(self, positions: np.ndarray, sizes: np.ndarray, velocities: np.ndarray,
+                     has_velocity: np.ndarray):
+        """
+        update_object_status_new and cal_horizontal_force for N objects at once.
+        positions, sizes, velocities: (N, 3), has_velocity: (N,) objects without a velocity get no drag.
+        Returns the submerged heights (N,) and the forces, buoyancy plus drag (N, 3).
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        sizes = np.asarray(sizes, dtype=np.float64)
+        bottom = np.minimum(positions[:, 1], positions[:, 1] + sizes[:, 1])
+        heights = np.maximum(np.minimum(self.surface_heights(positions) - bottom, sizes[:, 1]), 0)
+        forces = np.zeros((len(positions), 3))
+        forces[:, 1] = 4.0 * self.flood_density / 1000 * heights * np.abs(sizes[:, 0] * sizes[:, 2]) * 9.81
+        drag = (heights > 0) & has_velocity
+        fluid_velocity = np.array([-self.fluid_velocity * self.drag_coefficient, 0, 0])
+        velocity_diff = fluid_velocity - np.asarray(velocities, dtype=np.float64)[drag]
+        # drag_force_scale * drag_force_direction, the scale is proportional to |velocity_diff|
+        forces[drag] += 2.0 * self.flood_density / 1000 * np.abs(sizes[drag, 1] * sizes[drag, 2])[:, None] * velocity_diff
+        return heights, forces
+
     def query_height_beneath_water(self, object: ObjectStatus):
         floor_position_for_calculation = object.bottom()[0] if self.source_from in ['x_max', 'x_min'] else object.bottom()[2]
         distance_to_source = abs(self.source_location_for_calculation - floor_position_for_calculation)
-        height_diff_to_source = math.tan(abs(self.roll_theta / 180) * math.pi) * distance_to_source
+        height_diff_to_source = self.tan_roll * distance_to_source
         flood_height = self.source_height - height_diff_to_source
         return max(min(flood_height - min(object.bottom()[1], object.top()[1]), object.size[1]), 0)
 
@@ -329,6 +448,119 @@ class FloodManager:
     def query_point_flood_height(self, target: np.ndarray):
         floor_position_for_calculation = target[0] if self.source_from in ['x_max', 'x_min'] else target[2]
         distance_to_source = abs(self.source_location_for_calculation - floor_position_for_calculation)
-        height_diff_to_source = math.tan(abs(self.roll_theta / 180) * math.pi) * distance_to_source
+        height_diff_to_source = self.tan_roll * distance_to_source
         flood_height = max(self.source_height - height_diff_to_source, 0)
         return flood_height
+
+
+class FloodSchedule:
+    """
+    FloodManager.evolve computed ahead of time: source_height, roll_theta and tan(roll_theta) after every frame.
+    The only random part, height_diff, comes from a seeded random.Random, so the schedule is reproducible.
+    Frame 0 is the state the schedule was made from, frame k the state after k calls of evolve.
+    Frames past the end are computed on demand.
+    """
+    def __init__(self, flood_manager: FloodManager, seed: int = 0, num_frames: int = 3000):
+        self.flood_manager = flood_manager
+        self.random = random.Random(seed)
+        self.source_heights = [flood_manager.source_height]
+        self.roll_thetas = [flood_manager.roll_theta]
+        self.height_diffs = [flood_manager.height_diff]
+        self.ascending_counter = flood_manager.ascending_counter
+        self.arrays = None # (source heights, tan of roll_theta) as numpy arrays, for vectorized lookups
+        self.extend(num_frames)
+
+    def __len__(self):
+        return len(self.source_heights)
+
+    def extend(self, frame: int):
+        """
+        Make sure frames up to and including frame are computed.
+        """
+        while len(self.source_heights) <= frame:
+            source_height, roll_theta, self.ascending_counter, height_diff = self.flood_manager.advance(
+                self.source_heights[-1], self.roll_thetas[-1], self.ascending_counter, self.random)
+            self.source_heights.append(source_height)
+            self.roll_thetas.append(roll_theta)
+            self.height_diffs.append(height_diff)
+            self.arrays = None
+
+    def state(self, frame: int):
+        """
+        source_height, roll_theta, height_diff after the given frame.
+        """
+        self.extend(frame)
+        return self.source_heights[frame], self.roll_thetas[frame], self.height_diffs[frame]
+
+    def level(self, frame):
+        """
+        source_height and tan(roll_theta) of a frame, or of an array of frames.
+        """
+        self.extend(int(np.max(frame)))
+        if self.arrays is None:
+            self.arrays = (np.array(self.source_heights), np.tan(np.abs(np.array(self.roll_thetas) / 180) * np.pi))
+        return self.arrays[0][frame], self.arrays[1][frame]
+
+
+class FloodSurfaceRenderer:
+    """
+    Holds the water plane of every floor at the pose computed by FloodManager.evolve, sending absolute
+    rotations and positions only when they moved by more than the tolerances.
+    scale_visual_effect only takes a factor, so the factors of FloodManager are accumulated and
+    only the part that was not sent yet is sent.
+    """
+    AXES = {"yaw": np.array([0, 1, 0]), "pitch": np.array([1, 0, 0]), "roll": np.array([0, 0, 1])}
+
+    def __init__(self, angle_tolerance: float = 1e-3, position_tolerance: float = 1e-4, scale_tolerance: float = 1e-4):
+        self.angle_tolerance = angle_tolerance
+        self.position_tolerance = position_tolerance
+        self.scale_tolerance = scale_tolerance
+        self.reset()
+
+    def reset(self):
+        self.angles: Dict[int, np.ndarray] = dict() # floor id -> last (yaw, pitch, roll) sent
+        self.positions: Dict[int, np.ndarray] = dict() # floor id -> last position sent
+        self.scales: Dict[int, np.ndarray] = dict() # floor id -> product of all scale factors of FloodManager
+        self.sent_scales: Dict[int, np.ndarray] = dict() # floor id -> product of the scale factors sent
+        self.sent = 0
+
+    def rotation(self, direction: dict, angles: np.ndarray) -> dict:
+        """
+        The initial rotation of the effect, rotated around the world axes by the angles (degrees).
+        """
+        q = QuaternionUtils.euler_angles_to_quaternion(np.array([direction["x"], direction["y"], direction["z"]]))
+        for axis, angle in zip(self.AXES.values(), angles):
+            if angle != 0:
+                half = math.radians(angle) / 2
+                q = QuaternionUtils.multiply(np.append(axis * math.sin(half), math.cos(half)), q)
+        return {"x": float(q[0]), "y": float(q[1]), "z": float(q[2]), "w": float(q[3])}
+
+    def commands(self, flood_effect_dict: dict, directions: Dict[int, dict]) -> List[dict]:
+        """
+        flood_effect_dict: the result of FloodManager.evolve, directions: floor id -> rotation the effect was added with.
+        """
+        commands = []
+        for floor_id, effect in flood_effect_dict.items():
+            # only positive angles were ever applied to the water planes
+            angles = np.array([max(effect["angles"][axis], 0) for axis in self.AXES])
+            if floor_id not in self.angles or np.abs(angles - self.angles[floor_id]).max() > self.angle_tolerance:
+                self.angles[floor_id] = angles
+                commands.append({"$type": "rotate_visual_effect_to",
+                                 "rotation": self.rotation(directions[floor_id], angles),
+                                 "id": floor_id})
+            scale = self.scales.get(floor_id, np.ones(3)) * np.array([effect["scales"][axis] for axis in "xyz"])
+            self.scales[floor_id] = scale
+            factor = scale / self.sent_scales.get(floor_id, np.ones(3))
+            if np.abs(factor - 1).max() > self.scale_tolerance:
+                self.sent_scales[floor_id] = scale
+                commands.append({"$type": "scale_visual_effect",
+                                 "scale_factor": {"x": float(factor[0]), "y": float(factor[1]), "z": float(factor[2])},
+                                 "id": floor_id})
+            position = np.array([effect["positions"][axis] for axis in "xyz"], dtype=np.float64)
+            if floor_id not in self.positions or np.abs(position - self.positions[floor_id]).max() > self.position_tolerance:
+                self.positions[floor_id] = position
+                commands.append({"$type": "teleport_visual_effect",
+                                 "position": {"x": float(position[0]), "y": float(position[1]), "z": float(position[2])},
+                                 "id": floor_id})
+        self.sent = len(commands)
+        return commands
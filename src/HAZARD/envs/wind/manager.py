@@ -2,31 +2,57 @@ from tdw.add_ons.add_on import AddOn
 from .object import *
 from tdw.output_data import OutputData, Transforms, Bounds, Rigidbodies
 from tdw.output_data import Replicants, SegmentationColors, ReplicantSegmentationColors
-from typing import Dict, List
+from typing import Dict, List, Optional, Set
 import numpy as np
 from src.HAZARD.utils.seg_id import SegmentationID
+from src.HAZARD.utils.output_decoder import decode_transforms, decode_bounds, decode_rigidbodies, decode_replicants
+from src.HAZARD.utils.bounds_cache import BoundsCache
+from src.HAZARD.utils.response_router import ResponseRouter
+from src.HAZARD.utils.lod import LODScheduler
+from src.HAZARD.utils.force_emitter import ForceEmitter
+from src.HAZARD.utils.containment_index import ContainmentIndex
+from src.HAZARD.utils.sleep_tracker import SleepTracker
+from src.HAZARD.utils.spatial_query import SpatialQuery
 
 """
 Add-on to manage the objects.
 """
 
 class WindObjectManager(AddOn):
-    def __init__(self, constants=default_const):
+    def __init__(self, constants=default_const, bounds_refresh_interval: int = 100,
+                 router: Optional[ResponseRouter] = None, lod: bool = False, sleep: bool = False):
         super().__init__()
         self.constants = constants
-        self.objects: Dict[int, ObjectStatus] = dict()
+        self.objects: Dict[int, ObjectStatus] = ObjectTable(ObjectStatus)
+        # nearest object queries on a lazily rebuilt grid
+        self.spatial = SpatialQuery(self.objects)
         self.wind_force_manager = WindForceManager()
         self.effects = dict()
+        self.effect_arrays = (np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros((0, 3))) # ids, forces, torques
         self.settled = set()
         self.wind_v: np.ndarray = np.array([0, 0, 0])
         self.num_frame = 0
         self.segm = SegmentationID()
         self.id_renumbering = dict()
         self.id_list = [0]
+        self.bounds_cache = BoundsCache(refresh_interval=bounds_refresh_interval)
+        # shared with the controller, which classifies the output data once per frame
+        self.router = router if router is not None else ResponseRouter()
+        # wind reaches every object, so the level of detail only retires objects parked far away
+        self.lod = LODScheduler(active_distance=np.inf, near_distance=np.inf, enabled=lod)
+        self.retired: Set[int] = set()
+        # no wind, or objects too heavy for it, give zero forces, which are not sent
+        self.force_emitter = ForceEmitter()
+        self.containment = ContainmentIndex()
+        # objects at rest in the wind for a while do not get their force every frame
+        self.sleep = SleepTracker(enabled=sleep)
+        self.asleep: Set[int] = set()
     
     def reset(self):
-        self.objects = dict()
+        self.objects = ObjectTable(ObjectStatus)
+        self.spatial.reset(self.objects)
         self.effects = dict()
+        self.effect_arrays = (np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros((0, 3)))
         self.settled = set()
         self.num_frame = 0
         self.wind_v = np.array([0, 0, 0])
@@ -34,6 +60,13 @@ class WindObjectManager(AddOn):
         self.initialized = False
         self.id_renumbering = dict()
         self.id_list = [0]
+        self.bounds_cache.reset()
+        self.lod.reset()
+        self.retired = set()
+        self.force_emitter.reset()
+        self.containment.reset()
+        self.sleep.reset()
+        self.asleep = set()
     
     def get_initialization_commands(self) -> List[dict]:
         return [{"$type": "send_bounds"},
@@ -41,90 +74,89 @@ class WindObjectManager(AddOn):
                 {"$type": "send_rigidbodies"}]
     
     def on_send(self, resp: List[bytes]) -> None:
-        for i in range(len(resp)-1):
-            r_id = OutputData.get_data_type_id(resp[i])
+        with self.router.timed(type(self).__name__):
+            self.process_output(resp)
+
+    def process_output(self, resp: List[bytes]) -> None:
+        transforms = None
+        bounds_ids = None
+        for r_id, b in self.router.select(resp, ("tran", "boun", "repl", "rigi")):
             if r_id == "tran":
-                tran = Transforms(resp[i])
-                for j in range(tran.get_num()):
-                    idx = tran.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].position = tran.get_position(j)
-                        self.objects[idx].rotation = tran.get_rotation(j)
-                    else:
-                        print("Warning: object with id {} not found in WindObjectManager".format(idx))
-                        self.add_object(ObjectStatus(idx, position=tran.get_position(j)))
+                ids, positions, rotations = decode_transforms(b)
+                transforms = (ids, rotations)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("position", rows[found], positions[found])
+                self.objects.write("rotation", rows[found], rotations[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in WindObjectManager".format(idx))
+                    self.add_object(ObjectStatus(idx, position=positions[j]))
             elif r_id == "boun":
-                boun = Bounds(resp[i])
-                for j in range(boun.get_num()):
-                    idx = boun.get_id(j)
-                    if idx in self.objects:
-                        concat = np.zeros([6, 3])
-                        concat[0] = boun.get_front(j)
-                        concat[1] = boun.get_back(j)
-                        concat[2] = boun.get_left(j)
-                        concat[3] = boun.get_right(j)
-                        concat[4] = boun.get_top(j)
-                        concat[5] = boun.get_bottom(j)
-                        self.objects[idx].size = np.max(concat, axis=0) - np.min(concat, axis=0)
-                        if self.objects[idx].size[0] < 0:
-                            print(boun.get_front(j), boun.get_back(j), boun.get_left(j), boun.get_right(j), boun.get_top(j), boun.get_bottom(j))
-                    else:
-                        print("Warning: object with id {} not found in WindObjectManager".format(idx))
-                        self.add_object(ObjectStatus(idx, size=boun.get_front(j) + boun.get_right(j) + boun.get_top(j) - boun.get_back(j) - boun.get_left(j) - boun.get_bottom(j)))
-                        concat = np.zeros([6, 3])
-                        concat[0] = boun.get_front(j)
-                        concat[1] = boun.get_back(j)
-                        concat[2] = boun.get_left(j)
-                        concat[3] = boun.get_right(j)
-                        concat[4] = boun.get_top(j)
-                        concat[5] = boun.get_bottom(j)
-                        self.objects[idx].size = np.max(concat, axis=0) - np.min(concat, axis=0)
-                        if self.objects[idx].size[0] < 0:
-                            print(boun.get_front(j), boun.get_back(j), boun.get_left(j), boun.get_right(j), boun.get_top(j), boun.get_bottom(j))
+                ids, sizes = decode_bounds(b)
+                bounds_ids = ids
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("size", rows[found], sizes[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in WindObjectManager".format(idx))
+                    self.add_object(ObjectStatus(idx, size=sizes[j]))
             elif r_id == "repl":
-                repl = Replicants(resp[i])
-                for j in range(repl.get_num()):
-                    idx = repl.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].position = repl.get_position(j)
-                    else:
-                        print("Warning: object with id {} not found in WindObjectManager".format(idx))
-                        self.add_object(AgentStatus(idx, position=repl.get_position(j)))
+                ids, positions = decode_replicants(b)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("position", rows[found], positions[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in WindObjectManager".format(idx))
+                    self.add_object(AgentStatus(idx, position=positions[j]))
             elif r_id == "rigi":
-                rigi = Rigidbodies(resp[i])
-                for j in range(rigi.get_num()):
-                    idx = rigi.get_id(j)
-                    if idx in self.objects:
-                        self.objects[idx].velocity = rigi.get_velocity(j)
-                    else:
-                        print("Warning: object with id {} not found in WindObjectManager".format(idx))
-                        self.add_object(ObjectStatus(idx, velocity=rigi.get_velocity(j)))
-        for i in range(len(resp)-1):
-            r_id = OutputData.get_data_type_id(resp[i])
+                ids, velocities, sleeping = decode_rigidbodies(b)
+                rows, found = self.objects.lookup(ids)
+                self.objects.write("velocity", rows[found], velocities[found])
+                self.objects.write("sleeping", rows[found], sleeping[found])
+                for j in np.flatnonzero(~found):
+                    idx = int(ids[j])
+                    print("Warning: object with id {} not found in WindObjectManager".format(idx))
+                    self.add_object(ObjectStatus(idx, velocity=velocities[j]))
+        self.bounds_cache.on_send(self.objects, transforms=transforms, bounds_ids=bounds_ids)
+        for r_id, b in self.router.select(resp, ("segm", "rseg")):
             if r_id == "segm":
-                segm = SegmentationColors(resp[i])
+                segm = SegmentationColors(b)
                 self.segm.process(segm, id_renumbering=self.id_renumbering)
             elif r_id == "rseg":
-                segm = ReplicantSegmentationColors(resp[i])
+                segm = ReplicantSegmentationColors(b)
                 self.segm.process(segm, id_renumbering=self.id_renumbering)
-        self.effects = self.wind_force_manager.evolve(self.objects, self.wind_v, self.settled)
-        self.commands = [{"$type": "send_bounds"}, {"$type": "send_transforms"}, {"$type": "send_rigidbodies"}]
+        if self.lod.enabled:
+            self.retired = self.retired_objects()
+        if self.sleep.enabled:
+            self.asleep = set(self.objects.id_array()[self.sleep.update(self.objects, self.wind_v)].tolist())
+        self.effect_arrays = self.wind_force_manager.evolve_table(self.objects, self.wind_v, self.settled,
+                                                                  self.retired | self.asleep)
+        ids, forces, torques = self.effect_arrays
+        self.effects = dict(zip(ids.tolist(), zip(forces, torques)))
+        self.commands = self.bounds_cache.commands() + [{"$type": "send_transforms"}, {"$type": "send_rigidbodies"}]
         self.num_frame += 1
         if np.linalg.norm(self.wind_v * [1, 0, 1]) > 0.1:
-            for idx in self.objects:
-                if idx in self.settled or self.objects[idx].position is None or self.objects[idx].size is None:
-                    continue
-                for idx2 in self.settled:
-                    if idx2 == idx or self.objects[idx2].position is None or self.objects[idx2].size is None:
-                        continue
-                    # extent of idx is fully covered by idx2
-                    l, r, f, b = self.objects[idx2].left()[0], self.objects[idx2].right()[0], self.objects[idx2].front()[2], self.objects[idx2].back()[2]
-                    x, y, z = self.objects[idx].position.tolist()
-                    bottom = self.objects[idx2].bottom()[1]
-                    top = self.objects[idx2].top()[1]
-                    if l <= x and x <= r and b <= z and z <= f and bottom <= y and y <= top:
-                        self.settled.add(idx)
-                        break
+            # objects inside a settled object are sheltered from the wind
+            self.settled.update(self.containment.update(self.objects, self.settled, self.retired))
+
+    def retired_objects(self) -> Set[int]:
+        positions = self.objects.column("position").astype(np.float64)
+        tiers = self.lod.classify(positions, np.zeros(len(positions)), ~self.objects.valid_mask("position"))
+        due, _ = self.lod.schedule(self.objects.id_array().tolist(), tiers)
+        return set(self.objects.id_array()[~due].tolist())
+
+    def sleep_report(self):
+        """
+        Objects asleep, with their force skipped, and woken up on the last frame.
+        """
+        return self.sleep.stats()
+
+    def mark_bounds_dirty(self, ids: List[int]):
+        """
+        Request the bounds of these objects on the next frame, e.g. after grasping or teleporting them.
+        """
+        self.bounds_cache.mark_dirty(ids)
+
     def add_object(self, obj: ObjectStatus):
         self.objects[obj.idx] = obj
         if obj.idx not in self.id_renumbering:
@@ -134,21 +166,11 @@ class WindObjectManager(AddOn):
     def remove_object(self, obj: ObjectStatus):
         if obj.idx in self.objects:
             del self.objects[obj.idx]
+        self.lod.forget(obj.idx)
     
     def find_nearest_object(self, pos: np.ndarray, objects: Optional[List[int]] = None):
-        min_dist = 1e10
-        min_idx = None
-        it = iter(self.objects) if objects is None else iter(objects)
-        for idx in it:
-            if self.objects[idx].name != "Object":
-                continue
-            if idx in self.settled and objects is None:
-                continue
-            dist = np.linalg.norm(self.objects[idx].position - pos)
-            if dist < min_dist:
-                min_dist = dist
-                min_idx = idx
-        return min_idx
+        exclude = self.settled if objects is None else None
+        return self.spatial.nearest(pos, ids=objects, exclude=exclude)
     
     def prepare_segmentation_data(self):
         self.commands.extend([{"$type": "send_segmentation_colors"},
@@ -1,11 +1,32 @@
 from typing import Dict, Set, Optional
 from .wind_utils import *
 import numpy as np
+from src.HAZARD.utils.object_table import Column, TableRow, ObjectTable
+
+# offsets of the box anchors relative to (position, size), see ObjectStatus.top() etc.
+CENTER = np.array([0, 0.5, 0])
+TOP = np.array([0, 1, 0])
+LEFT = np.array([-0.5, 0.5, 0])
+RIGHT = np.array([0.5, 0.5, 0])
+FRONT = np.array([0, 0.5, 0.5])
+BACK = np.array([0, 0.5, -0.5])
+
+class ObjectStatus(TableRow):
+    __slots__ = ("idx", "constants", "name")
+    position = Column(np.float32, (3,))
+    rotation = Column(np.float32, (4,))
+    size = Column(np.float32, (3,))
+    velocity = Column(np.float32, (3,))
+    resistence = Column(np.float64)
+    # see SleepTracker
+    sleeping = Column(np.bool_)
+    rest_frames = Column(np.int64)
+    asleep = Column(np.bool_)
 
-class ObjectStatus:
     def __init__(self, idx, constants: Constants=default_const,
                  mass=1.0, position: np.ndarray = None, rotation: np.ndarray = None,
                  size: np.ndarray = None, velocity: np.ndarray = None, resistence: int = 0):
+        super().__init__()
         self.idx: int = idx
         self.position: Optional[np.ndarray] = position
         self.rotation: Optional[np.ndarray] = rotation
@@ -13,25 +34,34 @@ class ObjectStatus:
         self.velocity: Optional[np.ndarray] = velocity
         self.constants: Constants = constants
         self.resistence: int = resistence
+        self.sleeping: bool = False
+        self.rest_frames: int = 0
+        self.asleep: bool = False
         self.name = "Object"
     
-    def center(self): return self.position + self.size * np.array([0, 0.5, 0])
+    def center(self): return self.vector("position") + self.vector("size") * CENTER
     def bottom(self): return self.position
-    def top(self): return self.position + self.size * np.array([0, 1, 0])
-    def left(self): return self.position + self.size * np.array([-0.5, 0.5, 0])
-    def right(self): return self.position + self.size * np.array([0.5, 0.5, 0])
-    def front(self): return self.position + self.size * np.array([0, 0.5, 0.5])
-    def back(self): return self.position + self.size * np.array([0, 0.5, -0.5])
+    def top(self): return self.vector("position") + self.vector("size") * TOP
+    def left(self): return self.vector("position") + self.vector("size") * LEFT
+    def right(self): return self.vector("position") + self.vector("size") * RIGHT
+    def front(self): return self.vector("position") + self.vector("size") * FRONT
+    def back(self): return self.vector("position") + self.vector("size") * BACK
     def area(self): return (self.top() - self.bottom()).sum() * (self.right() - self.left()).sum()
 
 class AgentStatus(ObjectStatus):
+    __slots__ = ()
     def __init__(self, idx, position, size=None, constants=default_const):
         super().__init__(idx, constants, position=position, size=size)
         self.name = "Agent"
 
 class WindForceManager:
-    def __init__(self, constants=default_const):
+    def __init__(self, constants=default_const, seed: Optional[int] = None):
         self.constants: Constants = constants
+        self.seed(seed)
+
+    def seed(self, seed: Optional[int]):
+        # all random wind forces come from this generator, seeded by the controller
+        self.rng = np.random.Generator(np.random.PCG64(seed))
     
     def calc_wind_effect(self, wind_velocity: np.ndarray, obj: ObjectStatus):
         """
@@ -48,21 +78,66 @@ class WindForceManager:
         
         f_tan = np.linalg.norm(v_effect) * v_effect * area * self.constants.AIR_DENSITY
         
-        rand_v = np.minimum(2, np.random.normal(0, self.constants.F_CROSS_SCALE, 3))
+        rand_v = np.minimum(2, self.rng.normal(0, self.constants.F_CROSS_SCALE, 3))
         f_cross = np.cross(f_tan, rand_v)
          
-        r = np.random.normal(0, 0.1, 3) * (obj.top() - obj.bottom()).sum() / 2
+        r = self.rng.normal(0, 0.1, 3) * (obj.top() - obj.bottom()).sum() / 2
         torque = np.cross(f_tan, r)
         # torque = np.zeros(3)
         
         f = f_tan + f_cross
         return f, torque
     
-    def evolve(self, objects: Dict[int, ObjectStatus], wind: np.ndarray, settled: Set[int]):
+    def wind_effects(self, wind_velocity: np.ndarray, sizes: np.ndarray, velocities: np.ndarray,
+                     resistence: np.ndarray):
+        """
+        calc_wind_effect for N objects at once.
+        sizes, velocities: (N, 3), resistence: (N,). Returns the forces and torques, (N, 3) each.
+        """
+        forces = np.zeros((len(sizes), 3))
+        torques = np.zeros((len(sizes), 3))
+        wind_velocity = np.asarray(wind_velocity, dtype=np.float64)
+        if np.dot(wind_velocity, wind_velocity) < 1e-6:
+            return forces, torques
+        blown = resistence <= 10
+        felt_wind = wind_velocity / (resistence[blown] + 1)[:, None]
+        velocities = np.asarray(velocities, dtype=np.float64)[blown]
+        v_effect = felt_wind - felt_wind * ((felt_wind * velocities).sum(axis=1) / (felt_wind * felt_wind).sum(axis=1))[:, None]
+        # obj.area() and (obj.top() - obj.bottom()).sum()
+        heights = sizes[blown, 1].astype(np.float64)
+        area = heights * sizes[blown, 0]
+        f_tan = np.linalg.norm(v_effect, axis=1)[:, None] * v_effect * (area * self.constants.AIR_DENSITY)[:, None]
+        rand_v = np.minimum(2, self.rng.normal(0, self.constants.F_CROSS_SCALE, (len(f_tan), 3)))
+        r = self.rng.normal(0, 0.1, (len(f_tan), 3)) * (heights / 2)[:, None]
+        forces[blown] = f_tan + np.cross(f_tan, rand_v)
+        torques[blown] = np.cross(f_tan, r)
+        return forces, torques
+
+    def evolve_table(self, objects: ObjectTable, wind: np.ndarray, settled: Set[int], retired: Set[int] = frozenset()):
+        """
+        evolve on the columns of the object table. Returns the ids of the objects in the wind with their
+        forces and torques, (N,), (N, 3), (N, 3).
+        """
+        ids = objects.id_array()
+        blown = np.fromiter((obj.name == 'Object' for obj in objects.views), dtype=bool, count=len(ids))
+        blown &= objects.valid_mask("velocity") & objects.valid_mask("size")
+        if len(settled) + len(retired) > 0:
+            blown &= ~np.isin(ids, np.fromiter(settled | retired, dtype=np.int64))
+        rows = np.flatnonzero(blown)
+        forces, torques = self.wind_effects(wind, objects.column("size")[rows], objects.column("velocity")[rows],
+                                            objects.column("resistence")[rows])
+        return ids[rows], forces, torques
+
+    def evolve(self, objects: Dict[int, ObjectStatus], wind: np.ndarray, settled: Set[int], retired: Set[int] = frozenset()):
+        if isinstance(objects, ObjectTable):
+            ids, forces, torques = self.evolve_table(objects, wind, settled, retired)
+            return dict(zip(ids.tolist(), zip(forces, torques)))
         effects = dict()
         for idx in objects:
             obj = objects[idx]
             if obj.name != 'Object' or (not isinstance(obj.velocity, np.ndarray)) or (not isinstance(obj.size, np.ndarray)) or idx in settled:
                 continue
+            if idx in retired:
+                continue
             effects[idx] = self.calc_wind_effect(wind, obj)
-        return effects
\ No newline at end of file
+        return effects
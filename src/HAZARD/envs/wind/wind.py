@@ -3,6 +3,7 @@ from tdw.controller import Controller
 from .manager import WindObjectManager
 from .object import AgentStatus
 from .wind_utils import default_const
+from src.HAZARD.utils.response_router import ResponseRouter
 
 import numpy as np
 
@@ -15,14 +16,19 @@ class WindController(Controller):
         self.commands: List[dict] = list()
         super().__init__(port, check_version, launch_build)
         
-        self.manager = WindObjectManager()
+        # classifies the output data of each frame once for the manager and image capture
+        self.router = ResponseRouter()
+        self.manager = WindObjectManager(bounds_refresh_interval=kwargs.get("bounds_refresh_interval", 100),
+                                         router=self.router, lod=kwargs.get("lod", False),
+                                         sleep=kwargs.get("sleep", False))
         self.add_ons.append(self.manager)
         self.frame_count = 0
-        self.RNG = np.random.Generator(np.random.PCG64(seed))
+        self.seed(seed)
         self.constants = constants
 
     def seed(self, seed):
         self.RNG = np.random.Generator(np.random.PCG64(seed))
+        self.manager.wind_force_manager.seed(int(self.RNG.integers(1 << 31)))
     
     def get_unique_id(self):
         while True:
@@ -40,11 +46,8 @@ class WindController(Controller):
         self.manager.wind_v = np.array([0, 0, 0])
     
     def wind_step(self, resp):
-        for idx in self.manager.effects:
-            force, torque = self.manager.effects[idx]
-            # print(idx, force, torque, self.manager.objects[idx].position, self.manager.objects[idx].velocity)
-            self.commands.append({"$type": "apply_force_to_object", "id": idx, "force": {"x": force[0], "y": force[1], "z": force[2]}})
-            self.commands.append({"$type": "apply_torque_to_object", "id": idx, "torque": {"x": torque[0], "y": torque[1], "z": torque[2]}})
+        ids, forces, torques = self.manager.effect_arrays
+        self.commands.extend(self.manager.force_emitter.emit(ids, forces, torques))
         self.frame_count += 1
 
     def communicate(self, commands: Union[dict, List[dict]]) -> list:
@@ -62,5 +65,6 @@ class WindController(Controller):
         #     super().communicate([{"$type": "terminate"}])
         #     exit(0)
         if self.initialized:
-            self.wind_step(resp)
+            with self.router.timed("wind_step"):
+                self.wind_step(resp)
         return resp
\ No newline at end of file
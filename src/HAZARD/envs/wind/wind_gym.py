@@ -3,6 +3,8 @@ import gym.spaces
 from .agent import *
 import numpy as np
 from .windagent_controller import *
+from src.HAZARD.utils.leak_check import LeakCheck
+from src.HAZARD.utils.scene_snapshot import SceneSnapshots
 # from src.HAZARD.policy.env_actions import agent_drop, agent_pickup, agent_explore, agent_walk_to_single_step
 
 from enum import IntEnum
@@ -24,13 +26,26 @@ class WindEnv(gym.Env):
     def __init__(self, port: int = 1071, check_version: bool = True, launch_build: bool = False, seed = 0,
                  screen_size = 512, use_local_resources = False, map_size_h=256, map_size_v=256, grid_size=0.25,
                  image_capture_path: str = None, log_path: str = None, use_gt=False, use_dino=False,
-                 reverse_observation = False, record_only: bool = False, **kwargs):
+                 reverse_observation = False, record_only: bool = False, bounds_refresh_interval = 100,
+                 lod = False, sleep = False, reuse_controller = False,
+                 scene_snapshots = False, obs_cache = False, lazy_obs = False, leak_check = False, **kwargs):
         self.controller_args = dict(launch_build=launch_build, port=port, check_version=check_version,
                                     screen_size=screen_size, use_local_resources=use_local_resources,
                                     map_size_h=map_size_h, map_size_v=map_size_v, grid_size=grid_size,
                                     image_capture_path=image_capture_path, log_path=log_path, use_dino=use_dino,
-                                    use_gt=use_gt, reverse_observation=reverse_observation, record_only=record_only)
+                                    use_gt=use_gt, reverse_observation=reverse_observation, record_only=record_only,
+                                    bounds_refresh_interval=bounds_refresh_interval, lod=lod, sleep=sleep)
         self.controller = None
+        # keep one controller and build for all episodes, reset_scene cleans up between them
+        self.reuse_controller = reuse_controller
+        # check for objects the last episode left in the build, on each reset
+        self.leak_check = LeakCheck() if leak_check else None
+        # one snapshot per scene, kept across controllers
+        self.snapshots = SceneSnapshots(enabled=scene_snapshots)
+        self.controller_args["snapshots"] = self.snapshots
+        self.controller_args["obs_cache"] = obs_cache
+        self.controller_args["lazy_obs"] = lazy_obs
+        self.controller_args["leak_check"] = self.leak_check
         self.RNG = np.random.RandomState(0)
         self.done = False
         self.record_only = record_only
@@ -44,12 +59,14 @@ class WindEnv(gym.Env):
             data_dirs = [d for d in data_dirs if "suburb" in d]
             data_dir = os.path.join(PATH, "data", "room_setup_wind", data_dirs[self.RNG.randint(len(data_dirs))])
         self.setup = SceneSetup(data_dir=data_dir, record_mode=self.record_only)
-        if self.controller is not None:
+        if self.controller is not None and not self.reuse_controller:
             self.controller.communicate({"$type": "terminate"})
             self.controller.socket.close()
-        self.controller = WindAgentController(**self.controller_args)
+            self.controller = None
+        if self.controller is None:
+            self.controller = WindAgentController(**self.controller_args)
+            print("Controller connected")
         self.controller.seed(self.RNG.randint(1000000))
-        print("Controller connected")
         self.controller.init_scene(self.setup)
 
         self.num_step = 0
@@ -59,7 +76,7 @@ class WindEnv(gym.Env):
         if not self.record_only:
             self.controller.do_action(0, "turn_by", {"angle": 0})
             self.controller.next_key_frame()
-            return self.controller._obs()["RL"]
+            return self.controller._obs(fields=["RL"])["RL"]
     
     # def step(self, action):
     #     """
@@ -150,7 +167,7 @@ class WindEnv(gym.Env):
                 if self.last_action == ActionSpace.WALK_TO_RANDOM_OBJECT_IN_SIGHT:
                     target = self.last_target
                 else:
-                    obs = self.controller._obs()
+                    obs = self.controller._obs(fields=["sem_map"])
                     obj_ids = np.unique(obs["sem_map"]["id"])
                     targets = [self.controller.manager.get_real_id(idx) for idx in obj_ids if self.controller.manager.get_real_id(idx) not in self.controller.finished]
                     target = int(self.RNG.choice(targets)) if len(targets) > 0 else None
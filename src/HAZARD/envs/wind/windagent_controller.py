@@ -1,4 +1,4 @@
-from typing import Any, Tuple, Dict
+from typing import Any, Tuple, Dict, List, Optional
 from .object import ObjectStatus
 from .agent import *
 from tdw.add_ons.third_person_camera import ThirdPersonCamera
@@ -15,6 +15,8 @@ import os
 from src.HAZARD.utils.vision import Detector
 from src.HAZARD.utils.local_asset import get_local_url
 from src.HAZARD.utils.scene_setup import SceneSetup
+from src.HAZARD.utils.scene_snapshot import SceneSnapshots
+from src.HAZARD.utils.observation import LazyObservation, ObservationCache
 from tdw.output_data import OutputData, Images
 
 PATH = os.path.dirname(os.path.abspath(__file__))
@@ -46,6 +48,14 @@ class WindAgentController(WindController):
         self.use_gt = kwargs.get("use_gt", True)
         self.use_dino = use_dino
         self.record_only = record_only
+        # shared by the gym with the controllers of later episodes, replays every batch when disabled
+        self.snapshots = kwargs.get("snapshots", None)
+        if self.snapshots is None:
+            self.snapshots = SceneSnapshots(enabled=False)
+        # LeakCheck of the gym, None for no check
+        self.leak_check = kwargs.get("leak_check", None)
+        self.obs_cache = ObservationCache(enabled=kwargs.get("obs_cache", False))
+        self.lazy_obs = kwargs.get("lazy_obs", False)
         self.id2name = {}
         if not self.use_gt:
             if self.use_dino:
@@ -95,6 +105,7 @@ class WindAgentController(WindController):
         self.add_ons = []
         self.manager.reset()
         self.frame_count = 0
+        self.obs_cache.reset()
         self.communicate([])
         self.id2name = {}
         
@@ -114,6 +125,7 @@ class WindAgentController(WindController):
             logger = Logger(self.log_path)
             self.add_ons.append(logger)
             self.communicate([])
+        batches = []
         for commands in setup.commands_list:
             filtered_commands = []
             for command in commands:
@@ -132,7 +144,8 @@ class WindAgentController(WindController):
                     resistence = setup.other["wind_resistence"][str(idx)] if str(idx) in setup.other["wind_resistence"] else 0
                     self.manager.add_object(ObjectStatus(idx=idx, position=pos, resistence=resistence))
                 filtered_commands.append(command)
-            self.communicate(filtered_commands)
+            batches.append(filtered_commands)
+        self.snapshots.load(self, setup, batches)
 
         if not self.record_only:
             if len(self.agents) == 0:
@@ -168,7 +181,10 @@ class WindAgentController(WindController):
         self.set_wind(np.array(setup.other["wind"]))
         for idx in self.containers:
             self.manager.settled.add(idx)
-        self.communicate([])
+        # the ids of the new scene, on a frame before the episode starts
+        resp = self.communicate(self.leak_check.commands() if self.leak_check is not None else [])
+        if self.leak_check is not None:
+            self.leak_check.check(self, resp)
 
         if self.image_capture_path != None:
             pos = copy.deepcopy(setup.agent_positions[0])
@@ -346,107 +362,131 @@ class WindAgentController(WindController):
                     agent.fail_grasp()
         resp = super().communicate(commands)
         if self.image_capture_path != None:
-            for i in range(len(resp) - 1):
-                r_id = OutputData.get_data_type_id(resp[i])
-                # Get Images output data.
-                if r_id == "imag":
-                    images = Images(resp[i])
-                    # Determine which avatar captured the image.
-                    if images.get_avatar_id() == "record":
-                        # Save the image.
-                        TDWUtils.save_images(images=images, filename=str(self.comm_counter),
-                                             output_directory=self.image_capture_path)
-                        self.comm_counter += 1
+            # Get Images output data.
+            for b in self.router.get(resp, "imag"):
+                images = Images(b)
+                # Determine which avatar captured the image.
+                if images.get_avatar_id() == "record":
+                    # Save the image.
+                    TDWUtils.save_images(images=images, filename=str(self.comm_counter),
+                                         output_directory=self.image_capture_path)
+                    self.comm_counter += 1
         return resp
 
     @torch.no_grad()
-    def _obs(self, agent_idx: int = 0):
-        # print("get obs")
-        self.manager.prepare_segmentation_data()
-        self.communicate([])
-        obs = dict()
-        """
-        raw observation: RGBD, temperature
-        """
-        rgb = self.agents[agent_idx].dynamic.get_pil_image()
-        id_image = np.array(self.agents[agent_idx].dynamic.get_pil_image("id"))
-        if self.reverse_observation:
-            rgb = np.flip(rgb, axis=0)
-            id_image = np.flip(id_image, axis=0)
-
-        if self.use_gt:
-            seg_mask = self.manager.segm.get_seg_mask(id_image)
-        else:
-            rcnn_mask = self.detector.inference(np.array(rgb))
-            seg_mask = self.manager.segm.get_seg_mask(np.array(id_image),
-                                                        rcnn=rcnn_mask,
-                                                        id_list=self.manager.id_list)
-        # print(seg_mask.shape, seg_mask.max())
-        depth = TDWUtils.get_depth_values(self.agents[agent_idx].dynamic.images["depth"], width=self.screen_size, height=self.screen_size)
-        depth = np.flip(depth, axis=0)
-        
-        rgb = np.array(rgb).astype(np.float32).transpose((2, 0, 1)).astype(np.float32) * 1.0 / 255
-        depth = depth.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
-        
-        obs["raw"] = dict(
-            rgb=rgb,
-            depth=depth,
-            seg_mask=seg_mask
-        )
-        
-        """
-        mapped observation
+    def _obs(self, agent_idx: int = 0, fields: Optional[List[str]] = None):
         """
-        camera_matrix = self.agents[agent_idx].dynamic.camera_matrix.reshape((4, 4))
-        obs_concat = np.concatenate([rgb, depth], axis=0)
-        
-        sem = self.sem_map.forward(obs=obs_concat, id_map=seg_mask, camera_matrix=camera_matrix, maps_last=self.maps[agent_idx],
-                                   position=self.agents[agent_idx].dynamic.transform.position, record_mode=self.record_only,
-                                   targets=self.manager.get_renumbered_list(self.targets))
-        obs["sem_map"] = dict(height=sem["height"].cpu().numpy(),
-                              explored=sem["explored"].cpu().numpy(),
-                              id=sem["id"].cpu().numpy(),
-                              other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
-        self.maps[agent_idx] = dict(height=sem["height"].cpu().numpy(),
-                              explored=sem["explored"].cpu().numpy(),
-                              id=sem["id"].cpu().numpy(),
-                              other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
-        # end = time.time()
-        # print("sem_map time=", end - start)
-        
+        fields: the fields that will be read, "raw.<name>" for one raw field. With lazy_obs only these are computed
+        now, the others on first access before the next frame. None for all of them.
         """
-        map of goal and agent
-        """
-        agent_pos = self.sem_map.real_to_grid(self.agents[agent_idx].dynamic.transform.position)
-        target_poss = [self.sem_map.real_to_grid(self.manager.objects[idx].position) for idx in self.targets]
-        
-        goal_map = np.zeros((self.map_size_h, self.map_size_v))
-        for (i, target_pos) in enumerate(target_poss):
-            if self.targets[i] in self.finished:
-                continue
-            if target_pos[0] < 0 or target_pos[0] >= self.map_size_h or target_pos[1] < 0 or target_pos[1] >= self.map_size_v:
-                continue
-            if not (sem["id"] == self.manager.get_renumbered_id(self.targets[i])).any():
-                continue
-            goal_map[target_pos[0], target_pos[1]] = 1
-        if agent_pos[0] > 0 and agent_pos[0] < self.map_size_h - 1 and agent_pos[1] > 0 and agent_pos[1] < self.map_size_v - 1:
-            goal_map[agent_pos[0], agent_pos[1]] = -2
-            rad = self.agents[agent_idx].get_facing()
-            rad = int(rad / (np.math.pi / 4))
-            if rad < 0:
-                rad += 8
-            dx = list([1, 1, 0, -1, -1, -1, 0, 1])[rad]
-            dz = list([0, 1, 1, 1, 0, -1, -1, -1])[rad]
-            goal_map[agent_pos[0] + dx][agent_pos[1] + dz] = -1
-        obs["goal_map"] = goal_map
-        
-        RL_obs = np.zeros((4, self.map_size_h, self.map_size_v))
-        RL_obs[0] = obs["sem_map"]["height"]
-        RL_obs[1] = obs["sem_map"]["explored"]
-        RL_obs[2] = obs["sem_map"]["id"]
-        RL_obs[3] = goal_map
-        obs["RL"] = RL_obs
+        # print("get obs")
+        obs = self.obs_cache.get(agent_idx, self.frame_count)
+        if obs is None:
+            self.manager.prepare_segmentation_data()
+            self.communicate([])
+            obs = LazyObservation(self.frame_count, lambda: self.frame_count)
+            self.add_obs_fields(obs, agent_idx)
+            self.obs_cache.put(agent_idx, obs)
+        obs.compute(fields if self.lazy_obs else None)
         return obs
+
+    def add_obs_fields(self, obs: LazyObservation, agent_idx: int):
+        images = dict()
+
+        def image(pass_mask: str):
+            if pass_mask not in images:
+                images[pass_mask] = np.array(self.agents[agent_idx].dynamic.get_pil_image(pass_mask))
+                if self.reverse_observation:
+                    images[pass_mask] = np.flip(images[pass_mask], axis=0)
+            return images[pass_mask]
+
+        def rgb():
+            return image("img").astype(np.float32).transpose((2, 0, 1)).astype(np.float32) * 1.0 / 255
+
+        def depth():
+            depth = TDWUtils.get_depth_values(self.agents[agent_idx].dynamic.images["depth"], width=self.screen_size, height=self.screen_size)
+            depth = np.flip(depth, axis=0)
+            return depth.reshape((1, self.screen_size, self.screen_size)).astype(np.float32)
+
+        def seg_mask():
+            if self.use_gt:
+                return self.manager.segm.get_seg_mask(image("id"))
+            rcnn_mask = self.detector.inference(np.array(image("img")))
+            return self.manager.segm.get_seg_mask(np.array(image("id")), rcnn=rcnn_mask, id_list=self.manager.id_list)
+
+        def raw():
+            """
+            raw observation: RGBD
+            """
+            raw = LazyObservation(obs.frame, obs.clock)
+            raw.add("rgb", rgb)
+            raw.add("depth", depth)
+            raw.add("seg_mask", seg_mask)
+            return raw
+
+        @torch.no_grad()
+        def sem_map():
+            """
+            mapped observation
+            """
+            raw = obs["raw"]
+            # the semantic map reads depth and the channels after it, the rgb channels are left empty
+            obs_concat = np.concatenate([np.zeros((3, self.screen_size, self.screen_size), dtype=np.float32),
+                                         raw["depth"]], axis=0)
+
+            sem = self.sem_map.forward(obs=obs_concat, id_map=raw["seg_mask"], camera_matrix=camera_matrix, maps_last=self.maps[agent_idx],
+                                       position=self.agents[agent_idx].dynamic.transform.position, record_mode=self.record_only,
+                                       targets=self.manager.get_renumbered_list(self.targets))
+            self.maps[agent_idx] = dict(height=sem["height"].cpu().numpy(),
+                                  explored=sem["explored"].cpu().numpy(),
+                                  id=sem["id"].cpu().numpy(),
+                                  other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+            return dict(height=sem["height"].cpu().numpy(),
+                        explored=sem["explored"].cpu().numpy(),
+                        id=sem["id"].cpu().numpy(),
+                        other=sem["other"].cpu().numpy() if sem["other"] is not None else None)
+
+        def goal_map():
+            """
+            map of goal and agent
+            """
+            sem_id = obs["sem_map"]["id"]
+            agent_pos = self.sem_map.real_to_grid(self.agents[agent_idx].dynamic.transform.position)
+            target_poss = [self.sem_map.real_to_grid(self.manager.objects[idx].position) for idx in self.targets]
+
+            goal_map = np.zeros((self.map_size_h, self.map_size_v))
+            for (i, target_pos) in enumerate(target_poss):
+                if self.targets[i] in self.finished:
+                    continue
+                if target_pos[0] < 0 or target_pos[0] >= self.map_size_h or target_pos[1] < 0 or target_pos[1] >= self.map_size_v:
+                    continue
+                if not (sem_id == self.manager.get_renumbered_id(self.targets[i])).any():
+                    continue
+                goal_map[target_pos[0], target_pos[1]] = 1
+            if agent_pos[0] > 0 and agent_pos[0] < self.map_size_h - 1 and agent_pos[1] > 0 and agent_pos[1] < self.map_size_v - 1:
+                goal_map[agent_pos[0], agent_pos[1]] = -2
+                rad = self.agents[agent_idx].get_facing()
+                rad = int(rad / (np.math.pi / 4))
+                if rad < 0:
+                    rad += 8
+                dx = list([1, 1, 0, -1, -1, -1, 0, 1])[rad]
+                dz = list([0, 1, 1, 1, 0, -1, -1, -1])[rad]
+                goal_map[agent_pos[0] + dx][agent_pos[1] + dz] = -1
+            return goal_map
+
+        def rl():
+            RL_obs = np.zeros((4, self.map_size_h, self.map_size_v))
+            RL_obs[0] = obs["sem_map"]["height"]
+            RL_obs[1] = obs["sem_map"]["explored"]
+            RL_obs[2] = obs["sem_map"]["id"]
+            RL_obs[3] = obs["goal_map"]
+            return RL_obs
+
+        camera_matrix = self.agents[agent_idx].dynamic.camera_matrix.reshape((4, 4))
+        obs.add("raw", raw)
+        obs.add("sem_map", sem_map)
+        obs.add("goal_map", goal_map)
+        obs.add("RL", rl)
     
     def _info(self):
         info = dict()
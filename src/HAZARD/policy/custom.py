@@ -12,6 +12,8 @@ class CustomAgent:
     def __init__(self, task):
         self.task = task
         self.agent_type = "custom"
+        # the observation fields choose_target reads, e.g. ["sem_map", "raw.seg_mask"], None for all of them
+        self.obs_fields = None
 
     def reset(self, goal_objects, objects_info):
         pass
@@ -107,7 +107,7 @@ def agent_walk_to(env, target: Union[int, np.ndarray, List], max_steps=100, rese
         
         agent_pos = env.controller.real_to_grid(agent_pos)
         target_pos = env.controller.real_to_grid(target_pos)
-        obs = env.controller._obs()
+        obs = env.controller._obs(fields=["sem_map"])
         sem_map = obs["sem_map"]
         if isinstance(target, int) and not np.any(sem_map["id"] == env.controller.manager.id_renumbering[target]):
             env.controller.agents[0].collision_detection.avoid = True
@@ -164,7 +164,7 @@ def agent_walk_to_single_step(env, target: Union[int, np.ndarray, List], reset_a
         return True, "success"
     agent_pos = env.controller.real_to_grid(agent_pos)
     target_pos = env.controller.real_to_grid(target_pos)
-    obs = env.controller._obs()
+    obs = env.controller._obs(fields=["sem_map"])
     sem_map = obs["sem_map"]
     if isinstance(target, int) and not np.any(sem_map["id"] == env.controller.manager.get_renumbered_id(target)):
         return False, "target not in vision or memory"
@@ -225,6 +225,7 @@ def agent_pickup(env, target: int, env_type: str = "what?"):
     if target in env.controller.other_containers:
         env.controller.communicate(
             {"$type": "teleport_object", "id": target, "position": TDWUtils.array_to_vector3(above_pos)})
+    env.controller.manager.mark_bounds_dirty([target])
 
     env.controller.do_action(agent_idx=0, action="grasp", params={"target": target, 
                                                                     "arm": Arm.right,
@@ -248,7 +249,8 @@ def agent_explore(env):
     for i in range(TURN_TIMES):
         env.controller.do_action(agent_idx=0, action="turn_by", params={"angle": 360.0 / TURN_TIMES})
         status = env.controller.next_key_frame()[0][0]
-        env.controller._obs()
+        # the semantic map remembers what was seen while turning
+        env.controller._obs(fields=["sem_map"])
         if status != ActionStatus.success:
             return False, 'can not turn around at this time'
     return True, 'success'
@@ -310,6 +312,7 @@ def agent_drop(env, container: Optional[int]=None, env_type: str = "what?"):
         if env_type == "fire":
             env.controller.manager.objects[grasp_id].temperature_threshold = 4000
         env.controller.communicate(destroy_commands)
+        env.controller.manager.mark_bounds_dirty([grasp_id])
         # env.controller.do_action(agent_idx=0, action="reset_arm",
         #                          params={"arm": [Arm.left, Arm.right] if env_type == "wind" else Arm.right})
         env.controller.do_action(agent_idx=0, action="reset_arm", params={"arm": [Arm.left, Arm.right]})
@@ -19,6 +19,7 @@ class HumanAgent:
         self.rooms_explored = None
         self.goal_desc = None
         self.agent_type = "human"
+        self.obs_fields = ["sem_map", "goal_map", "raw.rgb", "raw.seg_mask"]
         self.agent_name = "Bob"
         self.prompt_template_path = prompt_template_path
         df = pd.read_csv(self.prompt_template_path)
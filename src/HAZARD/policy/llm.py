@@ -43,6 +43,7 @@ class LLM:
         self.apikey_idx = 0
         openai.api_key = self.apikey_list[self.apikey_idx]
         self.agent_type = "llm"
+        self.obs_fields = ["sem_map", "goal_map", "raw.seg_mask", "raw.log_temp"]
         self.task = task
         assert task in ['fire', 'flood', 'wind']
         self.debug = sampling_parameters.debug
@@ -117,6 +117,7 @@ class MCTSv2:
         self.rooms_explored = None
         self.goal_desc = None
         self.agent_type = "mcts"
+        self.obs_fields = ["sem_map", "goal_map", "raw.seg_mask", "raw.log_temp"]
         self.agent_name = "Bob"
         self.rooms = []
         self.total_cost = 0
@@ -20,6 +20,7 @@ class OracleAgent:
         self.task = task
         self.agent_speed = 1.0 / 62
         self.agent_type = "oracle"
+        self.obs_fields = []
         self.goal_objects = None
         self.objects_info = None
         self.controller = None
@@ -30,6 +31,7 @@ class OracleAgent:
         self.agent_position = []
         self.step_limit = 0
         self.frame_bias = 0
+        self.value_dict = None
 
     def reset(self, goal_objects, objects_info, controller, step_limit):
         self.goal_objects = goal_objects
@@ -63,10 +65,9 @@ class OracleAgent:
             if additional_steps * self.agent_speed >= distance:
                 meet = True
                 agent_pos = self.target_position_sequence[cur_step][target_id]
-                value_dict = json.load(open("data/meta_data/value.json"))
                 name = self.controller.target_id2name[target]
-                if name in value_dict:
-                    if value_dict[name] == 1:
+                if name in self.value_dict:
+                    if self.value_dict[name] == 1:
                         value = 5
                     else:
                         value = 1
@@ -100,6 +101,9 @@ class OracleAgent:
         if len(self.controller.target_ids) > 11:
             return []
         self.frame_bias = self.step_limit - len(self.target_position_sequence)
+        if self.value_dict is None:
+            # read once, find_path looks it up for every target of every searched order
+            self.value_dict = json.load(open("data/meta_data/value.json"))
         min_step, best_order, best_value = self.search_step([], self.agent_position, 0, 0)
         print("End search", min_step, best_order, best_value)
         return [("walk_to", idx) for idx in best_order]
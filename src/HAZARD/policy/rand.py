@@ -14,6 +14,7 @@ class RandomAgent:
     def __init__(self, task):
         self.task = task
         self.agent_type = "random"
+        self.obs_fields = []
     
     def reset(self, goal_objects, objects_info):
         pass
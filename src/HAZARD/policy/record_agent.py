@@ -2,6 +2,7 @@
 class RecordAgent:
     def __init__(self, task):
         self.agent_type = "record"
+        self.obs_fields = []
         self.agent_name = "Bob"
         self.task = task
         self.counter = 0
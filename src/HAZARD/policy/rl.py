@@ -28,6 +28,7 @@ class RLAgent:
         self.model:torch.nn.Module = torch.load(model_dir[task])[0].to(self.device)
         self.model.eval()
         self.agent_type = "rl"
+        self.obs_fields = ["RL"]
         
         self.eval_hidden_state = torch.zeros((1, self.model.recurrent_hidden_state_size), device=self.device, dtype=torch.float32)
         self.eval_masks = torch.zeros(1, device=self.device, dtype=torch.float32)
@@ -7,6 +7,7 @@ class RuleBasedAgent:
         self.rooms_explored = None
         self.goal_desc = None
         self.agent_type = "mcts"
+        self.obs_fields = []
         self.agent_name = "Bob"
         self.rooms = []
         self.total_cost = 0
@@ -14,6 +14,7 @@ from tdw.add_ons.third_person_camera import ThirdPersonCamera
 from tdw.replicant.ik_plans.ik_plan_type import IkPlanType
 from tdw.output_data import OutputData
 from src.HAZARD.policy.astar import get_astar_path
+from src.HAZARD.utils.response_router import ResponseRouter
 
 class PathMarker(AddOn):
     def __init__(self):
@@ -63,26 +64,25 @@ class BoxCastOccupancyMap(AddOn):
         self.floor_height: Optional[float] = None
         self.remembered_commands = []
         self.frequency = "never"
+        self.router = ResponseRouter() # replaced by the controller's router in run()
     
     def get_initialization_commands(self) -> List[dict]:
         return []
     
     def on_send(self, resp: List[bytes]) -> None:
         self.grid = np.zeros(self.num_grid, dtype=int)
-        for i in range(len(resp) - 1):
-            r_id = OutputData.get_data_type_id(resp[i])
-            if r_id == "rayc":
-                rayc = Raycast(resp[i])
-                idx = rayc.get_raycast_id()
-                if idx >= 114514 and idx < 114514 + self.num_grid[0] * self.num_grid[1]:
-                    idx -= 114514
-                    if rayc.get_hit():
-                        hit_y = rayc.get_point()[1]
-                        # print("hit point=", rayc.get_point(), "i, j=", idx // self.num_grid[1], idx % self.num_grid[1])
-                        if hit_y > self.floor_height + 0.01:
-                            self.grid[idx // self.num_grid[1], idx % self.num_grid[1]] = 1
-                    else:
-                        self.grid[idx // self.num_grid[1], idx % self.num_grid[1]] = 100
+        for b in self.router.get(resp, "rayc"):
+            rayc = Raycast(b)
+            idx = rayc.get_raycast_id()
+            if idx >= 114514 and idx < 114514 + self.num_grid[0] * self.num_grid[1]:
+                idx -= 114514
+                if rayc.get_hit():
+                    hit_y = rayc.get_point()[1]
+                    # print("hit point=", rayc.get_point(), "i, j=", idx // self.num_grid[1], idx % self.num_grid[1])
+                    if hit_y > self.floor_height + 0.01:
+                        self.grid[idx // self.num_grid[1], idx % self.num_grid[1]] = 1
+                else:
+                    self.grid[idx // self.num_grid[1], idx % self.num_grid[1]] = 100
         if self.frequency == "always":
             self.commands = self.remembered_commands.copy()
     
@@ -192,6 +192,7 @@ def run(scene_name, image_path=""):
     os.makedirs(image_path, exist_ok=True)
     camera = ThirdPersonCamera(avatar_id=f"{scene_name}", position={"x": 0, "y": 8, "z": 8}, look_at={"x": 0, "y": 0, "z": 0})
     ic = ImageCapture(path=image_path, avatar_ids=[f"{scene_name}", str(env.controller.agents[0].replicant_id)], pass_masks=["_img", "_depth", "_id"])
+    occ.router = env.controller.router
     env.controller.add_ons.extend([camera, ic, occ, marker])
     env.controller.add_ons.append(AgentCameraTracker(env.controller.agents[0], camera))
     occ.generate()
@@ -100,6 +100,16 @@ def submit(
 
         # if you have a network issue with amazon cloud, please turn on this (details in documentation)
         use_cached_assets: bool = False,
+        # keep one TDW build for all episodes instead of relaunching it for each of them
+        reuse_controller: bool = False,
+        # rebuild scenes loaded before from a snapshot instead of replaying their setup commands
+        scene_snapshots: bool = False,
+        # return the observation of the current frame again instead of stepping a frame for a new one
+        obs_cache: bool = False,
+        # compute only the observation fields the agent reads (its obs_fields), the others when they are read
+        lazy_obs: bool = False,
+        # with reuse_controller, report objects an episode left in the build after each reset
+        leak_check: bool = False,
 
         # Parameters for perceptional version of HAZARD
         use_dino: bool = False,  # turn on to use DINO as perception module, instead of mask R-CNN
@@ -153,21 +163,28 @@ def submit(
                                   map_size_h=256, map_size_v=256, grid_size=grid_size, use_gt=not perceptional,
                                   reverse_observation=reverse_observation, record_only=False, use_dino=use_dino,
                                   record_with_agents=record_with_agents, effect_on_agents=effect_on_agents,
-                                  use_cached_assets=use_cached_assets)
+                                  use_cached_assets=use_cached_assets, reuse_controller=reuse_controller,
+                                  scene_snapshots=scene_snapshots, obs_cache=obs_cache, lazy_obs=lazy_obs,
+                                  leak_check=leak_check)
         else:
             challenge = Challenge(env_name=env_name, data_dir=data_dir, output_dir=output_dir,
                                   logger=logger, launch_build=not debug, debug=debug, port=port, screen_size=1024,
                                   grid_size=grid_size, use_gt=not perceptional, record_only=(agent == "record"),
                                   reverse_observation=reverse_observation, record_with_agents=record_with_agents,
                                   use_dino=use_dino, effect_on_agents=effect_on_agents,
-                                  use_cached_assets=use_cached_assets)
+                                  use_cached_assets=use_cached_assets, reuse_controller=reuse_controller,
+                                  scene_snapshots=scene_snapshots, obs_cache=obs_cache, lazy_obs=lazy_obs,
+                                  leak_check=leak_check)
     else:
         agent_policy = agent
         challenge = Challenge(env_name=env_name, data_dir=data_dir, output_dir=output_dir,
                               logger=logger, launch_build=not debug, debug=debug, port=port, screen_size=1024,
                               grid_size=grid_size, use_gt=not perceptional, record_only=(agent == "record"),
                               reverse_observation=reverse_observation, record_with_agents=record_with_agents,
-                              use_dino=use_dino, effect_on_agents=effect_on_agents, use_cached_assets=use_cached_assets)
+                              use_dino=use_dino, effect_on_agents=effect_on_agents, use_cached_assets=use_cached_assets,
+                              reuse_controller=reuse_controller, scene_snapshots=scene_snapshots,
+                              obs_cache=obs_cache, lazy_obs=lazy_obs,
+                              leak_check=leak_check)
 
     if os.path.exists(os.path.join(data_dir, "log.txt")):  # single episode
         challenge.submit(agent=agent_policy, logger=logger, eval_episodes=1)
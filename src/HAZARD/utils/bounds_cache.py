@@ -0,0 +1,79 @@
+from typing import List, Optional, Set, Tuple
+import numpy as np
+
+"""
+Bounds only change when an object is added or rotates (the size is the axis-aligned extent),
+so there is no need to request send_bounds for every object on every frame.
+"""
+
+class BoundsCache:
+    """
+    Decides which objects need send_bounds on the next frame:
+    all objects on the first frame and every refresh_interval frames (1 = every frame, 0 = never),
+    otherwise only objects that are new, rotated by more than rotation_tolerance since their last bounds,
+    or marked with mark_dirty (grasped, teleported, ...).
+    """
+    def __init__(self, refresh_interval: int = 100, rotation_tolerance: float = 1e-3):
+        self.refresh_interval = refresh_interval
+        self.rotation_tolerance = rotation_tolerance
+        self.reset()
+
+    def reset(self):
+        self.frame = 0
+        self.full = True
+        self.dirty: Set[int] = set()
+        # rotation of each object when its bounds were last received, sorted by id
+        self.known_ids = np.zeros(0, dtype=np.int64)
+        self.known_rotations = np.zeros((0, 4), dtype=np.float32)
+        self.requested = 0 # number of objects requested by the last commands(), -1 for all
+
+    def mark_dirty(self, ids: List[int]):
+        self.dirty.update(int(idx) for idx in ids)
+
+    def on_bounds(self, ids: np.ndarray, rotations: np.ndarray):
+        ids = np.concatenate([self.known_ids, np.asarray(ids, dtype=np.int64)])
+        rotations = np.concatenate([self.known_rotations, np.asarray(rotations, dtype=np.float32).reshape(-1, 4)])
+        # keep the latest entry of every id
+        _, last = np.unique(ids[::-1], return_index=True)
+        last = len(ids) - 1 - last
+        self.known_ids = ids[last]
+        self.known_rotations = rotations[last]
+
+    def on_transforms(self, ids: np.ndarray, rotations: np.ndarray):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        if len(self.known_ids) == 0:
+            self.dirty.update(ids.tolist())
+            return
+        position = np.minimum(np.searchsorted(self.known_ids, ids), len(self.known_ids) - 1)
+        found = self.known_ids[position] == ids
+        rotated = np.abs(self.known_rotations[position] - rotations).max(axis=1) > self.rotation_tolerance
+        self.dirty.update(ids[~found | rotated].tolist())
+
+    def on_send(self, objects, transforms: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+                bounds_ids: Optional[np.ndarray] = None):
+        """
+        objects: the manager's ObjectTable, already updated with this frame's data.
+        transforms: (ids, rotations) of this frame's transforms, bounds_ids: ids of this frame's bounds.
+        """
+        if bounds_ids is not None:
+            rows, found = objects.lookup(bounds_ids)
+            self.on_bounds(np.asarray(bounds_ids)[found], objects.column("rotation")[rows[found]])
+        if transforms is not None:
+            self.on_transforms(*transforms)
+
+    def commands(self) -> List[dict]:
+        self.frame += 1
+        if self.full or (self.refresh_interval > 0 and self.frame % self.refresh_interval == 0):
+            self.full = False
+            self.dirty = set()
+            self.requested = -1
+            return [{"$type": "send_bounds"}]
+        self.requested = len(self.dirty)
+        if len(self.dirty) == 0:
+            # an empty id list would mean all objects
+            return []
+        ids = sorted(self.dirty)
+        self.dirty = set()
+        return [{"$type": "send_bounds", "ids": ids}]
@@ -0,0 +1,115 @@
+from typing import Set
+import numpy as np
+
+"""
+Objects that come to rest inside a settled object (a container) are settled as well.
+
+Whether an object is inside a container only changes when one of the two moves, so instead of testing every
+object against every container on every frame, settling is treated as an event of an object or a container
+moving.
+"""
+
+class ContainmentIndex:
+    """
+    update(objects, settled, retired) returns the objects that settle on this frame:
+    objects that moved since the last update are tested against all containers, the others only against
+    containers that are new or moved. Objects settled this way are containers for the others right away.
+    The settled set may be changed from outside (grasping, dropping), update() picks that up.
+    Moving is measured from the pose an object or container had when it was last tested, so that slow drift
+    adds up until it is more than tolerance.
+    """
+    def __init__(self, tolerance: float = 1e-4, block_size: int = 256):
+        self.tolerance = tolerance
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        # boxes of the containers when they were last tested against all objects, sorted by id
+        self.container_ids = np.zeros(0, dtype=np.int64)
+        self.container_boxes = np.zeros((0, 6))
+        # positions of the unsettled objects when they were last tested against all containers, sorted by id
+        self.checked_ids = np.zeros(0, dtype=np.int64)
+        self.checked_positions = np.zeros((0, 3))
+        self.tested = 0 # object-container pairs tested by the last update
+
+    @staticmethod
+    def boxes(positions: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+        """
+        (left, right, back, front, bottom, top) of the objects, as in ObjectStatus.left() etc.
+        """
+        positions = positions.astype(np.float64)
+        sizes = sizes.astype(np.float64)
+        return np.stack([positions[:, 0] - 0.5 * sizes[:, 0], positions[:, 0] + 0.5 * sizes[:, 0],
+                         positions[:, 2] - 0.5 * sizes[:, 2], positions[:, 2] + 0.5 * sizes[:, 2],
+                         positions[:, 1], positions[:, 1] + sizes[:, 1]], axis=1)
+
+    def contained(self, points: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        """
+        Whether each of the (N, 3) points lies in at least one of the boxes.
+        """
+        inside = np.zeros(len(points), dtype=bool)
+        if len(boxes) == 0:
+            return inside
+        self.tested += len(points) * len(boxes)
+        for start in range(0, len(points), self.block_size):
+            p = points[start:start + self.block_size, None, :]
+            inside[start:start + self.block_size] = ((boxes[:, 0] <= p[..., 0]) & (p[..., 0] <= boxes[:, 1]) &
+                                                     (boxes[:, 2] <= p[..., 2]) & (p[..., 2] <= boxes[:, 3]) &
+                                                     (boxes[:, 4] <= p[..., 1]) & (p[..., 1] <= boxes[:, 5])).any(axis=1)
+        return inside
+
+    @staticmethod
+    def last_tested(known_ids: np.ndarray, known: np.ndarray, ids: np.ndarray, values: np.ndarray, tolerance: float):
+        """
+        The known values of ids where they are within tolerance of values, values elsewhere, and where that is.
+        """
+        if len(known_ids) == 0:
+            return values.copy(), np.zeros(len(ids), dtype=bool)
+        position = np.minimum(np.searchsorted(known_ids, ids), len(known_ids) - 1)
+        unchanged = (known_ids[position] == ids) & (np.abs(known[position] - values).max(axis=1) <= tolerance)
+        return np.where(unchanged[:, None], known[position], values), unchanged
+
+    def update(self, objects, settled: Set[int], retired: Set[int] = frozenset()) -> Set[int]:
+        """
+        objects: the manager's ObjectTable. Returns the ids of the objects to add to settled.
+        """
+        self.tested = 0
+        ids = objects.id_array()
+        valid = objects.valid_mask("position") & objects.valid_mask("size")
+        if len(retired) > 0:
+            valid &= ~np.isin(ids, np.fromiter(retired, dtype=np.int64))
+        is_settled = np.isin(ids, np.fromiter(settled, dtype=np.int64)) if len(settled) > 0 else np.zeros(len(ids), dtype=bool)
+        positions = objects.column("position").astype(np.float64)
+
+        rows = np.flatnonzero(valid & is_settled)
+        order = np.argsort(ids[rows])
+        container_ids = ids[rows][order]
+        container_boxes = self.boxes(positions[rows][order], objects.column("size")[rows][order])
+        tested_boxes, unchanged = self.last_tested(self.container_ids, self.container_boxes, container_ids,
+                                                   container_boxes, self.tolerance)
+        changed = ~unchanged
+        # changed containers are tested against all objects below
+        self.container_ids, self.container_boxes = container_ids, tested_boxes
+
+        rows = np.flatnonzero(valid & ~is_settled)
+        tested_positions, unmoved = self.last_tested(self.checked_ids, self.checked_positions, ids[rows],
+                                                     positions[rows], self.tolerance)
+        moved = ~unmoved
+        inside = np.zeros(len(rows), dtype=bool)
+        inside[moved] = self.contained(positions[rows[moved]], container_boxes)
+        inside[~moved] = self.contained(positions[rows[~moved]], container_boxes[changed])
+        new_boxes = inside
+        while new_boxes.any():
+            # newly settled objects contain others from now on
+            boxes = self.boxes(positions[rows[new_boxes]], objects.column("size")[rows[new_boxes]])
+            rest = np.flatnonzero(~inside)
+            new_boxes = np.zeros(len(rows), dtype=bool)
+            new_boxes[rest] = self.contained(positions[rows[rest]], boxes)
+            inside |= new_boxes
+
+        # moved objects are tested against all containers above, the others keep the position of their last test
+        order = np.argsort(ids[rows[~inside]])
+        self.checked_ids = ids[rows[~inside]][order]
+        self.checked_positions = tested_positions[~inside][order]
+        return set(ids[np.flatnonzero(valid & ~is_settled)][inside].tolist())
+
@@ -0,0 +1,64 @@
+from typing import Dict, List, Optional
+import numpy as np
+
+"""
+Force and torque commands for many objects, without the ones that do nothing.
+
+A zero force neither moves nor wakes up a rigidbody, so skipping it does not change the simulation.
+TDW forces only act during the physics step of the frame they are sent in, so a nonzero force has to be
+sent again on every frame even if it did not change.
+"""
+
+class ForceEmitter:
+    """
+    emit(ids, forces, torques): apply_force_to_object / apply_torque_to_object commands.
+    Repeated ids are merged into one command, forces below min_force and torques below min_torque are skipped.
+    stats() reports how many commands were sent and saved on the last frame and in total.
+    """
+    def __init__(self, min_force: float = 1e-4, min_torque: float = 1e-4):
+        self.min_force = min_force
+        self.min_torque = min_torque
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.saved = 0
+        self.total_sent = 0
+        self.total_saved = 0
+
+    @staticmethod
+    def merge(ids: np.ndarray, vectors: np.ndarray):
+        unique, inverse = np.unique(ids, return_inverse=True)
+        if len(unique) == len(ids):
+            return ids, vectors
+        merged = np.zeros((len(unique), 3))
+        np.add.at(merged, inverse.reshape(-1), vectors)
+        return unique, merged
+
+    @staticmethod
+    def commands(command_type: str, key: str, ids: np.ndarray, vectors: np.ndarray, threshold: float) -> List[dict]:
+        keep = np.linalg.norm(vectors, axis=1) >= threshold
+        return [{"$type": command_type, "id": idx, key: {"x": v[0], "y": v[1], "z": v[2]}}
+                for idx, v in zip(ids[keep].tolist(), vectors[keep].tolist())]
+
+    def emit(self, ids, forces: np.ndarray, torques: Optional[np.ndarray] = None) -> List[dict]:
+        """
+        ids: (N,), forces: (N, 3), torques: (N, 3) or None
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        requested = len(ids) if torques is None else 2 * len(ids)
+        commands = []
+        if len(ids) > 0:
+            force_ids, forces = self.merge(ids, np.asarray(forces, dtype=np.float64).reshape(-1, 3))
+            commands = self.commands("apply_force_to_object", "force", force_ids, forces, self.min_force)
+            if torques is not None:
+                torque_ids, torques = self.merge(ids, np.asarray(torques, dtype=np.float64).reshape(-1, 3))
+                commands += self.commands("apply_torque_to_object", "torque", torque_ids, torques, self.min_torque)
+        self.sent = len(commands)
+        self.saved = requested - len(commands)
+        self.total_sent += self.sent
+        self.total_saved += self.saved
+        return commands
+
+    def stats(self) -> Dict[str, int]:
+        return dict(sent=self.sent, saved=self.saved, total_sent=self.total_sent, total_saved=self.total_saved)
@@ -0,0 +1,47 @@
+from typing import Dict, List
+import numpy as np
+from src.HAZARD.utils.output_decoder import decode_transforms, decode_replicants
+
+"""
+Objects left over from the previous episode when one controller (and build) is reused across episodes.
+
+Once init_scene() has loaded the new scene the build should contain exactly its objects: the ones added by its
+setup commands (controller.id2name), the ones the controller added itself and tracks in its manager, and one
+replicant per agent. The controllers ask for the ids on a frame of init_scene() that is sent anyway, before
+the episode starts, so that checking does not change the episode.
+"""
+
+class LeakCheck:
+    """
+    check(controller) compares the objects and replicants in the build with the ones the controller tracks.
+    Untracked objects or extra replicants are leaks. The object counts of all checks are kept in history, so
+    that a count growing over episodes of the same scene shows up as well.
+    commands() are added to a frame of the controller, check(controller, resp) reads the response of that frame.
+    """
+    def __init__(self):
+        self.history: List[Dict[str, int]] = []
+
+    @staticmethod
+    def commands() -> List[dict]:
+        return [{"$type": "send_transforms"}, {"$type": "send_replicants"}]
+
+    @staticmethod
+    def scene_ids(controller, resp: list):
+        object_ids = [decode_transforms(b)[0] for b in controller.router.get(resp, "tran")]
+        replicant_ids = [decode_replicants(b)[0] for b in controller.router.get(resp, "repl")]
+        object_ids = np.concatenate(object_ids) if len(object_ids) > 0 else np.zeros(0, dtype=np.int64)
+        replicant_ids = np.concatenate(replicant_ids) if len(replicant_ids) > 0 else np.zeros(0, dtype=np.int64)
+        return set(object_ids.tolist()), set(replicant_ids.tolist())
+
+    def check(self, controller, resp: list) -> Dict[str, int]:
+        object_ids, replicant_ids = self.scene_ids(controller, resp)
+        tracked = set(controller.id2name) | set(controller.manager.objects)
+        agent_ids = set(agent.replicant_id for agent in controller.agents)
+        leaked = sorted(object_ids - tracked - agent_ids)
+        report = dict(objects=len(object_ids), tracked=len(tracked), replicants=len(replicant_ids),
+                      agents=len(agent_ids), leaked=len(leaked), leaked_replicants=len(replicant_ids - agent_ids))
+        self.history.append(report)
+        if len(leaked) > 0 or report["leaked_replicants"] > 0:
+            print("Leak check: {} untracked objects {} and {} untracked replicants after reset".format(
+                len(leaked), leaked[:10], report["leaked_replicants"]))
+        return report
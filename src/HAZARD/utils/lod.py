@@ -0,0 +1,108 @@
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+"""
+Level of detail for hazard updates.
+
+Objects far from the hazard front (fire, water surface, ...) barely change, so they do not need to be
+updated on every tick. Objects parked far away (agent_drop teleports them to (100, 20, 0)) never change
+again and drop out of the update loops altogether.
+"""
+
+class UpdateTier(IntEnum):
+    ACTIVE = 0 # updated every tick
+    NEAR = 1 # updated every near_interval ticks
+    DORMANT = 2 # updated every dormant_interval ticks
+    RETIRED = 3 # not updated
+
+
+def nearest_distance(points: np.ndarray, sources: np.ndarray, block_size: int = 256) -> np.ndarray:
+    """
+    Distance from every point to the closest source, inf if there is no source.
+    """
+    distance = np.full(len(points), np.inf)
+    if len(sources) == 0:
+        return distance
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        distance[start:start + block_size] = np.linalg.norm(block[:, None, :] - sources[None, :, :], axis=-1).min(axis=1)
+    return distance
+
+
+class LODScheduler:
+    """
+    Puts objects into update tiers by their distance to the hazard front, then decides which objects are due
+    on each tick. An object that was skipped reports how many ticks it has to catch up on (steps).
+
+    Managers only consult the scheduler when it is enabled, otherwise every object is updated on every tick.
+    With validate, managers also run the full-rate update and record the difference with record().
+    """
+    def __init__(self, active_distance: float, near_distance: float, near_interval: int = 2,
+                 dormant_interval: int = 8, retire_distance: float = 50.0, enabled: bool = True,
+                 validate: bool = False):
+        self.active_distance = active_distance
+        self.near_distance = near_distance
+        self.intervals = np.array([1, near_interval, dormant_interval, 0], dtype=np.int64)
+        self.retire_distance = retire_distance # same rule as np.abs(position).sum() > 50
+        self.enabled = enabled
+        self.validate = validate
+        self.reset()
+
+    def reset(self):
+        self.tick = 0
+        self.last_update: Dict[int, int] = dict() # id -> tick of its last update
+        self.tier_counts = np.zeros(len(UpdateTier), dtype=np.int64)
+        self.validation: Dict[str, Dict[str, float]] = dict()
+
+    def classify(self, positions: np.ndarray, distances: np.ndarray, active: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        positions: (N, 3), distances: (N,) distance to the hazard front, active: (N,) objects kept active by their state.
+        """
+        tiers = np.full(len(positions), UpdateTier.DORMANT, dtype=np.int8)
+        tiers[distances <= self.near_distance] = UpdateTier.NEAR
+        tiers[distances <= self.active_distance] = UpdateTier.ACTIVE
+        if active is not None:
+            tiers[active] = UpdateTier.ACTIVE
+        tiers[np.abs(positions).sum(axis=1) > self.retire_distance] = UpdateTier.RETIRED
+        return tiers
+
+    def schedule(self, ids: List[int], tiers: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Advance one tick. Returns (due, steps): which objects to update now, and for each the number of
+        ticks since its last update (1 for objects updated every tick and for new objects, which are always due).
+        """
+        self.tick += 1
+        last = np.fromiter((self.last_update.get(idx, -1) for idx in ids), dtype=np.int64, count=len(ids))
+        new = last < 0
+        steps = np.where(new, 1, self.tick - last)
+        interval = self.intervals[tiers]
+        due = (interval > 0) & ((steps >= interval) | new)
+        for i in np.flatnonzero(due).tolist():
+            self.last_update[ids[i]] = self.tick
+        self.tier_counts = np.bincount(tiers, minlength=len(UpdateTier))
+        return due, steps
+
+    def forget(self, idx: int):
+        self.last_update.pop(idx, None)
+
+    def record(self, name: str, errors: np.ndarray, mismatches: int = 0):
+        """
+        Validation: absolute differences between the scheduled and the full-rate update,
+        and the number of objects whose discrete state differs.
+        """
+        entry = self.validation.setdefault(name, dict(max=0.0, sum=0.0, samples=0, mismatches=0))
+        errors = np.asarray(errors, dtype=np.float64)
+        if len(errors) > 0:
+            entry["max"] = max(entry["max"], float(errors.max()))
+            entry["sum"] += float(errors.sum())
+            entry["samples"] += len(errors)
+        entry["mismatches"] += int(mismatches)
+
+    def validation_report(self) -> Dict[str, Dict[str, float]]:
+        return {name: dict(max=entry["max"], mean=entry["sum"] / max(entry["samples"], 1),
+                           mismatches=entry["mismatches"])
+                for name, entry in self.validation.items()}
+
+    def stats(self) -> Dict[str, int]:
+        return {tier.name.lower(): int(self.tier_counts[tier]) for tier in UpdateTier}
@@ -0,0 +1,33 @@
+from typing import List
+from tdw.add_ons.obi import Obi
+
+"""
+The Obi fluid solver of the fire and flood controllers, set up for an episode and torn down before the next
+scene of a reused build.
+"""
+
+def obi_solver_ids(solver_id: int) -> List[int]:
+    """
+    The solvers in the build after init_obi: solver_id, set up by it, and solver 0, the default solver of the
+    Obi add-on. Highest first, so that destroying one does not shift the id of the next.
+    """
+    return sorted({solver_id, 0}, reverse=True)
+
+
+def init_obi(controller, solver_id: int) -> Obi:
+    obi = Obi()
+    controller.communicate([{"$type": "create_obi_solver"}])
+    obi.set_solver(solver_id=solver_id, scale_factor=1.0, substeps=1)
+    controller.add_ons.append(obi)
+    controller.communicate([])
+    controller.communicate([])
+    return obi
+
+
+def destroy_obi(controller, obi: Obi, solver_id: int):
+    """
+    Remove the add-on of init_obi from the controller and destroy its solvers.
+    """
+    if obi in controller.add_ons:
+        controller.add_ons.remove(obi)
+    controller.communicate([{"$type": "destroy_obi_solver", "solver_id": i} for i in obi_solver_ids(solver_id)])
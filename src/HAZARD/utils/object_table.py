@@ -0,0 +1,247 @@
+from collections.abc import MutableMapping
+from enum import Enum
+from typing import Dict, List, Tuple
+import numpy as np
+
+"""
+Struct-of-arrays storage for object status.
+
+Every hazard keeps one row per object id. Attributes declared as Column live in numpy columns
+of an ObjectTable, so vectorized code can run directly on table.column(name), while
+manager.objects[idx].position and friends keep working through the row object.
+"""
+
+class Column:
+    """
+    Attribute stored in an ObjectTable column once the object is added to a table.
+    Before that (and after it is removed) the value is kept on the object itself.
+
+    shape: () for scalars, (n,) for vectors. Vectors may be None (unknown) and are read as copies.
+    enum: scalars of this Enum type are stored by value and read back as enum members.
+    """
+    def __init__(self, dtype, shape: Tuple[int, ...] = (), enum=None):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.enum = enum
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        if obj._table is None:
+            return obj._values[self.name]
+        return obj._table.get(self.name, obj._row)
+
+    def __set__(self, obj, value):
+        if obj._table is None:
+            obj._values[self.name] = value
+        else:
+            obj._table.set(self.name, obj._row, value)
+
+
+class TableRow:
+    """
+    Base class of objects stored in an ObjectTable. Subclasses declare Column attributes
+    and list their other attributes in __slots__.
+    """
+    __slots__ = ("_table", "_row", "_values")
+
+    def __init__(self):
+        self._table = None
+        self._row = -1
+        self._values = dict()
+
+    @classmethod
+    def table_columns(cls) -> Dict[str, Column]:
+        columns = dict()
+        for klass in reversed(cls.__mro__):
+            for name, attr in vars(klass).items():
+                if isinstance(attr, Column):
+                    columns[name] = attr
+        return columns
+
+    def vector(self, name: str):
+        """
+        Vector attribute without copying, for computations that build a new array anyway.
+        """
+        if self._table is None:
+            return self._values[name]
+        return self._table.vector(name, self._row)
+
+
+class ObjectTable(MutableMapping):
+    """
+    Dict-like mapping from object id to row objects, iterated in insertion order.
+    Removal moves the last row into the freed one, so columns stay dense.
+    """
+    def __init__(self, row_class, capacity: int = 64):
+        self.specs = row_class.table_columns()
+        self.capacity = capacity
+        self.size = 0
+        self.rows: Dict[int, int] = dict() # id -> row, keeps insertion order
+        self.views: List[TableRow] = []
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.columns: Dict[str, np.ndarray] = {name: np.zeros((capacity,) + spec.shape, dtype=spec.dtype)
+                                               for name, spec in self.specs.items()}
+        self.valid: Dict[str, np.ndarray] = {name: np.zeros(capacity, dtype=bool)
+                                             for name, spec in self.specs.items() if len(spec.shape) > 0}
+        self.sorted_ids = None # (sorted ids, their rows), rebuilt by lookup after rows are added or removed
+        self.version = 0 # bumped by every change that goes through the table, not by in-place column edits
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __contains__(self, idx):
+        return idx in self.rows
+
+    def __getitem__(self, idx):
+        return self.views[self.rows[idx]]
+
+    def __setitem__(self, idx, obj: TableRow):
+        if obj._table is not None:
+            if obj._table is self and self.rows.get(idx) == obj._row:
+                return
+            raise ValueError("object {} is already stored in a table".format(idx))
+        self.version += 1
+        if idx in self.rows:
+            row = self.rows[idx]
+            self.detach(row)
+        else:
+            self.sorted_ids = None
+            if self.size == self.capacity:
+                self.grow()
+            row = self.size
+            self.size += 1
+            self.rows[idx] = row
+            self.views.append(obj)
+        self.ids[row] = idx
+        for name in self.specs:
+            self.set(name, row, obj._values[name])
+        self.views[row] = obj
+        obj._table = self
+        obj._row = row
+        obj._values = None
+
+    def __delitem__(self, idx):
+        row = self.rows.pop(idx)
+        self.version += 1
+        self.detach(row)
+        self.sorted_ids = None
+        last = self.size - 1
+        if row != last:
+            self.ids[row] = self.ids[last]
+            for name, column in self.columns.items():
+                column[row] = column[last]
+            for name, valid in self.valid.items():
+                valid[row] = valid[last]
+            moved = self.views[last]
+            moved._row = row
+            self.views[row] = moved
+            self.rows[int(self.ids[row])] = row
+        self.views.pop()
+        for valid in self.valid.values():
+            valid[last] = False
+        self.size -= 1
+
+    def clear(self):
+        self.version += 1
+        for row in range(self.size):
+            self.detach(row)
+        self.rows = dict()
+        self.views = []
+        self.size = 0
+        self.sorted_ids = None
+        for valid in self.valid.values():
+            valid[:] = False
+
+    def detach(self, row: int):
+        """
+        Copy the row back into its object, which then lives on outside of the table.
+        """
+        obj = self.views[row]
+        obj._values = {name: self.get(name, row) for name in self.specs}
+        obj._table = None
+        obj._row = -1
+
+    def grow(self):
+        self.capacity *= 2
+        self.ids = np.resize(self.ids, self.capacity)
+        for name in self.columns:
+            column = np.zeros((self.capacity,) + self.specs[name].shape, dtype=self.specs[name].dtype)
+            column[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = column
+        for name in self.valid:
+            valid = np.zeros(self.capacity, dtype=bool)
+            valid[:self.size] = self.valid[name][:self.size]
+            self.valid[name] = valid
+
+    def get(self, name: str, row: int):
+        if name in self.valid:
+            if not self.valid[name][row]:
+                return None
+            return self.columns[name][row].copy()
+        value = self.columns[name][row].item()
+        enum = self.specs[name].enum
+        return value if enum is None else enum(value)
+
+    def vector(self, name: str, row: int):
+        if not self.valid[name][row]:
+            return None
+        return self.columns[name][row]
+
+    def set(self, name: str, row: int, value):
+        self.version += 1
+        if name in self.valid:
+            if value is None:
+                self.valid[name][row] = False
+                return
+            self.columns[name][row] = value
+            self.valid[name][row] = True
+            return
+        if isinstance(value, Enum):
+            value = value.value
+        self.columns[name][row] = value
+
+    def lookup(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rows of many ids at once. Returns (rows, found), rows are only meaningful where found is True.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.size == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        if self.sorted_ids is None:
+            order = np.argsort(self.ids[:self.size], kind="stable")
+            self.sorted_ids = (self.ids[:self.size][order], order)
+        sorted_ids, order = self.sorted_ids
+        position = np.minimum(np.searchsorted(sorted_ids, ids), self.size - 1)
+        return order[position], sorted_ids[position] == ids
+
+    def write(self, name: str, rows: np.ndarray, values: np.ndarray):
+        """
+        Indexed assignment of a whole column slice, e.g. all positions of a frame.
+        """
+        self.version += 1
+        self.columns[name][rows] = values
+        if name in self.valid:
+            self.valid[name][rows] = True
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        The column of the stored rows, writable in place. Row order is not insertion order, see id_array.
+        """
+        return self.columns[name][:self.size]
+
+    def valid_mask(self, name: str) -> np.ndarray:
+        return self.valid[name][:self.size]
+
+    def id_array(self) -> np.ndarray:
+        return self.ids[:self.size]
+
+    def row_of(self, idx: int) -> int:
+        return self.rows[idx]
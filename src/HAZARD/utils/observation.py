@@ -0,0 +1,131 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from collections.abc import MutableMapping
+import functools
+
+"""
+Observations of the agent controllers, made at most once per frame and agent.
+
+_obs() steps a frame and decodes the images, then computes the segmentation, the semantic map and the goal
+map. Planners call it several times without advancing a frame in between, and each of these calls got the
+same observation again at the cost of a frame. The observation of a frame is now kept until the next frame.
+
+Not every planner reads every field either: the RL agent reads RL, walking reads sem_map. Agents declare the
+fields they read in obs_fields (e.g. ["goal_map", "raw.seg_mask"]), with lazy_obs the controllers compute
+those right away and the others only if they are read.
+"""
+
+class LazyObservation(MutableMapping):
+    """
+    Dict of observation fields, some of which are only computed on first access.
+    add(name, build) registers a field computed by build(), values set directly are plain fields.
+    The fields of a frame have to be read before the next one, clock() returns the current frame.
+    """
+    def __init__(self, frame: int, clock: Callable[[], int]):
+        self.frame = frame
+        self.clock = clock
+        self.values: Dict[str, Any] = dict()
+        self.builders: Dict[str, Callable[[], Any]] = dict()
+
+    def add(self, name: str, build: Callable[[], Any]):
+        self.values.pop(name, None)
+        self.builders[name] = build
+
+    def replace(self, name: str, build: Callable[[], Any]):
+        """
+        Replace a field by build(), now if the field is computed already and on first access otherwise.
+        """
+        if name in self.values:
+            self[name] = build()
+        else:
+            self.add(name, build)
+
+    def compute(self, names: Optional[List[str]] = None):
+        """
+        Compute the given fields now (all if None), in the order they were added. For a field that is an
+        observation itself, "name.field" computes one of its fields and "name" all of them.
+        """
+        for name in list(self):
+            nested = None
+            if names is not None and name not in names:
+                nested = [n[len(name) + 1:] for n in names if n.startswith(name + ".")]
+                if len(nested) == 0:
+                    continue
+            value = self[name]
+            if isinstance(value, LazyObservation):
+                value.compute(nested)
+
+    def computed(self) -> List[str]:
+        return list(self.values)
+
+    def copy(self) -> "LazyObservation":
+        """
+        Observation with the same fields, the uncomputed ones computed by (and kept in) this observation.
+        Fields set or added on the copy leave this observation unchanged.
+        """
+        obs = LazyObservation(self.frame, self.clock)
+        obs.values = dict(self.values)
+        for name in self.builders:
+            obs.builders[name] = functools.partial(self.__getitem__, name)
+        return obs
+
+    def __getitem__(self, name: str):
+        if name not in self.values:
+            if name not in self.builders:
+                raise KeyError(name)
+            if self.clock() != self.frame:
+                raise RuntimeError("Field {} of the observation of frame {} read at frame {}, call _obs() again".format(
+                    name, self.frame, self.clock()))
+            self.values[name] = self.builders[name]()
+            del self.builders[name]
+        return self.values[name]
+
+    def __setitem__(self, name: str, value):
+        self.builders.pop(name, None)
+        self.values[name] = value
+
+    def __delitem__(self, name: str):
+        if name in self.values:
+            del self.values[name]
+        else:
+            del self.builders[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.values or name in self.builders
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.values) + list(self.builders))
+
+    def __len__(self) -> int:
+        return len(self.values) + len(self.builders)
+
+
+class ObservationCache:
+    """
+    The last observation of each agent and the frame it was made on.
+    get(agent_idx, frame) returns it if no frame advanced since, None otherwise (or if disabled).
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.observations: Dict[int, Any] = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, agent_idx: int, frame: int):
+        if not self.enabled:
+            return None
+        obs = self.observations.get(agent_idx)
+        if obs is None or obs.frame != frame:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return obs
+
+    def put(self, agent_idx: int, obs: LazyObservation):
+        if self.enabled:
+            self.observations[agent_idx] = obs
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses)
@@ -0,0 +1,41 @@
+from typing import Tuple
+import numpy as np
+from tdw.output_data import Transforms, Bounds, Rigidbodies, Replicants
+
+"""
+Decode whole TDW output data blobs into numpy arrays, instead of calling the per-object getters.
+The arrays are views of the blob, copy them (e.g. by writing into an ObjectTable) before keeping them.
+"""
+
+def decode_transforms(b: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns ids (N,), positions (N, 3), rotations (N, 4)
+    """
+    data = Transforms(b).data
+    return data.IdsAsNumpy(), data.PositionsAsNumpy().reshape(-1, 3), data.RotationsAsNumpy().reshape(-1, 4)
+
+def decode_bounds(b: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns ids (N,), sizes (N, 3). The size is the extent of the front/back/left/right/top/bottom points.
+    """
+    data = Bounds(b).data
+    ids = data.IdsAsNumpy()
+    points = data.BoundPositionsAsNumpy().reshape(len(ids), 7, 3)[:, :6]
+    return ids, points.max(axis=1) - points.min(axis=1)
+
+def decode_rigidbodies(b: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns ids (N,), velocities (N, 3), sleeping (N,)
+    """
+    data = Rigidbodies(b).data
+    return data.IdsAsNumpy(), data.VelocitiesAsNumpy().reshape(-1, 3), data.SleepingsAsNumpy().astype(bool)
+
+def decode_replicants(b: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns ids (N,), positions (N, 3) of the replicants themselves (not their body parts).
+    """
+    repl = Replicants(b)
+    num_body_parts = repl.get_num_body_parts()
+    ids = repl.data.IdsAsNumpy().reshape(-1, num_body_parts)[:, 0]
+    positions = repl.data.PositionsAsNumpy().reshape(-1, num_body_parts, 3)[:, 0]
+    return ids, positions
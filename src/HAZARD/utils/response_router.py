@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+from tdw.output_data import OutputData
+
+"""
+Classify the output data of a communicate() call once, instead of every consumer scanning resp
+and parsing the type id of every blob again.
+
+The controller owns one router and hands it to its add-ons. The first consumer of a frame builds the
+index, the others (same resp list) reuse it.
+"""
+
+class ResponseRouter:
+    """
+    route(resp): type id -> blobs of that type, in response order.
+    select(resp, r_ids): (type id, blob) of the given types, in response order, for handlers
+    whose result depends on the order of different types.
+    timed(name): accumulate the time spent by a handler, see timings.
+    """
+    def __init__(self):
+        self.resp = None # kept alive so that a new list can never be mistaken for the indexed one
+        self.entries: List[Tuple[str, bytes]] = []
+        self.index: Dict[str, List[bytes]] = dict()
+        self.frames = 0
+        self.timings: Dict[str, List[float]] = dict() # handler name -> [calls, seconds]
+
+    def route(self, resp: List[bytes]) -> Dict[str, List[bytes]]:
+        if resp is not self.resp:
+            # the last element of resp is the frame count
+            self.entries = [(OutputData.get_data_type_id(resp[i]), resp[i]) for i in range(len(resp) - 1)]
+            self.index = dict()
+            for r_id, b in self.entries:
+                self.index.setdefault(r_id, []).append(b)
+            self.resp = resp
+            self.frames += 1
+        return self.index
+
+    def get(self, resp: List[bytes], r_id: str) -> List[bytes]:
+        return self.route(resp).get(r_id, [])
+
+    def select(self, resp: List[bytes], r_ids: Iterable[str]) -> List[Tuple[str, bytes]]:
+        index = self.route(resp)
+        r_ids = set(r_ids)
+        if sum(len(index.get(r_id, [])) for r_id in r_ids) == 0:
+            return []
+        return [(r_id, b) for r_id, b in self.entries if r_id in r_ids]
+
+    @contextmanager
+    def timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timing = self.timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += time.perf_counter() - start
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """
+        Calls, total and mean seconds of every timed handler.
+        """
+        return {name: {"calls": calls, "seconds": seconds, "mean": seconds / max(calls, 1)}
+                for name, (calls, seconds) in self.timings.items()}
+
+    def reset_timings(self):
+        self.timings = dict()
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import pickle
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+"""
+Scene directories (log.txt, info.json and flood.json of a room_setup_* scene) compiled once into a cached index.
+
+Parsing log.txt and matching the targets against its add_object commands takes most of the time of a
+SceneSetup. The index keeps the result in INDEX_FILE next to the sources, and is compiled again when a source
+changed: its mtime or size differs and so does the hash of the contents.
+"""
+
+INDEX_FILE = "scene_index.pkl"
+INDEX_VERSION = 1
+SOURCES = ["log.txt", "info.json", "flood.json"]
+
+
+def source_stamps(data_dir: str) -> Dict[str, Tuple[int, int]]:
+    stamps = dict()
+    for name in SOURCES:
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamps[name] = (stat.st_mtime_ns, stat.st_size)
+    return stamps
+
+
+def source_hash(data_dir: str, stamps: Dict[str, Tuple[int, int]]) -> str:
+    digest = hashlib.sha1()
+    for name in sorted(stamps):
+        digest.update(name.encode())
+        with open(os.path.join(data_dir, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def match_targets(info: dict, ids: np.ndarray, names: List[str], categories: List[str]):
+    """
+    Targets of the scene as SceneSetup reports them. Wind targets are given by id, the others by category.
+    Returns targets, target_ids, target_names, target_id2category and target_id2name.
+    """
+    ids = ids.tolist()
+    target_names = []
+    target_id2category = dict()
+    target_id2name = dict()
+    if info["task"] == "wind":
+        targets = []
+        target_ids = info["targets"]
+        rows = dict()
+        for i, idx in enumerate(ids):
+            rows.setdefault(idx, []).append(i)
+        for target in target_ids:
+            for i in rows.get(target, []):
+                if categories[i] not in targets:
+                    targets.append(categories[i])
+                if names[i] not in target_names:
+                    target_names.append(names[i])
+        if len(target_ids) > 0:
+            # every object, not only the targets, as SceneSetup always did
+            target_id2category = dict(zip(ids, categories))
+            target_id2name = dict(zip(ids, names))
+    else:
+        targets = info["targets"]
+        target_ids = []
+        rows = dict()
+        for i, category in enumerate(categories):
+            rows.setdefault(category, []).append(i)
+        for target in targets:
+            for i in rows.get(target, []):
+                if ids[i] not in target_id2category:
+                    target_ids.append(ids[i])
+                    target_id2category[ids[i]] = categories[i]
+                    target_id2name[ids[i]] = names[i]
+                if names[i] not in target_names:
+                    target_names.append(names[i])
+    return targets, target_ids, target_names, target_id2category, target_id2name
+
+
+def compile_scene(data_dir: str) -> dict:
+    """
+    The index of a scene directory: the command batches of log.txt, the add_object commands as an object table
+    (ids, names, categories, positions), the contents of info.json and flood.json, and the targets.
+    """
+    with open(os.path.join(data_dir, "log.txt"), "r", encoding="utf-8") as f:
+        commands_list = [json.loads(line) for line in f.read().strip().replace("\r", "").split("\n")]
+    with open(os.path.join(data_dir, "info.json"), "r") as f:
+        info = json.load(f)
+    flood = None
+    if os.path.exists(os.path.join(data_dir, "flood.json")):
+        with open(os.path.join(data_dir, "flood.json"), "r") as f:
+            flood = json.load(f)
+    added = [command for commands in commands_list for command in commands if command["$type"] == "add_object"]
+    scene_names = [command["name"] for commands in commands_list for command in commands
+                   if command["$type"] == "add_scene"]
+    ids = np.array([command["id"] for command in added], dtype=np.int64)
+    names = [command["name"] for command in added]
+    categories = [command["category"] for command in added]
+    positions = np.array([[command["position"]["x"], command["position"]["y"], command["position"]["z"]]
+                          for command in added], dtype=np.float64).reshape(-1, 3)
+    targets, target_ids, target_names, target_id2category, target_id2name = \
+        match_targets(info, ids, names, categories)
+    return dict(commands_list=commands_list, info=info, flood=flood,
+                scene_name=scene_names[-1] if len(scene_names) > 0 else None,
+                ids=ids, names=names, categories=categories, positions=positions,
+                targets=targets, target_ids=target_ids, target_names=target_names,
+                target_id2category=target_id2category, target_id2name=target_id2name)
+
+
+def load_scene_index(data_dir: str, write: bool = True) -> dict:
+    """
+    The index of a scene directory, from INDEX_FILE if it is still valid. Every call returns new objects,
+    so that callers may change the commands.
+    write: store a newly compiled index in INDEX_FILE, scenes in a read-only directory are compiled every time.
+    """
+    path = os.path.join(data_dir, INDEX_FILE)
+    stamps = source_stamps(data_dir)
+    cached: Optional[dict] = None
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                cached = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            cached = None
+    if cached is not None and cached["version"] == INDEX_VERSION:
+        if cached["stamps"] == stamps:
+            return cached["index"]
+        digest = source_hash(data_dir, stamps)
+        if cached["hash"] == digest:
+            # touched (e.g. by a checkout) but not changed
+            cached["stamps"] = stamps
+            save_index(path, cached, write)
+            return cached["index"]
+    else:
+        digest = source_hash(data_dir, stamps)
+    index = compile_scene(data_dir)
+    save_index(path, dict(version=INDEX_VERSION, stamps=stamps, hash=digest, index=index), write)
+    return index
+
+
+def save_index(path: str, cached: dict, write: bool):
+    if not write:
+        return
+    try:
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def compile_scenes(root: str) -> List[str]:
+    """
+    Compile the index of every scene directory below root, returns the directories.
+    """
+    compiled = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if "log.txt" in filenames and "info.json" in filenames:
+            load_scene_index(dirpath)
+            compiled.append(dirpath)
+    return sorted(compiled)
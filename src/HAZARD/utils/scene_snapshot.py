@@ -0,0 +1,95 @@
+from typing import Dict, List, Optional
+import numpy as np
+from src.HAZARD.utils.output_decoder import decode_transforms
+
+"""
+Load a scene once from its setup commands and rebuild it from a snapshot afterwards.
+
+The setup commands of a scene come in batches that are sent one frame each, some of them with step_physics
+to let the objects settle. The first load of a scene records the poses of the objects once that is done.
+Later loads send all setup commands in one batch without the physics steps and put the objects at the
+recorded poses right away.
+"""
+
+class SceneSnapshot:
+    """
+    commands: the setup commands without step_physics, ids: (N,), positions: (N, 3),
+    rotations: (N, 4) quaternions, regions: the output data of send_scene_regions if it was asked for.
+    """
+    def __init__(self, commands: List[dict], ids: np.ndarray, positions: np.ndarray, rotations: np.ndarray):
+        self.commands = commands
+        self.ids = ids
+        self.positions = positions
+        self.rotations = rotations
+        self.regions: Optional[list] = None
+
+    def rebuild_commands(self) -> List[dict]:
+        commands = list(self.commands)
+        for idx, p, r in zip(self.ids.tolist(), self.positions.tolist(), self.rotations.tolist()):
+            commands.append({"$type": "teleport_object", "id": idx, "position": {"x": p[0], "y": p[1], "z": p[2]}})
+            commands.append({"$type": "rotate_object_to", "id": idx,
+                             "rotation": {"x": r[0], "y": r[1], "z": r[2], "w": r[3]}})
+        return commands
+
+
+class SceneSnapshots:
+    """
+    Snapshots of the scenes loaded so far, by scene directory. The gyms keep one SceneSnapshots for all
+    their controllers, so that it outlives a controller that is replaced on reset.
+    load(controller, setup, batches) sends the filtered setup commands of the scene.
+    scene_regions(controller, setup) returns the output data of send_scene_regions.
+    With enabled=False both do what the controllers did before: replay every batch, ask for the regions.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.snapshots: Dict[tuple, SceneSnapshot] = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(setup) -> tuple:
+        # the record mode changes the setup commands
+        return setup.data_dir, setup.record_mode
+
+    def load(self, controller, setup, batches: List[List[dict]]):
+        snapshot = self.snapshots.get(self.key(setup)) if self.enabled else None
+        if snapshot is not None:
+            self.hits += 1
+            controller.communicate(snapshot.rebuild_commands())
+            return
+        for commands in batches[:-1]:
+            controller.communicate(commands)
+        last = batches[-1] if len(batches) > 0 else []
+        if not self.enabled:
+            controller.communicate(last)
+            return
+        self.misses += 1
+        # the poses after the last batch and its physics steps
+        resp = controller.communicate(last + [{"$type": "send_transforms"}])
+        added = np.array([command["id"] for commands in batches for command in commands
+                          if command["$type"] == "add_object"], dtype=np.int64)
+        ids, positions, rotations = [np.zeros(0, dtype=np.int64)], [np.zeros((0, 3))], [np.zeros((0, 4))]
+        for b in controller.router.get(resp, "tran"):
+            found = decode_transforms(b)
+            ids.append(found[0])
+            positions.append(found[1])
+            rotations.append(found[2])
+        ids, positions, rotations = np.concatenate(ids), np.concatenate(positions), np.concatenate(rotations)
+        keep = np.isin(ids, added)
+        commands = [command for commands in batches for command in commands if command["$type"] != "step_physics"]
+        self.snapshots[self.key(setup)] = SceneSnapshot(commands, ids[keep].astype(np.int64),
+                                                        positions[keep].astype(np.float64),
+                                                        rotations[keep].astype(np.float64))
+
+    def scene_regions(self, controller, setup) -> list:
+        snapshot = self.snapshots.get(self.key(setup)) if self.enabled else None
+        if snapshot is not None and snapshot.regions is not None:
+            return snapshot.regions
+        resp = controller.communicate([{"$type": "send_scene_regions"}])
+        if snapshot is not None:
+            # SceneBounds reads all but the last element, the frame count
+            snapshot.regions = controller.router.get(resp, "sreg") + [resp[-1]]
+        return resp
+
+    def stats(self) -> Dict[str, int]:
+        return dict(scenes=len(self.snapshots), hits=self.hits, misses=self.misses)
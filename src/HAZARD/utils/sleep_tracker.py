@@ -0,0 +1,64 @@
+from typing import Dict
+import numpy as np
+from src.HAZARD.utils.lod import nearest_distance
+
+"""
+Sleep/wake state of objects pushed by a hazard force.
+
+An object that stays at rest for several frames while the force is applied is sheltered (against a wall,
+held by friction, too heavy), so computing and sending its force again does not change anything. Such
+objects fall asleep and only get their force every probe_interval frames, to find out whether it moves
+them by now. They wake up as soon as they move, the force field changes or a neighbour moves.
+"""
+
+class SleepTracker:
+    """
+    Works on the columns of an ObjectTable whose rows declare the Columns sleeping (reported by the
+    rigidbodies output data), rest_frames and asleep.
+    update(objects, field) returns the rows whose force can be skipped on this frame.
+    """
+    def __init__(self, sleep_frames: int = 10, probe_interval: int = 20, rest_speed: float = 0.05,
+                 wake_radius: float = 1.0, field_tolerance: float = 1e-3, enabled: bool = True):
+        self.sleep_frames = sleep_frames
+        self.probe_interval = probe_interval
+        self.rest_speed = rest_speed
+        self.wake_radius = wake_radius
+        self.field_tolerance = field_tolerance
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.frame = 0
+        self.field = None
+        self.counts = dict(asleep=0, skipped=0, woken=0)
+
+    def update(self, objects, field: np.ndarray) -> np.ndarray:
+        """
+        objects: ObjectTable, field: the force field of this frame (e.g. the wind velocity).
+        """
+        self.frame += 1
+        field = np.asarray(field, dtype=np.float64)
+        rest_frames = objects.column("rest_frames")
+        asleep = objects.column("asleep")
+        was_asleep = asleep.copy()
+        has_velocity = objects.valid_mask("velocity")
+        speed = np.linalg.norm(objects.column("velocity"), axis=1)
+        resting = objects.column("sleeping") | (has_velocity & (speed < self.rest_speed))
+        rest_frames[:] = np.where(resting, rest_frames + 1, 0)
+        if self.field is None or np.abs(field - self.field).max() > self.field_tolerance:
+            rest_frames[:] = 0
+        self.field = field
+        moving = has_velocity & ~resting & objects.valid_mask("position")
+        candidates = np.flatnonzero(rest_frames >= self.sleep_frames)
+        if len(candidates) > 0 and moving.any():
+            positions = objects.column("position")
+            near = nearest_distance(positions[candidates], positions[moving]) <= self.wake_radius
+            rest_frames[candidates[near]] = 0
+        asleep[:] = rest_frames >= self.sleep_frames
+        probe = (objects.id_array() + self.frame) % self.probe_interval == 0
+        skip = asleep & ~probe
+        self.counts = dict(asleep=int(asleep.sum()), skipped=int(skip.sum()), woken=int((was_asleep & ~asleep).sum()))
+        return skip
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counts)
@@ -0,0 +1,133 @@
+import math
+import numpy as np
+from typing import Dict, Tuple, Set, List
+
+def cells_between(low_cell: tuple, high_cell: tuple) -> List[tuple]:
+    if low_cell == high_cell:
+        return [low_cell]
+    ranges = [range(l, h + 1) for l, h in zip(low_cell, high_cell)]
+    return [tuple(cell) for cell in np.array(np.meshgrid(*ranges, indexing="ij")).reshape(len(ranges), -1).T.tolist()]
+
+class SpatialHash:
+    """
+    Uniform grid over positions (or axis-aligned boxes). Keys are usually object ids.
+    A point lives in the cell containing it; a box lives in every cell it touches.
+    Queries return candidates only, callers do the exact distance / overlap test.
+    """
+    def __init__(self, cell_size: float, axes: Tuple[int, ...] = (0, 1, 2)):
+        self.cell_size = cell_size
+        self.axes = list(axes)
+        self.cells: Dict[tuple, Set[int]] = dict()
+        self.key_cells: Dict[int, Tuple[tuple, tuple]] = dict() # key -> (lowest cell, highest cell)
+
+    def __len__(self):
+        return len(self.key_cells)
+
+    def __contains__(self, key):
+        return key in self.key_cells
+
+    def clear(self):
+        self.cells = dict()
+        self.key_cells = dict()
+
+    def cell_of(self, position) -> tuple:
+        return tuple(math.floor(position[axis] / self.cell_size) for axis in self.axes)
+
+    def _bounds(self, position, extent=None):
+        position = np.asarray(position, dtype=np.float64)
+        if extent is None:
+            cell = self.cell_of(position)
+            return cell, cell
+        extent = np.asarray(extent, dtype=np.float64)
+        return self.cell_of(position - extent), self.cell_of(position + extent)
+
+    def _link(self, key, bounds):
+        self.key_cells[key] = bounds
+        for cell in cells_between(*bounds):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def _unlink(self, key):
+        for cell in cells_between(*self.key_cells.pop(key)):
+            bucket = self.cells[cell]
+            bucket.discard(key)
+            if len(bucket) == 0:
+                del self.cells[cell]
+
+    def insert(self, key: int, position, extent=None):
+        """
+        extent: half size of the box along each axis of the position, None for a point
+        """
+        if key in self.key_cells:
+            self._unlink(key)
+        self._link(key, self._bounds(position, extent))
+
+    def update(self, key: int, position, extent=None) -> bool:
+        """
+        Move a key. Returns True if it changed cells (or was not present).
+        """
+        bounds = self._bounds(position, extent)
+        old = self.key_cells.get(key)
+        if old == bounds:
+            return False
+        if old is not None:
+            self._unlink(key)
+        self._link(key, bounds)
+        return True
+
+    def update_many(self, keys: List[int], positions: np.ndarray) -> int:
+        """
+        Incremental update of point keys from an (N, 3) array. Only keys that changed cells are re-linked.
+        Returns the number of keys moved.
+        """
+        if len(keys) == 0:
+            return 0
+        cells = np.floor(np.asarray(positions, dtype=np.float64)[:, self.axes] / self.cell_size).astype(np.int64).tolist()
+        moved = 0
+        for key, cell in zip(keys, cells):
+            cell = tuple(cell)
+            old = self.key_cells.get(key)
+            if old is not None and old[0] == cell and old[1] == cell:
+                continue
+            if old is not None:
+                self._unlink(key)
+            self._link(key, (cell, cell))
+            moved += 1
+        return moved
+
+    def remove(self, key: int):
+        if key in self.key_cells:
+            self._unlink(key)
+
+    def neighbours(self, cell: tuple, reach: int = 1) -> List[int]:
+        """
+        All keys in the (2 * reach + 1)^d block of cells around a cell. Box keys may appear more than once.
+        """
+        keys = []
+        for block_cell in cells_between(tuple(c - reach for c in cell), tuple(c + reach for c in cell)):
+            bucket = self.cells.get(block_cell)
+            if bucket is not None:
+                keys.extend(bucket)
+        return keys
+
+    def query_box(self, low, high) -> Set[int]:
+        """
+        Keys whose cells overlap the box [low, high] (full 3d coordinates, only self.axes are used).
+        """
+        low_cell = self.cell_of(low)
+        high_cell = self.cell_of(high)
+        found = set()
+        if np.prod([h - l + 1 for l, h in zip(low_cell, high_cell)]) > len(self.cells):
+            # the box covers more cells than are occupied, scan the occupied ones instead
+            for cell, bucket in self.cells.items():
+                if all(l <= c <= h for c, l, h in zip(cell, low_cell, high_cell)):
+                    found.update(bucket)
+            return found
+        for cell in cells_between(low_cell, high_cell):
+            bucket = self.cells.get(cell)
+            if bucket is not None:
+                found.update(bucket)
+        return found
+
+    def query_radius(self, position, radius: float) -> Set[int]:
+        position = np.asarray(position, dtype=np.float64)
+        return self.query_box(position - radius, position + radius)
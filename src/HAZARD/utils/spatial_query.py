@@ -0,0 +1,160 @@
+from typing import Dict, Iterable, List, Optional, Set
+import numpy as np
+
+"""
+Nearest, k-nearest and radius queries over the object positions of a manager's ObjectTable,
+instead of a linear scan with one np.linalg.norm per object.
+"""
+
+class SpatialQuery:
+    """
+    Grid over the xz plane of the object positions, rebuilt lazily: only when objects were added or removed,
+    or moved by more than rebuild_distance since the last build. Objects that moved less are found through
+    their old cell and the search radius is widened by how far they moved, so results are exact.
+
+    Every query takes the same filters: name (only rows whose name is this, None for all),
+    ids (only these ids, e.g. targets) and exclude (not these ids, e.g. settled objects).
+    Rows without a position are never returned.
+    """
+    def __init__(self, objects, cell_size: float = 1.0, rebuild_distance: float = 0.5):
+        self.cell_size = cell_size
+        self.rebuild_distance = rebuild_distance
+        self.reset(objects)
+
+    def reset(self, objects):
+        """
+        objects: the ObjectTable to query, managers pass their new table after a reset.
+        """
+        self.objects = objects
+        self.version = -1
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.positions = np.zeros((0, 3)) # positions at the last build
+        self.drift = 0.0 # how far any object moved in the xz plane since the last build
+        self.current = self.positions
+        self.names = np.zeros(0, dtype=object)
+        self.cells: Dict[tuple, np.ndarray] = dict() # (x cell, z cell) -> rows
+        self.low = self.high = np.zeros(2, dtype=np.int64) # occupied cell range
+        self.builds = 0
+
+    def refresh(self):
+        objects = self.objects
+        if objects.version == self.version:
+            return
+        self.version = objects.version
+        ids = objects.id_array()
+        positions = np.where(objects.valid_mask("position")[:, None], objects.column("position"), np.nan).astype(np.float64)
+        if np.array_equal(ids, self.ids) and np.array_equal(np.isnan(positions), np.isnan(self.positions)):
+            moved = np.linalg.norm((positions - self.positions)[:, [0, 2]], axis=1)
+            drift = np.nan_to_num(moved).max(initial=0.0)
+            if drift <= self.rebuild_distance:
+                self.drift = drift
+                self.current = positions
+                return
+        self.build(ids, positions)
+
+    def build(self, ids: np.ndarray, positions: np.ndarray):
+        self.builds += 1
+        self.ids = ids.copy()
+        self.positions = positions
+        self.current = positions
+        self.drift = 0.0
+        self.names = np.array([obj.name for obj in self.objects.views], dtype=object)
+        located = np.flatnonzero(~np.isnan(positions[:, 0]))
+        cells = np.floor(positions[located][:, [0, 2]] / self.cell_size).astype(np.int64)
+        self.cells = dict()
+        if len(located) == 0:
+            return
+        unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+        order = np.argsort(inverse.reshape(-1), kind="stable")
+        bounds = np.cumsum(np.bincount(inverse.reshape(-1), minlength=len(unique)))
+        for cell, rows in zip(map(tuple, unique.tolist()), np.split(located[order], bounds[:-1])):
+            self.cells[cell] = rows
+        self.low, self.high = unique.min(axis=0), unique.max(axis=0)
+
+    def mask(self, rows: np.ndarray, name: Optional[str], exclude: Optional[Set[int]]) -> np.ndarray:
+        keep = ~np.isnan(self.current[rows, 0])
+        if name is not None:
+            keep &= self.names[rows] == name
+        if exclude is not None and len(exclude) > 0:
+            keep &= ~np.isin(self.ids[rows], np.fromiter(exclude, dtype=np.int64))
+        return keep
+
+    def ring(self, center: tuple, r: int) -> List[np.ndarray]:
+        """
+        Rows of the cells at Chebyshev distance r from center.
+        """
+        if r == 0:
+            return [self.cells[center]] if center in self.cells else []
+        x0, z0 = center
+        found = []
+        for x in range(max(x0 - r, self.low[0]), min(x0 + r, self.high[0]) + 1):
+            for z in ((z0 - r, z0 + r) if abs(x - x0) < r else range(z0 - r, z0 + r + 1)):
+                rows = self.cells.get((x, z))
+                if rows is not None:
+                    found.append(rows)
+        return found
+
+    def candidates(self, ids: Optional[Iterable[int]]):
+        """
+        Rows of the given ids in their order, or None to search the grid.
+        """
+        if ids is None:
+            return None
+        ids = np.fromiter((int(idx) for idx in ids), dtype=np.int64)
+        rows, found = self.objects.lookup(ids)
+        return rows[found]
+
+    def k_nearest(self, pos: np.ndarray, k: int, ids: Optional[Iterable[int]] = None,
+                  exclude: Optional[Set[int]] = None, name: Optional[str] = "Object") -> List[int]:
+        """
+        Up to k ids closest to pos, closest first.
+        """
+        self.refresh()
+        pos = np.asarray(pos, dtype=np.float64).reshape(3)
+        rows = self.candidates(ids)
+        if rows is None:
+            center = tuple(np.floor(pos[[0, 2]] / self.cell_size).astype(np.int64).tolist())
+            max_ring = int(max(np.abs(np.array(center) - self.low).max(), np.abs(np.array(center) - self.high).max())) if len(self.cells) > 0 else -1
+            rows = np.zeros(0, dtype=np.int64)
+            distances = np.zeros(0)
+            for r in range(max_ring + 1):
+                found = self.ring(center, r)
+                if len(found) > 0:
+                    new = np.concatenate(found)
+                    new = new[self.mask(new, name, exclude)]
+                    rows = np.concatenate([rows, new])
+                    distances = np.concatenate([distances, np.linalg.norm(self.current[new] - pos, axis=1)])
+                # objects in farther rings were at least r cells away at the last build
+                if len(rows) >= k and np.partition(distances, k - 1)[k - 1] <= r * self.cell_size - self.drift:
+                    break
+        else:
+            rows = rows[self.mask(rows, name, exclude)]
+            distances = np.linalg.norm(self.current[rows] - pos, axis=1)
+        order = np.argsort(distances, kind="stable")[:k]
+        return self.ids[rows[order]].tolist()
+
+    def nearest(self, pos: np.ndarray, ids: Optional[Iterable[int]] = None,
+                exclude: Optional[Set[int]] = None, name: Optional[str] = "Object") -> Optional[int]:
+        found = self.k_nearest(pos, 1, ids=ids, exclude=exclude, name=name)
+        return found[0] if len(found) > 0 else None
+
+    def within(self, pos: np.ndarray, radius: float, ids: Optional[Iterable[int]] = None,
+               exclude: Optional[Set[int]] = None, name: Optional[str] = "Object") -> List[int]:
+        """
+        Ids at most radius away from pos, closest first.
+        """
+        self.refresh()
+        pos = np.asarray(pos, dtype=np.float64).reshape(3)
+        rows = self.candidates(ids)
+        if rows is None:
+            low = np.floor((pos[[0, 2]] - radius - self.drift) / self.cell_size).astype(np.int64)
+            high = np.floor((pos[[0, 2]] + radius + self.drift) / self.cell_size).astype(np.int64)
+            found = [self.cells[(x, z)] for x in range(max(low[0], self.low[0]), min(high[0], self.high[0]) + 1)
+                     for z in range(max(low[1], self.low[1]), min(high[1], self.high[1]) + 1) if (x, z) in self.cells] \
+                if len(self.cells) > 0 else []
+            rows = np.concatenate(found) if len(found) > 0 else np.zeros(0, dtype=np.int64)
+        rows = rows[self.mask(rows, name, exclude)]
+        distances = np.linalg.norm(self.current[rows] - pos, axis=1)
+        keep = distances <= radius
+        order = np.argsort(distances[keep], kind="stable")
+        return self.ids[rows[keep][order]].tolist()